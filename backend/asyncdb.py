@@ -0,0 +1,88 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from database import Database
+
+
+class DatabaseTimeout(Exception):
+    pass
+
+
+class AsyncDatabase:
+    # Awaitable facade over Database: every static method is run on a bounded thread pool,
+    # each worker thread keeping its own pooled connection. A query that outlives the timeout
+    # is interrupted on its connection so it frees the worker. workers=0 runs queries inline
+    # on the event loop, which is only useful for comparison in benchmarks.
+    def __init__(self, workers: int = 8, timeout: float = 10.0):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        # on_call(name, seconds, failed) after every call, including the time spent waiting for a worker
+        self.on_call = None
+
+    def start(self, workers: int | None = None, timeout: float | None = None) -> None:
+        if workers is not None:
+            self.workers = workers
+        if timeout is not None:
+            self.timeout = timeout
+        if self.workers > 0 and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='db')
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    @staticmethod
+    def _run(method, args, kwargs, state: dict):
+        # state['conn'] is set only while this call runs on it, both changes under the call's lock,
+        # so a timeout can never interrupt the next call the worker thread runs on the same connection
+        with state['lock']:
+            if state['abandoned']:
+                raise DatabaseTimeout(getattr(method, '__name__', str(method)))
+            state['conn'] = Database.connection()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            with state['lock']:
+                state['conn'] = None
+
+    async def call(self, method, *args, timeout: float | None = None, **kwargs):
+        if self.on_call is None:
+            return await self._call(method, args, kwargs, timeout)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await self._call(method, args, kwargs, timeout)
+            failed = False
+            return result
+        finally:
+            self.on_call(getattr(method, '__name__', str(method)), time.perf_counter() - started, failed)
+
+    async def _call(self, method, args: tuple, kwargs: dict, timeout: float | None):
+        if self._executor is None:
+            return method(*args, **kwargs)
+        state = {'lock': threading.Lock(), 'conn': None, 'abandoned': False}
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._run, method, args, kwargs, state)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            with state['lock']:
+                # Still queued: it will not start. Running: its statement is interrupted
+                state['abandoned'] = True
+                if state['conn'] is not None:
+                    state['conn'].interrupt()
+            # Retrieve the eventual (usually 'interrupted') error so it is not reported as unhandled
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+            raise DatabaseTimeout(getattr(method, '__name__', str(method)))
+
+    def __getattr__(self, name: str):
+        method = getattr(Database, name)
+        if not callable(method):
+            raise AttributeError(name)
+
+        async def proxy(*args, **kwargs):
+            return await self.call(method, *args, **kwargs)
+        proxy.__name__ = name
+        return proxy
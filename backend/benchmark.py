@@ -0,0 +1,742 @@
+import os
+import sys
+import json
+import time
+import struct
+import random
+import sqlite3
+import argparse
+import datetime
+import platform
+import subprocess
+import tempfile
+
+# Benchmarks run against a throwaway database in a temporary working directory,
+# so database.py must only be imported after chdir (it creates its schema on import).
+
+# Synthetic dataset sizes; --users/--videos/--watches/--comments override single values
+SCALES = {
+    '10k': {'users': 1000, 'videos': 10000, 'watches': 50000, 'comments': 20000},
+    '100k': {'users': 10000, 'videos': 100000, 'watches': 500000, 'comments': 200000},
+    '1m': {'users': 100000, 'videos': 1000000, 'watches': 5000000, 'comments': 2000000},
+}
+
+
+def summarize(timings: list[float]) -> dict:
+    timings = sorted(timings)
+    total = sum(timings)
+    return {
+        'ops_per_sec': round(len(timings) / total, 1) if total else None,
+        'p50_us': round(timings[len(timings) // 2] * 1e6, 1),
+        'p99_us': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6, 1),
+    }
+
+
+def measure(fn, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
+
+
+def peak_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def process_peak_rss_mb(pid: int) -> float | None:
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def process_cpu_seconds(pid: int) -> float | None:
+    # User plus system CPU time of another process, from /proc (Linux only)
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError):
+        return None
+
+
+def mp4_box(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def synthetic_mp4(path: str, size: int, width: int = 1280, height: int = 720, duration: float = 60.0, chunks: int = 64) -> None:
+    # ftyp + mdat + moov, moov last as phone cameras write it: enough structure for probe_mp4, faststart and
+    # range streaming, but the payload is random bytes, not decodable video
+    timescale = 1000
+    ticks = int(duration * timescale)
+    ftyp = mp4_box(b'ftyp', b'isom' + struct.pack('>I', 0x200) + b'isomiso2avc1mp41')
+    payload_size = max(size - len(ftyp) - 8 - 1024, chunks)
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    mvhd = mp4_box(b'mvhd', struct.pack('>IIIII', 0, 0, 0, timescale, ticks) + struct.pack('>IH10x', 0x10000, 0x100) + matrix
+                   + bytes(24) + struct.pack('>I', 2))
+    tkhd = mp4_box(b'tkhd', struct.pack('>IIIII4xI8xHHH2x', 3, 0, 0, 1, 0, ticks, 0, 0, 0) + matrix
+                   + struct.pack('>II', width << 16, height << 16))
+    mdhd = mp4_box(b'mdhd', struct.pack('>IIIIIHH', 0, 0, 0, timescale, ticks, 0x55c4, 0))
+    hdlr = mp4_box(b'hdlr', struct.pack('>II4s12x', 0, 0, b'vide') + b'VideoHandler\0')
+    avcc = mp4_box(b'avcC', bytes([1, 0x64, 0x00, 0x1f, 0xff, 0xe0, 0]))
+    avc1 = mp4_box(b'avc1', bytes(6) + struct.pack('>HHH12xHHIII', 1, 0, 0, width, height, 0x480000, 0x480000, 0)
+                   + struct.pack('>H32sHh', 1, b'', 0x18, -1) + avcc)
+    stsd = mp4_box(b'stsd', struct.pack('>II', 0, 1) + avc1)
+    mdat_start = len(ftyp) + 8
+    offsets = [mdat_start + i * (payload_size // chunks) for i in range(chunks)]
+    stco = mp4_box(b'stco', struct.pack('>II', 0, chunks) + struct.pack(f'>{chunks}I', *offsets))
+    stbl = mp4_box(b'stbl', stsd + stco)
+    trak = mp4_box(b'trak', tkhd + mp4_box(b'mdia', mdhd + hdlr + mp4_box(b'minf', stbl)))
+    moov = mp4_box(b'moov', mvhd + trak)
+    with open(path, 'wb') as file:
+        file.write(ftyp)
+        file.write(struct.pack('>I4s', 8 + payload_size, b'mdat'))
+        remaining = payload_size
+        while remaining:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            file.write(block)
+            remaining -= len(block)
+        file.write(moov)
+
+
+def seed_watches(rnd: random.Random, users: int, videos: int, watches: int, days: float = 30):
+    # Spread over the last days days, like the watch log of a running site
+    now = time.time()
+    return ((f'user{rnd.randrange(users)}', rnd.randrange(1, videos + 1), now - rnd.random() * days * 86400) for _ in range(watches))
+
+
+def seed_database(path: str, users: int, videos: int, watches: int, comments: int, seed: int = 0) -> None:
+    rnd = random.Random(seed)
+    words = ['cat', 'dog', 'music', 'game', 'news', 'travel', 'food', 'code', 'python', 'sport', 'film', 'art']
+    with sqlite3.connect(path) as conn:
+        conn.executemany('INSERT INTO Users (Login, Password, Name, Description, PfpPath) VALUES (?, ?, ?, ?, ?)',
+                         ((f'user{i}', 'password', f'User {i}', ' '.join(rnd.sample(words, 3)), f'user{i}.png')
+                          for i in range(users)))
+        conn.executemany('INSERT INTO Videos (Name, Path, ImagePath, Description, OwnerId, DateTime) VALUES (?, ?, ?, ?, ?, ?)',
+                         ((' '.join(rnd.sample(words, 2)) + f' {i}', f'V{i}.mp4', f'V{i}.png', ' '.join(rnd.sample(words, 5)),
+                           f'user{rnd.randrange(users)}', '2024-01-01 00:00:00')
+                          for i in range(videos)))
+        conn.executemany('INSERT INTO Tags (Name) VALUES (?)', ((word,) for word in words))
+        conn.executemany('INSERT INTO VideoTags (TagId, VideoId, Position) VALUES (?, ?, ?)',
+                         ((tag + 1, i, position) for i in range(1, videos + 1)
+                          for position, tag in enumerate(rnd.sample(range(len(words)), 3))))
+        conn.executemany('INSERT INTO VideoWatches (WatcherId, VideoId, WatchedAt) VALUES (?, ?, ?)', seed_watches(rnd, users, videos, watches))
+        conn.executemany('INSERT OR IGNORE INTO VideoReactions (VideoId, ReactorId, IsLike) VALUES (?, ?, ?)',
+                         ((rnd.randrange(1, videos + 1), f'user{rnd.randrange(users)}', rnd.randrange(2)) for _ in range(watches // 4)))
+        conn.executemany('INSERT INTO Comments (CommentatorId, VideoId, Text, DateTime) VALUES (?, ?, ?, ?)',
+                         ((f'user{rnd.randrange(users)}', rnd.randrange(1, videos + 1), 'nice video', '2024-01-01 00:00:00')
+                          for _ in range(comments)))
+
+
+def hot_endpoints(Database, videos: int, users: int) -> dict:
+    rnd = random.Random(1)
+    return {
+        'get_video_by_id': lambda: Database.get_video_by_id(rnd.randrange(1, videos + 1)),
+        'get_user_data': lambda: Database.get_user_data(f'user{rnd.randrange(users)}'),
+        'get_videos_by_owner_page': lambda: Database.get_videos_by_owner_page(f'user{rnd.randrange(users)}'),
+        'get_comments_page': lambda: Database.get_comments_page(rnd.randrange(1, videos + 1)),
+    }
+
+
+def bench_methods(args) -> dict:
+    # Every public read path plus the common writes, each with its own random arguments
+    import database
+    from database import Database
+    seed_database(database.DB_PATH, args.users, args.videos, args.watches, args.comments)
+    Database.cache.enabled = not args.no_cache
+    Database.build_fuzzy_index()
+    rnd = random.Random(5)
+    words = ['cat', 'dog', 'music', 'game', 'news', 'travel', 'food', 'code', 'python', 'sport', 'film', 'art']
+
+    def video():
+        return rnd.randrange(1, args.videos + 1)
+
+    def user():
+        return f'user{rnd.randrange(args.users)}'
+
+    methods = {
+        **hot_endpoints(Database, args.videos, args.users),
+        'get_videos_by_ids_24': lambda: Database.get_videos_by_ids([video() for _ in range(24)]),
+        'get_video_by_path': lambda: Database.get_video_by_path(f'V{video() - 1}.mp4'),
+        'get_random_video': Database.get_random_video,
+        'get_comments_page_top': lambda: Database.get_comments_page(video(), 'top'),
+        'search_in_database': lambda: Database.search_in_database(rnd.choice(words) + ' ' + rnd.choice(words)),
+        'search_in_database_fuzzy_miss': lambda: Database.search_in_database(with_typo(rnd.choice(words) * 2, rnd)),
+        'search_in_database_fast': lambda: Database.search_in_database_fast(rnd.choice(words)),
+        'get_reccomended_videos_by_user_id': lambda: Database.get_reccomended_videos_by_user_id(user(), 10),
+        'get_user_reactions': lambda: Database.get_user_reactions(user(), [video() for _ in range(24)], []),
+        'toggle_reaction': lambda: Database.toggle_reaction('video', user(), video(), rnd.randrange(2)),
+        'add_video_watch': lambda: Database.add_video_watch(user(), video()),
+        'comment_video': lambda: Database.comment_video(user(), 'benchmark comment', video()),
+    }
+    results = {name: measure(fn, args.repeat) for name, fn in methods.items()}
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def bench_mp4(args) -> dict:
+    from mp4 import faststart, probe_mp4
+    path = 'bench.mp4'
+    probe_timings, faststart_timings = [], []
+    for _ in range(max(5, args.repeat // 100)):
+        synthetic_mp4(path, args.video_size)
+        started = time.perf_counter()
+        probe_mp4(path)
+        probe_timings.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        faststart(path)
+        faststart_timings.append(time.perf_counter() - started)
+    return {'video_size': args.video_size, 'probe_mp4': summarize(probe_timings), 'faststart': summarize(faststart_timings),
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def bench_pool(args) -> dict:
+    import database
+    from database import Database
+    seed_database(database.DB_PATH, args.users, args.videos, args.watches, args.comments)
+    Database.cache.enabled = False
+
+    def connect_per_call():
+        return sqlite3.connect(database.DB_PATH)
+
+    results = {}
+    for mode in ('connect_per_call', 'pooled'):
+        Database.connection = staticmethod(connect_per_call if mode == 'connect_per_call' else Database.pool.connection)
+        results[mode] = {name: measure(fn, args.repeat) for name, fn in hot_endpoints(Database, args.videos, args.users).items()}
+    results['speedup'] = {name: round(results['pooled'][name]['ops_per_sec'] / results['connect_per_call'][name]['ops_per_sec'], 2)
+                          for name in results['pooled']}
+    return results
+
+
+def bench_cache(args) -> dict:
+    import database
+    from database import Database
+    seed_database(database.DB_PATH, args.users, args.videos, args.watches, args.comments)
+    results = {}
+    for enabled in (False, True):
+        Database.cache.enabled = enabled
+        Database.cache.clear()
+        # Warm-up pass so the cached run measures steady state, as a long-running worker would see it
+        for fn in hot_endpoints(Database, args.videos, args.users).values():
+            for _ in range(args.repeat):
+                fn()
+        results['cached' if enabled else 'uncached'] = {name: measure(fn, args.repeat) for name, fn in hot_endpoints(Database, args.videos, args.users).items()}
+    results['speedup'] = {name: round(results['cached'][name]['ops_per_sec'] / results['uncached'][name]['ops_per_sec'], 2)
+                          for name in results['cached']}
+    results['stats'] = Database.cache.snapshot()
+    return results
+
+
+def bench_recommend(args) -> dict:
+    import database
+    import recommend
+    from database import Database
+    seed_database(database.DB_PATH, args.users, args.videos, args.watches, args.comments)
+    rnd = random.Random(3)
+
+    def full_scan():
+        # Same scoring over every video, with the user's full watch history: what the candidate bounds avoid
+        user = f'user{rnd.randrange(args.users)}'
+        with Database.connection() as conn:
+            affinity = dict(conn.execute('SELECT TagId, Weight FROM UserTagAffinity WHERE UserId = ? AND Weight > 0', (user,)).fetchall())
+            videos = conn.execute('SELECT id, DateTime, ViewCount, Likes, Dislikes FROM Videos').fetchall()
+            pairs = conn.execute('SELECT VideoId, TagId FROM VideoTags').fetchall()
+            seen = {row[0] for row in conn.execute('SELECT VideoId FROM VideoWatches WHERE WatcherId = ?', (user,))}
+        return recommend.rank(videos, pairs, affinity, seen, 10)
+
+    return {
+        'indexed': measure(lambda: Database.get_reccomended_videos_by_user_id(f'user{rnd.randrange(args.users)}', 10), args.repeat),
+        'anonymous': measure(lambda: Database.get_reccomended_videos_by_user_id(None, 10), args.repeat),
+        'full_scan': measure(full_scan, max(1, args.repeat // 100)),
+    }
+
+
+def bench_analytics(args) -> dict:
+    # Trending and channel/video stats read from the rollups, against the same answers computed from the
+    # raw watch log, as the log grows to 1x, 2x and 4x --watches; rollup throughput is measured per round
+    import database
+    from database import Database
+    seed_database(database.DB_PATH, args.users, args.videos, 0, args.comments)
+    rnd = random.Random(9)
+    hour = int(time.time() // 3600)
+
+    def raw_trending():
+        with Database.connection() as conn:
+            return conn.execute('''SELECT VideoId, SUM(POWER(0.5, (? - CAST(WatchedAt / 3600 AS INTEGER)) / 12.0)) AS Score FROM VideoWatches
+                                   WHERE WatchedAt > ? GROUP BY VideoId ORDER BY Score DESC LIMIT 24''', (hour, (hour - 47) * 3600)).fetchall()
+
+    def raw_channel_daily():
+        with Database.connection() as conn:
+            return conn.execute('''SELECT CAST(w.WatchedAt / 86400 AS INTEGER) AS Day, COUNT() FROM VideoWatches w JOIN Videos v ON v.id = w.VideoId
+                                   WHERE v.OwnerId = ? AND w.WatchedAt > ? GROUP BY Day''', (f'user{rnd.randrange(args.users)}', time.time() - 30 * 86400)).fetchall()
+
+    results, total = {}, 0
+    for factor in (1, 2, 4):
+        added = args.watches * factor - total
+        with sqlite3.connect(database.DB_PATH) as conn:
+            conn.executemany('INSERT INTO VideoWatches (WatcherId, VideoId, WatchedAt) VALUES (?, ?, ?)', seed_watches(rnd, args.users, args.videos, added))
+        total += added
+        started = time.perf_counter()
+        while Database.rollup_watches() == database.ROLLUP_BATCH:
+            pass
+        Database.refresh_trending()
+        rollup_seconds = time.perf_counter() - started
+        round_result = {
+            'rollup_watches_per_sec': round(added / rollup_seconds),
+            'get_trending_page': measure(Database.get_trending_page, args.repeat),
+            'get_channel_stats': measure(lambda: Database.get_channel_stats(f'user{rnd.randrange(args.users)}'), args.repeat),
+            'get_view_stats_video': measure(lambda: Database.get_view_stats('video', rnd.randrange(1, args.videos + 1)), args.repeat),
+        }
+        if support_power(Database):
+            round_result['raw_trending'] = measure(raw_trending, max(1, args.repeat // 100))
+        round_result['raw_channel_daily'] = measure(raw_channel_daily, max(1, args.repeat // 100))
+        results[f'{total}_watches'] = round_result
+    return results
+
+
+def support_power(Database) -> bool:
+    # POWER() needs SQLite built with its math functions
+    try:
+        Database.connection().execute('SELECT POWER(0.5, 2)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def synthetic_names(count: int, seed: int = 0) -> list[str]:
+    rnd = random.Random(seed)
+    consonants, vowels = 'bcdfghklmnprstvz', 'aeiouy'
+
+    def word():
+        return ''.join(rnd.choice(consonants) + rnd.choice(vowels) for _ in range(rnd.randint(2, 4)))
+    return [' '.join(word() for _ in range(rnd.randint(1, 3))) for _ in range(count)]
+
+
+def with_typo(text: str, rnd: random.Random) -> str:
+    i = rnd.randrange(len(text))
+    return text[:i] + rnd.choice('abcdefghijklmnopqrstuvwxyz') + text[i + 1:]
+
+
+def bench_fuzzy(args) -> dict:
+    import Levenshtein
+    from fuzzy import FuzzyIndex, normalize
+    names = synthetic_names(args.names)
+    index = FuzzyIndex()
+    started = time.perf_counter()
+    for key, name in enumerate(names):
+        index.add(key, name)
+    build_seconds = time.perf_counter() - started
+
+    rnd = random.Random(2)
+    queries = [with_typo(rnd.choice(names).split()[0], rnd) for _ in range(args.repeat)]
+    query = iter(queries * 2)
+
+    def scan():
+        text = normalize(next(query))
+        return sorted((Levenshtein.distance(name, text), key) for key, name in enumerate(names) if Levenshtein.distance(name, text) < 20)[:10]
+
+    return {
+        'names': len(names),
+        'build_seconds': round(build_seconds, 2),
+        'index': measure(lambda: index.search(next(query), 10), args.repeat),
+        'scan': measure(scan, max(1, args.repeat // 100)),
+    }
+
+
+def latency_summary(timings: list[float]) -> dict:
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'p50_ms': round(timings[len(timings) // 2] * 1e3, 2),
+        'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e3, 2),
+    }
+
+
+async def http_request(reader, writer, method: str, path: str, headers: dict, body: bytes = b'') -> tuple[int, int]:
+    head = ''.join(f'{name}: {value}\r\n' for name, value in {'Host': 'localhost', 'Content-Length': len(body), **headers}.items())
+    writer.write(f'{method} {path} HTTP/1.1\r\n{head}\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode().partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status, length
+
+
+async def run_load(port: int, requests: list[tuple[str, str, str, dict, bytes]], concurrency: int) -> dict:
+    import asyncio
+    pending = iter(requests)
+    timings = {}
+    received = {}
+    errors = {}
+
+    async def worker():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for kind, method, path, headers, body in pending:
+            started = time.perf_counter()
+            status, length = await http_request(reader, writer, method, path, headers, body)
+            timings.setdefault(kind, []).append(time.perf_counter() - started)
+            received[kind] = received.get(kind, 0) + length
+            errors[kind] = errors.get(kind, 0) + (status >= 500)
+        writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {'throughput_rps': round(len(requests) / elapsed, 1),
+            **{kind: {**latency_summary(values), 'body_bytes_per_request': round(received[kind] / len(values)), 'server_errors': errors[kind]}
+               for kind, values in timings.items()}}
+
+
+def start_server(port: int, env: dict, workers: int | None = None):
+    # workers=None runs the app in a single process; otherwise main.py's production mode with that many workers
+    import socket
+    import subprocess
+    backend = os.path.dirname(os.path.abspath(__file__))
+    if workers is None:
+        command = [sys.executable, '-c', f'import main; main.app.run(host="127.0.0.1", port={port}, single_process=True, access_log=False)']
+    else:
+        command = [sys.executable, os.path.join(backend, 'main.py'), '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers)]
+    server = subprocess.Popen(command, env={**os.environ, 'PYTHONPATH': backend, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(300):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+
+def write_video_files(count: int, size: int) -> None:
+    # Seeded video i is stored as V{i}.mp4; one synthetic file is copied so large runs stay quick to set up
+    synthetic_mp4('video/V0.mp4', size)
+    with open('video/V0.mp4', 'rb') as source:
+        data = source.read()
+    for i in range(1, count):
+        with open(f'video/V{i}.mp4', 'wb') as file:
+            file.write(data)
+
+
+def login_cookie(port: int, login: str, password: str) -> str:
+    import http.client
+    from urllib.parse import urlencode
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/login', urlencode({'username': login, 'password': password}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    reply = conn.getresponse()
+    reply.read()
+    conn.close()
+    cookie = reply.getheader('Set-Cookie')
+    if reply.status != 200 or not cookie:
+        raise RuntimeError(f'login failed with status {reply.status}')
+    return cookie.split(';')[0]
+
+
+def route_requests(args, files: int, cookie: str) -> dict:
+    # One request factory per route; ids are drawn from the whole dataset except where a file on disk is needed
+    rnd = random.Random(4)
+    words = ['cat', 'dog', 'music', 'game', 'news', 'travel', 'food', 'code', 'python', 'sport', 'film', 'art']
+    as_json = {'Content-Type': 'application/json'}
+    auth = {'Cookie': cookie}
+
+    def video():
+        return rnd.randrange(1, args.videos + 1)
+
+    def user():
+        return f'user{rnd.randrange(args.users)}'
+
+    def stored_range():
+        start = rnd.randrange(args.video_size // 2)
+        return f'/servevideo/V{rnd.randrange(files)}.mp4', {'Range': f'bytes={start}-{start + 65535}'}
+
+    return {
+        'GET /video/<id>': lambda: ('GET', f'/video/{rnd.randrange(1, files + 1)}', {}, b''),
+        'GET /video/<id> (logged in)': lambda: ('GET', f'/video/{rnd.randrange(1, files + 1)}', auth, b''),
+        'GET /video/<id>/comments': lambda: ('GET', f'/video/{video()}/comments', {}, b''),
+        'GET /profile/<name>': lambda: ('GET', f'/profile/{user()}', {}, b''),
+        'GET /profile/<name>/videos': lambda: ('GET', f'/profile/{user()}/videos', {}, b''),
+        'POST /search': lambda: ('POST', '/search', as_json, json.dumps({'text': rnd.choice(words) + ' ' + rnd.choice(words)}).encode()),
+        'GET /get_recommended_videos': lambda: ('GET', '/get_recommended_videos?count=10', auth, b''),
+        'GET /servevideo/<file> (range)': lambda: ('GET', *stored_range(), b''),
+        'POST /reactions': lambda: ('POST', '/reactions', {**as_json, **auth}, json.dumps({'Videos': [video() for _ in range(24)]}).encode()),
+        'POST /react/video': lambda: ('POST', '/react/video', {**as_json, **auth}, json.dumps({'VideoId': video(), 'IsLike': rnd.randrange(2)}).encode()),
+    }
+
+
+def bench_routes(args) -> dict:
+    # Each route is loaded on its own through keep-alive connections to a real server process
+    # (the same code path as production, no test client in between), then all of them mixed
+    import asyncio
+    os.makedirs('video', exist_ok=True)
+    os.makedirs('static', exist_ok=True)
+    import database
+    seed_database(database.DB_PATH, args.users, args.videos, args.watches, args.comments)
+    files = min(args.videos, 200)
+    write_video_files(files, args.video_size)
+
+    server = start_server(args.port, {'SANIC_DB_WORKERS': str(args.db_workers), 'SANIC_CACHE_ENABLED': '0' if args.no_cache else '1'})
+    try:
+        routes = route_requests(args, files, login_cookie(args.port, 'user0', 'password'))
+        results = {}
+        for name, make in routes.items():
+            requests = [(name, *make()) for _ in range(args.requests)]
+            load = asyncio.run(run_load(args.port, requests, args.concurrency))
+            results[name] = {'throughput_rps': load['throughput_rps'], **load[name]}
+        mixed = [(name, *make()) for _ in range(args.requests // len(routes) + 1) for name, make in routes.items()]
+        random.Random(6).shuffle(mixed)
+        results['mixed'] = asyncio.run(run_load(args.port, mixed, args.concurrency))
+        results['server_peak_rss_mb'] = process_peak_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def bench_workers(args) -> dict:
+    # Throughput of the mixed route load (reads, reactions, comments) as the production mode scales
+    # from 1 to --max-workers processes sharing one database; server_errors counts 5xx responses
+    import asyncio
+    os.makedirs('video', exist_ok=True)
+    os.makedirs('static', exist_ok=True)
+    import database
+    seed_database(database.DB_PATH, args.users, args.videos, args.watches, args.comments)
+    files = min(args.videos, 200)
+    write_video_files(files, args.video_size)
+
+    counts, workers = [], 1
+    while workers < args.max_workers:
+        counts.append(workers)
+        workers *= 2
+    results = {}
+    for workers in counts + [args.max_workers]:
+        server = start_server(args.port, {'SANIC_DB_WORKERS': str(args.db_workers), 'SANIC_JOB_WORKERS': '1'}, workers)
+        try:
+            routes = route_requests(args, files, login_cookie(args.port, 'user0', 'password'))
+            rnd = random.Random(7)
+            mixed = [(name, *make()) for _ in range(args.requests // len(routes) + 1) for name, make in routes.items()]
+            rnd.shuffle(mixed)
+            load = asyncio.run(run_load(args.port, mixed, args.concurrency))
+            results[f'{workers}_workers'] = {'throughput_rps': load['throughput_rps'],
+                                             'server_errors': sum(value['server_errors'] for value in load.values() if isinstance(value, dict)),
+                                             **{name: load[name]['p99_ms'] for name in routes}}
+        finally:
+            server.terminate()
+            server.wait()
+    base = results['1_workers']['throughput_rps']
+    for result in results.values():
+        result['speedup'] = round(result['throughput_rps'] / base, 2)
+    return results
+
+
+def bench_load(args) -> dict:
+    import asyncio
+    os.makedirs('video', exist_ok=True)
+    os.makedirs('static', exist_ok=True)
+    import database
+    seed_database(database.DB_PATH, args.users, args.videos, args.watches, args.comments)
+    files = min(args.videos, 20)
+    write_video_files(files, args.video_size)
+
+    rnd = random.Random(3)
+    words = ['cat', 'dog', 'music', 'game', 'news', 'travel', 'food', 'code', 'python', 'sport', 'film', 'art']
+    requests = []
+    for _ in range(args.requests):
+        if rnd.random() < 0.5:
+            body = json.dumps({'text': rnd.choice(words) + ' ' + rnd.choice(words)}).encode()
+            requests.append(('search', 'POST', '/search', {'Content-Type': 'application/json'}, body))
+        else:
+            start = rnd.randrange(args.video_size - 65536)
+            requests.append(('stream', 'GET', f'/servevideo/V{rnd.randrange(files)}.mp4', {'Range': f'bytes={start}-{start + 65535}'}, b''))
+
+    results = {}
+    for workers in (0, args.db_workers):
+        server = start_server(args.port, {'SANIC_DB_WORKERS': str(workers)})
+        try:
+            results['inline' if workers == 0 else f'{workers}_db_workers'] = asyncio.run(run_load(args.port, requests, args.concurrency))
+            results['inline' if workers == 0 else f'{workers}_db_workers']['server_peak_rss_mb'] = process_peak_rss_mb(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def bench_api(args) -> dict:
+    # JSON encoders and compression settings on a real /video/<id> payload, then the server's
+    # bandwidth and CPU per request for plain, compressed and revalidated page loads
+    import gzip
+    import asyncio
+    import http.client
+    import responses
+    from functools import partial
+    from sanic.response import json_dumps
+    os.makedirs('video', exist_ok=True)
+    os.makedirs('static', exist_ok=True)
+    import database
+    seed_database(database.DB_PATH, args.users, args.videos, args.watches, args.comments)
+    files = min(args.videos, 50)
+    write_video_files(files, 65536)
+
+    # A long ETag window so that tags do not rotate in the middle of the run
+    server = start_server(args.port, {'SANIC_DB_WORKERS': str(args.db_workers), 'SANIC_ETAG_WINDOW': '86400'})
+    try:
+        cookie = login_cookie(args.port, 'user0', 'password')
+
+        def fetch(path: str) -> tuple[dict, str]:
+            conn = http.client.HTTPConnection('127.0.0.1', args.port)
+            conn.request('GET', path, headers={'Cookie': cookie})
+            reply = conn.getresponse()
+            payload = json.loads(reply.read())
+            conn.close()
+            return payload, reply.getheader('ETag')
+
+        payload = fetch('/video/1')[0]
+        raw = json.dumps(payload).encode()
+        encoders = {'json': lambda: json.dumps(payload), 'sanic': lambda: json_dumps(payload), 'responses.dumps': lambda: responses.dumps(payload)}
+        results = {'payload_bytes': len(raw), 'encoder': 'orjson' if responses.orjson is not None else 'sanic',
+                   'encode': {name: measure(fn, args.repeat) for name, fn in encoders.items()}, 'compress': {}}
+        levels = [('gzip', level) for level in (1, 6, 9)] + ([('br', quality) for quality in (1, 5, 11)] if responses.brotli is not None else [])
+        for encoding, level in levels:
+            compress = partial(responses.compress, raw, encoding, gzip_level=level, brotli_quality=level)
+            results['compress'][f'{encoding}-{level}'] = {'ratio': round(len(compress()) / len(raw), 3), **measure(compress, max(1, args.repeat // 10))}
+        assert gzip.decompress(responses.compress(raw, 'gzip')) == raw
+
+        pages = [f'/video/{i}' for i in range(1, files + 1)] + [f'/profile/user{i}' for i in range(min(args.users, 50))]
+        etags = {path: fetch(path)[1] for path in pages}
+        variants = {
+            'identity': {},
+            'gzip': {'Accept-Encoding': 'gzip'},
+            **({'br': {'Accept-Encoding': 'br, gzip'}} if responses.brotli is not None else {}),
+            'revalidate': None,
+        }
+        rnd = random.Random(8)
+        results['http'] = {}
+        for name, headers in variants.items():
+            requests = [(name, 'GET', path, {'Cookie': cookie, **(headers if headers is not None else {'If-None-Match': etags[path]})}, b'')
+                        for path in (rnd.choice(pages) for _ in range(args.requests))]
+            cpu = process_cpu_seconds(server.pid)
+            load = asyncio.run(run_load(args.port, requests, args.concurrency))
+            spent = process_cpu_seconds(server.pid)
+            results['http'][name] = {'throughput_rps': load['throughput_rps'], **load[name],
+                                     'server_cpu_ms_per_request': round((spent - cpu) * 1000 / len(requests), 3) if cpu is not None else None}
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+BENCHMARKS = {
+    'methods': bench_methods,
+    'routes': bench_routes,
+    'mp4': bench_mp4,
+    'pool': bench_pool,
+    'cache': bench_cache,
+    'recommend': bench_recommend,
+    'fuzzy': bench_fuzzy,
+    'load': bench_load,
+    'api': bench_api,
+    'workers': bench_workers,
+    'analytics': bench_analytics,
+}
+
+
+def run_info(args) -> dict:
+    # Enough context to line up results from different commits and machines
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+    }
+
+
+def compare(results, baseline, path: str = '') -> dict:
+    # new / old for every number present in both runs: above 1 is faster for ops and rps, slower for latencies
+    ratios = {}
+    if isinstance(results, dict) and isinstance(baseline, dict):
+        for key, value in results.items():
+            if key in baseline:
+                ratios.update(compare(value, baseline[key], f'{path}/{key}' if path else key))
+    elif isinstance(results, (int, float)) and isinstance(baseline, (int, float)) and baseline and not isinstance(results, bool):
+        ratios[path] = round(results / baseline, 3)
+    return ratios
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='VideoHosting benchmarks')
+    parser.add_argument('benchmarks', nargs='+', choices=sorted(BENCHMARKS), metavar='benchmark',
+                        help=', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--scale', choices=list(SCALES), default='10k')
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--videos', type=int)
+    parser.add_argument('--watches', type=int)
+    parser.add_argument('--comments', type=int)
+    parser.add_argument('--names', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--db-workers', type=int, default=8)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--video-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    args = parser.parse_args(argv)
+    for name, value in SCALES[args.scale].items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    report = {'run': run_info(args), 'results': {}}
+    for name in args.benchmarks:
+        # A fresh directory per benchmark: each one seeds its own database
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            try:
+                report['results'][name] = BENCHMARKS[name](args)
+            finally:
+                os.chdir(cwd)
+                for module in ('database', 'main', 'asyncdb', 'ingest', 'jobs'):
+                    sys.modules.pop(module, None)
+    if baseline is not None:
+        report['baseline'] = {'commit': baseline.get('run', {}).get('commit'),
+                              'ratios': compare(report['results'], baseline.get('results', {}))}
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import time
+import zlib
+import json
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+# Per-key versions live in a fixed number of slots: two keys sharing a slot only cost a spurious change
+VERSION_SLOTS = 16384
+
+
+def version_slot(key) -> int:
+    # Not hash(): string hashes differ between processes, and every worker must map a key to the same slot
+    return zlib.crc32(str(key).encode()) % VERSION_SLOTS
+
+
+class LRUCache:
+    # Bounded LRU with a per-entry TTL. Thread-safe: Database methods run on the executor's threads.
+    # Values are shared between callers and must be treated as read-only.
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; a value loaded before a bump is not stored
+        self.version = 0
+        # Validators: local counters, or with a shared log the id of the last log row for the namespace / slot
+        self._namespace_version = 0
+        self._key_versions = [0] * VERSION_SLOTS
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return MISSING
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def set(self, key, value, version: int | None = None) -> None:
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, keys, log_id: int | None = None) -> None:
+        # log_id: the shared log row of this invalidation, which becomes the version of its keys
+        with self._lock:
+            self.version += 1
+            self._namespace_version = self._namespace_version + 1 if log_id is None else max(self._namespace_version, log_id)
+            for key in keys:
+                slot = version_slot(key)
+                self._key_versions[slot] = self._key_versions[slot] + 1 if log_id is None else max(self._key_versions[slot], log_id)
+                if self._entries.pop(key, None) is not None:
+                    self.stats['invalidations'] += 1
+
+    def reset_versions(self) -> None:
+        with self._lock:
+            self._namespace_version = 0
+            self._key_versions = [0] * VERSION_SLOTS
+
+    def clear(self) -> None:
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def key_version(self, key, floor: int = 0) -> int:
+        # Changes whenever key is invalidated; key None gives the version of the whole namespace
+        return max(self._namespace_version if key is None else self._key_versions[version_slot(key)], floor)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, 'entries': len(self._entries), 'max_entries': self.max_entries, 'ttl': self.ttl}
+
+
+class InvalidationLog:
+    # Shared backend for several server processes on one database: invalidations are appended to
+    # CacheInvalidations and every process replays rows newer than the last one it has seen.
+    def __init__(self, connection, poll_interval: float = 0.25, keep: int = 100000):
+        self.connection = connection
+        self.poll_interval = poll_interval
+        self.keep = keep
+        self.last_id = None
+        # Rows up to floor have been deleted; every version is at least floor, so processes that saw
+        # those rows and processes started after agree on the versions
+        self.floor = 0
+        self._next_poll = 0.0
+        self._lock = threading.Lock()
+
+    def publish(self, namespace: str, keys: list) -> int:
+        with self.connection() as conn:
+            cursor = conn.execute('INSERT INTO CacheInvalidations (Namespace, Keys) VALUES (?, ?)', (namespace, json.dumps(keys)))
+            if cursor.lastrowid % 1000 == 0:
+                conn.execute('DELETE FROM CacheInvalidations WHERE id <= ?', (cursor.lastrowid - self.keep,))
+            return cursor.lastrowid
+
+    def history(self) -> list[tuple[int, str, list]]:
+        # Every retained row, to rebuild the versions when a process joins; polling continues after them
+        with self._lock, self.connection() as conn:
+            rows = conn.execute('SELECT id, Namespace, Keys FROM CacheInvalidations ORDER BY id').fetchall()
+            self.floor = rows[0][0] - 1 if rows else 0
+            self.last_id = rows[-1][0] if rows else 0
+        return [(row_id, namespace, json.loads(keys)) for row_id, namespace, keys in rows]
+
+    def poll(self) -> list[tuple[int, str, list]]:
+        now = time.monotonic()
+        if now < self._next_poll or not self._lock.acquire(blocking=False):
+            return []
+        try:
+            self._next_poll = now + self.poll_interval
+            with self.connection() as conn:
+                if self.last_id is None:
+                    self.last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM CacheInvalidations').fetchone()[0]
+                    return []
+                rows = conn.execute('SELECT id, Namespace, Keys FROM CacheInvalidations WHERE id > ? ORDER BY id', (self.last_id,)).fetchall()
+                self.floor = max(self.floor, conn.execute('SELECT COALESCE(MIN(id), 1) - 1 FROM CacheInvalidations').fetchone()[0])
+            if rows:
+                self.last_id = rows[-1][0]
+            return [(row_id, namespace, json.loads(keys)) for row_id, namespace, keys in rows]
+        except sqlite3.Error:
+            return []
+        finally:
+            self._lock.release()
+
+
+class Cache:
+    # Named LRU caches for the hot read paths. Write paths call invalidate(namespace, *keys);
+    # with a shared log attached the invalidation also reaches every other worker within poll_interval.
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.namespaces = {}
+        self.log = None
+        self.listeners = {}
+        # Local versions restart with the process, so they are only comparable together with its epoch.
+        # With a shared log every process derives the same versions from it and shares one epoch.
+        self.epoch = secrets.token_hex(4)
+
+    def add_namespace(self, name: str, max_entries: int, ttl: float) -> None:
+        self.namespaces[name] = LRUCache(max_entries, ttl)
+
+    def share(self, log: InvalidationLog | None) -> None:
+        self.log = log
+        if log is None:
+            return
+        self.epoch = 'shared'
+        for cache in self.namespaces.values():
+            cache.reset_versions()
+        for row_id, namespace, keys in log.history():
+            cache = self.namespaces.get(namespace)
+            if cache is not None:
+                cache.invalidate(keys, row_id)
+
+    def listen(self, namespace: str, callback) -> None:
+        # callback(keys) for invalidations published by other processes, e.g. to update in-process indexes
+        self.listeners[namespace] = callback
+
+    def sync(self) -> None:
+        if self.log is None:
+            return
+        for row_id, namespace, keys in self.log.poll():
+            cache = self.namespaces.get(namespace)
+            if cache is not None:
+                cache.invalidate(keys, row_id)
+            listener = self.listeners.get(namespace)
+            if listener is not None:
+                listener(keys)
+
+    def get_many(self, namespace: str, keys: list, load) -> dict:
+        # load(missing_keys) -> {key: value}; keys absent from its result are not cached (e.g. not found)
+        if not self.enabled:
+            return load(keys)
+        self.sync()
+        cache = self.namespaces[namespace]
+        found, missing = {}, []
+        for key in keys:
+            value = cache.get(key)
+            if value is MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            version = cache.version
+            loaded = load(missing)
+            for key, value in loaded.items():
+                cache.set(key, value, version)
+            found.update(loaded)
+        return found
+
+    def versions(self, keys: list[tuple[str, object]]) -> tuple:
+        # Validators for responses built from cached data: (namespace, key) pairs to versions,
+        # tracked even while caching is disabled
+        self.sync()
+        floor = self.log.floor if self.log is not None else 0
+        return (self.epoch, *(self.namespaces[namespace].key_version(key, floor) for namespace, key in keys))
+
+    def invalidate(self, namespace: str, *keys) -> None:
+        log_id = None
+        try:
+            if self.log is not None:
+                log_id = self.log.publish(namespace, list(keys))
+        finally:
+            self.namespaces[namespace].invalidate(keys, log_id)
+
+    def notify(self, namespace: str, *keys) -> None:
+        # Publishes a change to the other processes only, for namespaces without cached entries
+        if self.log is not None:
+            self.log.publish(namespace, list(keys))
+
+    def clear(self) -> None:
+        for cache in self.namespaces.values():
+            cache.clear()
+
+    def snapshot(self) -> dict:
+        stats = {name: cache.snapshot() for name, cache in self.namespaces.items()}
+        for name, cache in stats.items():
+            lookups = cache['hits'] + cache['misses']
+            cache['hit_ratio'] = round(cache['hits'] / lookups, 3) if lookups else None
+        return {'enabled': self.enabled, 'shared': self.log is not None, 'namespaces': stats}
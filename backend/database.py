@@ -1,130 +1,298 @@
 import sqlite3
 import random
-import hashlib
 import datetime
-import Levenshtein
+import time
+import threading
+import os
+import re
 import json
+from fuzzy import FuzzyIndex
+from cache import Cache, InvalidationLog
+from pagination import InvalidCursor, decode_cursor, encode_cursor, page
+import recommend
+from migrations import id_ranges, run_migrations
 
-def hashPassword(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+DB_PATH = 'database.db'
+
+# Tag strings inside TagsJSON, for use in SQL next to a Videos row; invalid JSON counts as no tags
+TAG_SOURCE = "json_each(CASE WHEN json_valid({row}.TagsJSON) AND json_type({row}.TagsJSON) = 'array' THEN {row}.TagsJSON ELSE '[]' END) tag"
+TAG_VALUE = "lower(trim(tag.value))"
+# Space separated tag names of a video, for the Tags column of VideosSearch
+VIDEO_TAG_NAMES = "(SELECT COALESCE(group_concat(t.Name, ' '), '') FROM VideoTags vt JOIN Tags t ON t.id = vt.TagId WHERE vt.VideoId = {video})"
+# How much a watch or a reaction moves the user's affinity for each tag of the video
+WATCH_AFFINITY = 1.0
+LIKE_AFFINITY = 2.0
+DISLIKE_AFFINITY = -2.0
+
+VIDEO_SEARCH_RANK = 'bm25(VideosSearch, 10.0, 1.0, 5.0)'
+USER_SEARCH_RANK = 'bm25(UsersSearch, 0.0, 10.0, 1.0)'
+COMMENT_ORDERS = {'new': 'DateTime', 'top': 'Likes'}
+COMMENTS_PAGE_MAX = 100
+# Reaction table, its target column and the table holding the target's Likes/Dislikes counters
+REACTION_TARGETS = {
+    'video': ('VideoReactions', 'VideoId', 'Videos'),
+    'comment': ('CommentReactions', 'CommentId', 'Comments'),
+}
+REACTIONS_BULK_MAX = 200
+# Watch analytics are bucketed by UTC epoch hour and day; hourly buckets older than this are dropped,
+# daily ones are kept
+HOUR = 3600
+DAY = 86400
+HOURLY_RETENTION = 14 * 24
+ROLLUP_BATCH = 50000
+# Rollup tables per subject: (hourly table, daily table, key column)
+VIEW_ROLLUPS = {
+    'video': ('VideoViewsHourly', 'VideoViewsDaily', 'VideoId'),
+    'channel': ('ChannelViewsHourly', 'ChannelViewsDaily', 'OwnerId'),
+}
+
+def comment_cache_keys(VideoId: int) -> list[str]:
+    return [f'{int(VideoId)}:{sort}' for sort in COMMENT_ORDERS]
+
+def view_series(views: dict[int, int], last: int, count: int, seconds: int, field: str, format: str) -> list[dict]:
+    # The count buckets ending with last, oldest first, with zeros where nothing was watched
+    return [{field: datetime.datetime.fromtimestamp(bucket * seconds, datetime.timezone.utc).strftime(format), 'Views': views.get(bucket, 0)}
+            for bucket in range(last - count + 1, last + 1)]
+
+def fts_query(text: str) -> str | None:
+    # Every word of the user's text becomes a quoted prefix term, so FTS5 syntax in the input is never interpreted
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+class ConnectionPool:
+    # One long-lived connection per thread (and per process, so forked workers never share one).
+    # sqlite3 keeps an LRU of compiled statements per connection, so constant SQL strings are prepared once.
+    def __init__(self, path: str, cached_statements: int = 256, cache_size_kb: int = 64 * 1024,
+                 mmap_size: int = 256 * 1024 * 1024, busy_timeout: float = 30.0):
+        self.path = path
+        self.cached_statements = cached_statements
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, cached_statements=self.cached_statements,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close_all(self) -> None:
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass
+        self._local = threading.local()
 
 class Database:
+    pool = ConnectionPool(DB_PATH)
+    video_names = FuzzyIndex()
+    channel_names = FuzzyIndex()
+    cache = Cache()
+    cache.add_namespace('video', max_entries=20000, ttl=30)
+    cache.add_namespace('user', max_entries=20000, ttl=300)
+    cache.add_namespace('comments', max_entries=5000, ttl=120)
+    cache.add_namespace('session', max_entries=50000, ttl=60)
+
     @staticmethod
-    def get_all_videos_by_owner_id(OwnerId: str) -> list[dict]:
-        videos = []
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT Name, Path, ImagePath, Description, OwnerId, DateTime,id, TagsJSON FROM Videos WHERE OwnerId = ?', (OwnerId,))
-            rows = cursor.fetchall()
-            for row in rows:
-                video = {
-                    'Name': row[0],
-                    'Path': row[1],
-                    'ImagePath': row[2],
-                    'Description': row[3],
-                    'Owner': Database.get_user_data(row[4]), 
-                    'DateTime':row[5],
-                    'id':row[6],
-                    'Tags': json.loads(row[7]) if row[7] else []
-                }
-                videos.append(video)
-        return videos
-    
-    def get_user_favorite_tags(user_id: str) -> list[str]:
-        tags = {}
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT VideoId FROM VideoWatches WHERE WatcherId = ?', (user_id,))
-            WatchedVideos = []
-            for row in cursor.fetchall():
-                video = Database.get_video_by_id(row[0])
-                if video:
-                    WatchedVideos.append(video)
-            for video in WatchedVideos:
-                for tag in video['Tags']:
-                    if tag in tags:
-                        tags[tag] += 1
-                    else:
-                        tags[tag] = 1
-            return tags
+    def connection() -> sqlite3.Connection:
+        return Database.pool.connection()
+
+    @staticmethod
+    def get_videos_by_owner_page(OwnerId: str, cursor: str | None = None, limit: int = 24) -> dict:
+        # Newest first, keyed on (DateTime, id) over the VideosOwnerDate index
+        after = decode_cursor(cursor, 2)
+        with Database.connection() as conn:
+            if after is None:
+                rows = conn.execute('''SELECT id, DateTime FROM Videos WHERE OwnerId = ?
+                                       ORDER BY DateTime DESC, id DESC LIMIT ?''', (OwnerId, limit + 1)).fetchall()
+            else:
+                rows = conn.execute('''SELECT id, DateTime FROM Videos WHERE OwnerId = ? AND (DateTime, id) < (?, ?)
+                                       ORDER BY DateTime DESC, id DESC LIMIT ?''', (OwnerId, after[0], after[1], limit + 1)).fetchall()
+        rows, next_cursor = page(rows, limit, lambda row: [row[1], row[0]])
+        return {'videos': Database.get_videos_by_ids([row[0] for row in rows]), 'next': next_cursor}
     
-    def get_reccomended_videos_by_user_id(user_id: str, count: int) -> list[dict]:
-        tags = Database.get_user_favorite_tags(user_id)
-        videos = []
-        with sqlite3.connect('database.db') as conn:
-            for tag in tags:
-                cursor = conn.execute('SELECT Name, Path, ImagePath, Description, OwnerId, DateTime, id, TagsJSON FROM Videos WHERE TagsJSON LIKE ?', (f'%{tags}%',))
-                cursor = cursor.fetchall()
-                if not cursor:
-                    continue
-                for row in cursor:
-                    video = {
-                        'Name': row[0],
-                        'Path': row[1],
-                        'ImagePath': row[2],
-                        'Description': row[3],
-                        'Owner':Database.get_user_data(row[4]), 
-                        'DateTime':row[5],
-                        'id':row[6],
-                        'Tags': json.loads(row[7]) if row[7] else []
-                    }
-                    videos.append(video)
-        while len(videos) < count:
-            videos.append(Database.get_random_video())
-        try:
-            return random.sample(videos, count)
-        except ValueError:
-            return videos
+    @staticmethod
+    def get_user_favorite_tags(user_id: str) -> dict[str, float]:
+        with Database.connection() as conn:
+            cursor = conn.execute('''SELECT t.Name, a.Weight FROM UserTagAffinity a JOIN Tags t ON t.id = a.TagId
+                                     WHERE a.UserId = ? AND a.Weight > 0 ORDER BY a.Weight DESC''', (user_id,))
+            return dict(cursor.fetchall())
+
+    @staticmethod
+    def get_reccomended_videos_by_user_id(user_id: str | None, count: int, top_tags: int = 10, per_tag: int = 50,
+                                          pool: int = 100) -> list[dict]:
+        # Candidates: the newest videos of the user's strongest tags plus the newest and most watched videos overall,
+        # so every query reads a bounded number of rows. Scoring and top-k selection are done in recommend.rank,
+        # which drops the videos the user watched or owns.
+        with Database.connection() as conn:
+            affinity = {}
+            if user_id:
+                affinity = dict(conn.execute('''SELECT TagId, Weight FROM UserTagAffinity WHERE UserId = ? AND Weight > 0
+                                                ORDER BY Weight DESC LIMIT ?''', (user_id, top_tags)).fetchall())
+            candidates = set()
+            for TagId in affinity:
+                cursor = conn.execute('SELECT VideoId FROM VideoTags WHERE TagId = ? ORDER BY VideoId DESC LIMIT ?', (TagId, per_tag))
+                candidates.update(row[0] for row in cursor)
+            candidates.update(row[0] for row in conn.execute('SELECT id FROM Videos ORDER BY id DESC LIMIT ?', (pool,)))
+            candidates.update(row[0] for row in conn.execute('SELECT id FROM Videos ORDER BY ViewCount DESC LIMIT ?', (pool,)))
+            candidates_json = json.dumps(list(candidates))
+            videos = conn.execute('''SELECT id, DateTime, ViewCount, Likes, Dislikes, OwnerId FROM Videos
+                                     WHERE id IN (SELECT value FROM json_each(?))''', (candidates_json,)).fetchall()
+            seen = set()
+            if user_id:
+                seen.update(row[0] for row in conn.execute('''SELECT DISTINCT VideoId FROM VideoWatches
+                                                             WHERE WatcherId = ? AND VideoId IN (SELECT value FROM json_each(?))''',
+                                                          (user_id, candidates_json)))
+                seen.update(row[0] for row in videos if row[5] == user_id)
+                missing = count - (len(videos) - len(seen))
+                if missing > 0:
+                    # Too few unseen candidates (a heavy watcher, a small site): fill up with unseen videos
+                    # from a random point of the id range, wrapping around once
+                    last = conn.execute('SELECT COALESCE(MAX(id), 0) FROM Videos').fetchone()[0]
+                    start = random.randint(0, last)
+                    for first, end in ((start, last + 1), (0, start)):
+                        rows = conn.execute('''SELECT id, DateTime, ViewCount, Likes, Dislikes, OwnerId FROM Videos v
+                                               WHERE id >= ? AND id < ? AND OwnerId != ? AND id NOT IN (SELECT value FROM json_each(?))
+                                                   AND NOT EXISTS (SELECT 1 FROM VideoWatches w WHERE w.WatcherId = ? AND w.VideoId = v.id)
+                                               ORDER BY id LIMIT ?''', (first, end, user_id, candidates_json, user_id, missing)).fetchall()
+                        videos.extend(rows)
+                        missing -= len(rows)
+                        if missing <= 0:
+                            break
+                    candidates_json = json.dumps([row[0] for row in videos])
+            pairs = conn.execute('''SELECT VideoId, TagId FROM VideoTags
+                                    WHERE VideoId IN (SELECT value FROM json_each(?)) AND TagId IN (SELECT value FROM json_each(?))''',
+                                 (candidates_json, json.dumps(list(affinity)))).fetchall() if affinity else []
+        return Database.get_videos_by_ids(recommend.rank(videos, pairs, affinity, seen, count))
 
     @staticmethod
     def get_video_reactions(VideoId: int) -> dict[str, int]:
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('''SELECT 
-                                SUM(CASE WHEN IsLike = 1 THEN 1 ELSE 0 END) AS LikesCount,
-                                SUM(CASE WHEN IsLike = 0 THEN 1 ELSE 0 END) AS DislikesCount
-                                FROM VideoReactions 
-                                WHERE VideoId = ?''', (VideoId,))
+        with Database.connection() as conn:
+            cursor = conn.execute('SELECT Likes, Dislikes FROM Videos WHERE id = ?', (VideoId,))
             row = cursor.fetchone()
             if row:
                 return {'Likes': row[0] if row[0] else 0, 'Dislikes':row[1] if row[1] else 0}
             return None
     
+    @staticmethod
+    def load_videos(VideoIds: list[int]) -> dict[int, dict]:
+        # Video rows without their owner, so a profile change never has to touch cached videos
+        with Database.connection() as conn:
+            ids = json.dumps(VideoIds)
+            rows = conn.execute('''SELECT id, Name, Path, ImagePath, Description, OwnerId, DateTime,
+                                          Likes, Dislikes, ViewCount, Duration, Width, Height
+                                   FROM Videos WHERE id IN (SELECT value FROM json_each(?))''', (ids,)).fetchall()
+            tags = {}
+            for VideoId, Name in conn.execute('''SELECT vt.VideoId, t.Name FROM VideoTags vt JOIN Tags t ON t.id = vt.TagId
+                                                 WHERE vt.VideoId IN (SELECT value FROM json_each(?))
+                                                 ORDER BY vt.VideoId, vt.Position''', (ids,)):
+                tags.setdefault(VideoId, []).append(Name)
+        videos = {}
+        for row in rows:
+            videos[row[0]] = {
+                'id': row[0],
+                'Name': row[1],
+                'Path': row[2],
+                'ImagePath': row[3],
+                'Description': row[4],
+                'OwnerId': row[5],
+                'DateTime': row[6],
+                'Tags': tags.get(row[0], []),
+                'Reactions': {'Likes': row[7], 'Dislikes': row[8]},
+                'ViewCount': row[9],
+                'Duration': row[10],
+                'Width': row[11],
+                'Height': row[12]
+            }
+        return videos
+
+    @staticmethod
+    def get_videos_by_ids(VideoIds: list[int]) -> list[dict]:
+        # Hydrates a whole listing from the video and user caches, loading only the misses in one query each.
+        # View counts may lag by up to the video cache TTL; reactions and edits invalidate immediately.
+        ids = [int(i) for i in dict.fromkeys(VideoIds) if i is not None]
+        if not ids:
+            return []
+        videos = Database.cache.get_many('video', ids, Database.load_videos)
+        owners = Database.get_users_data([video['OwnerId'] for video in videos.values()])
+        result = []
+        for i in ids:
+            video = videos.get(i)
+            if video is not None:
+                video = {key: value for key, value in video.items() if key != 'OwnerId'}
+                video['Owner'] = owners.get(videos[i]['OwnerId'])
+                video['Reactions'] = dict(video['Reactions'])
+                result.append(video)
+        return result
+
     @staticmethod
     def get_video_by_id(id: int) -> dict[str, str | int | datetime.datetime] | None:
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT Name, Path, ImagePath, Description, OwnerId, DateTime, id, TagsJSON FROM Videos WHERE id = ?', (id,))
-            row = cursor.fetchone()
-            if row:
-                reactions = Database.get_video_reactions(row[6])
-                if not reactions:
-                    reactions = 0
-                views = Database.get_video_watches(row[6])
-                if not views:
-                    views = 0
-                try:
-                    return {'id': row[6], 'Name':row[0], 'Path':row[1], 'ImagePath':row[2],'Description':row[3],'Owner':Database.get_user_data(row[4]), 'DateTime':row[5], 'Tags': json.loads(row[7]) if row[7] else [], 'Reactions':reactions, 'ViewCount':views}
-                except json.JSONDecodeError:
-                    return {'id': row[6], 'Name':row[0], 'Path':row[1], 'ImagePath':row[2],'Description':row[3],'Owner':Database.get_user_data(row[4]), 'DateTime':row[5], 'Tags': [], 'Reactions':reactions, 'ViewCount':views}
+        try:
+            videos = Database.get_videos_by_ids([id])
+        except (TypeError, ValueError):
             return None
+        return videos[0] if videos else None
     
     @staticmethod
-    def unreact_video(UserId: str, VideoId: int):
-        with sqlite3.connect('database.db') as conn:
-            conn.execute('DELETE FROM VideoReactions WHERE ReactorId = ? AND VideoId = ?', (UserId, VideoId,))
+    def toggle_reaction(Target: str, UserId: str, TargetId: int, IsLike: bool) -> dict | None:
+        # Pressing the same button again removes the reaction, the other one switches it. Both cases are one
+        # write transaction on the unique (target, reactor) key, so concurrent clicks can never add a second row.
+        # Returns the user's reaction and the target's counters after the change, None if the target does not exist.
+        table, column, targets = REACTION_TARGETS[Target]
+        IsLike = 1 if IsLike else 0
+        with Database.connection() as conn:
+            removed = conn.execute(f'DELETE FROM {table} WHERE {column} = ? AND ReactorId = ? AND IsLike = ?', (TargetId, UserId, IsLike)).rowcount
+            if not removed:
+                conn.execute(f'''INSERT INTO {table} ({column}, ReactorId, IsLike) SELECT id, ?, ? FROM {targets} WHERE id = ?
+                                 ON CONFLICT ({column}, ReactorId) DO UPDATE SET IsLike = excluded.IsLike''', (UserId, IsLike, TargetId))
+            row = conn.execute(f'SELECT Likes, Dislikes FROM {targets} WHERE id = ?', (TargetId,)).fetchone()
+        if row is None:
+            return None
+        if Target == 'video':
+            Database.cache.invalidate('video', int(TargetId))
+        else:
+            Database.invalidate_comment(TargetId)
+        return {'IsLike': None if removed else bool(IsLike), 'Likes': row[0], 'Dislikes': row[1]}
 
     @staticmethod
-    def is_video_reacted(UserId: str, VideoId: int) -> bool:
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT Count() FROM VideoReactions WHERE ReactorId = ? AND VideoId = ?', (UserId, VideoId,))
-            row = cursor.fetchone()
-            return int(row[0]) == 1
-    
-    @staticmethod
-    def react_video(UserId: str, VideoId: int, IsLike: int):
-        with sqlite3.connect('database.db') as conn:
-            conn.execute('INSERT INTO VideoReactions (VideoId, ReactorId, IsLike) VALUES (?, ?, ?)', (VideoId, UserId, IsLike,))
+    def get_user_reactions(UserId: str, VideoIds: list[int], CommentIds: list[int]) -> dict[str, dict[int, bool]]:
+        # The user's reactions for everything on a page, keyed by id; ids without a reaction are left out
+        reactions = {}
+        with Database.connection() as conn:
+            for key, (table, column, _), ids in (('Videos', REACTION_TARGETS['video'], VideoIds), ('Comments', REACTION_TARGETS['comment'], CommentIds)):
+                if not ids:
+                    reactions[key] = {}
+                    continue
+                cursor = conn.execute(f'''SELECT {column}, IsLike FROM {table}
+                                         WHERE ReactorId = ? AND {column} IN (SELECT value FROM json_each(?))''', (UserId, json.dumps(ids)))
+                reactions[key] = {row[0]: bool(row[1]) for row in cursor}
+        return reactions
 
     @staticmethod
     def get_video_by_path(Path: str) -> dict[str, str | int | datetime.datetime] | None:
-        with sqlite3.connect('database.db') as conn:
+        with Database.connection() as conn:
             cursor = conn.execute('SELECT Name, Path, ImagePath, Description, OwnerId, DateTime, id FROM Videos WHERE Path = ?', (Path,))
             row = cursor.fetchone()
             try:
@@ -137,7 +305,7 @@ class Database:
     @staticmethod
     def get_random_video() -> dict[str, str | int | datetime.datetime] | None:
         try:
-            with sqlite3.connect('database.db') as conn:
+            with Database.connection() as conn:
                 cursor = conn.execute('SELECT id FROM Videos ORDER BY RANDOM() LIMIT 1')
                 row = cursor.fetchone()
                 return Database.get_video_by_id(row[0])
@@ -146,108 +314,310 @@ class Database:
 
     @staticmethod
     def get_video_watches(VideoId: int) -> int:
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT COUNT() FROM VideoWatches Where VideoId = ?', (VideoId,))
+        with Database.connection() as conn:
+            cursor = conn.execute('SELECT ViewCount FROM Videos WHERE id = ?', (VideoId,))
             row = cursor.fetchone()
-            return row[0]
+            return row[0] if row else 0
 
     @staticmethod
-    def add_video_watch(UserId: str, VideoId: int):
-        with sqlite3.connect('database.db') as conn:
-            conn.execute('INSERT INTO VideoWatches (WatcherId, VideoId) VALUES (?, ?)', (UserId, VideoId))
+    def add_video_watch(UserId: str, VideoId: int, WatchedAt: float | None = None):
+        with Database.connection() as conn:
+            conn.execute('INSERT INTO VideoWatches (WatcherId, VideoId, WatchedAt) VALUES (?, ?, ?)', (UserId, VideoId, WatchedAt or time.time()))
 
     @staticmethod
-    def unreact_comment(UserId: str, CommentId: int):
-        with sqlite3.connect('database.db') as conn:
-            conn.execute('DELETE FROM CommentReactions WHERE ReactorId = ? AND CommentId = ?', (UserId, CommentId))
+    def add_video_watches(Watches: list[tuple[str | None, int, float]]):
+        # (WatcherId, VideoId, WatchedAt) with WatchedAt in Unix seconds
+        with Database.connection() as conn:
+            conn.executemany('INSERT INTO VideoWatches (WatcherId, VideoId, WatchedAt) VALUES (?, ?, ?)', Watches)
 
     @staticmethod
-    def react_comment(UserId: str, CommentId: int, IsLike: bool):
-        with sqlite3.connect('database.db') as conn:
-            conn.execute('INSERT INTO CommentReactions (CommentId, ReactorId, IsLike) VALUES (?, ?, ?)', (CommentId, UserId, IsLike))
+    def rollup_watches(batch_size: int = ROLLUP_BATCH) -> int:
+        # Folds the next batch_size watch ids into the hourly and daily rollups and returns how many ids it covered.
+        # The range is claimed by the first statement, so the transaction holds the write lock from the start and
+        # concurrent runs (one per server process) take consecutive ranges instead of counting events twice.
+        with Database.connection() as conn:
+            first, last = conn.execute('''UPDATE RollupState SET Previous = Position,
+                                              Position = MAX(Position, MIN(Position + ?, (SELECT COALESCE(MAX(id), 0) FROM VideoWatches)))
+                                          WHERE Name = 'watches' RETURNING Previous, Position''', (batch_size,)).fetchone()
+            if last <= first:
+                return 0
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS WatchBatch (VideoId INTEGER, OwnerId TEXT, Hour INTEGER, Views INTEGER)')
+            conn.execute('DELETE FROM temp.WatchBatch')
+            conn.execute(f'''INSERT INTO temp.WatchBatch (VideoId, OwnerId, Hour, Views)
+                             SELECT w.VideoId, v.OwnerId, CAST(w.WatchedAt / {HOUR} AS INTEGER), COUNT()
+                             FROM VideoWatches w LEFT JOIN Videos v ON v.id = w.VideoId
+                             WHERE w.id > ? AND w.id <= ? AND w.WatchedAt IS NOT NULL GROUP BY 1, 3''', (int(first), int(last)))
+            for hourly, daily, column in VIEW_ROLLUPS.values():
+                conn.execute(f'''INSERT INTO {hourly} ({column}, Hour, Views)
+                                 SELECT {column}, Hour, SUM(Views) FROM temp.WatchBatch WHERE {column} IS NOT NULL GROUP BY 1, 2
+                                 ON CONFLICT ({column}, Hour) DO UPDATE SET Views = Views + excluded.Views''')
+                conn.execute(f'''INSERT INTO {daily} ({column}, Day, Views)
+                                 SELECT {column}, Hour / 24, SUM(Views) FROM temp.WatchBatch WHERE {column} IS NOT NULL GROUP BY 1, 2
+                                 ON CONFLICT ({column}, Day) DO UPDATE SET Views = Views + excluded.Views''')
+            conn.execute('DELETE FROM temp.WatchBatch')
+        return int(last - first)
 
     @staticmethod
-    def comment_reaction(UserId: str, CommentId: int):
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT COUNT(), IsLike FROM CommentReactions Where CommentatorId = ? And CommentId = ?', (UserId, CommentId))
-            row = cursor.fetchone()
-            return {'IsReacted': row[0], 'IsLike': row[1]}
+    def refresh_trending(Hours: int = 48, HalfLife: float = 12.0, MinAge: float = 0.0) -> bool:
+        # Trending score: views of the last Hours hourly buckets, each hour's weight halving every HalfLife hours.
+        # Only runs when the previous refresh is at least MinAge seconds old, so with several server
+        # processes one of them does it per interval. Also drops hourly buckets past their retention.
+        now = time.time()
+        hour = int(now // HOUR)
+        weights = json.dumps([0.5 ** (age / HalfLife) for age in range(Hours)])
+        with Database.connection() as conn:
+            claimed = conn.execute("UPDATE RollupState SET Previous = Position, Position = ? WHERE Name = 'trending' AND Position <= ?",
+                                   (now, now - MinAge)).rowcount
+            if not claimed:
+                return False
+            conn.execute('DELETE FROM VideoTrending')
+            conn.execute('''INSERT INTO VideoTrending (VideoId, Score)
+                            SELECT h.VideoId, SUM(h.Views * w.value) FROM VideoViewsHourly h JOIN json_each(?) w ON w.key = ? - h.Hour
+                            WHERE h.Hour > ? GROUP BY h.VideoId''', (weights, hour, hour - Hours))
+            for hourly, _, _ in VIEW_ROLLUPS.values():
+                conn.execute(f'DELETE FROM {hourly} WHERE Hour <= ?', (hour - HOURLY_RETENTION,))
+        return True
+
+    @staticmethod
+    def get_trending_page(cursor: str | None = None, limit: int = 24) -> dict:
+        # Highest score first, keyed on (Score, VideoId) over the VideoTrendingScore index
+        after = decode_cursor(cursor, 2)
+        with Database.connection() as conn:
+            if after is None:
+                rows = conn.execute('SELECT VideoId, Score FROM VideoTrending ORDER BY Score DESC, VideoId DESC LIMIT ?', (limit + 1,)).fetchall()
+            else:
+                rows = conn.execute('''SELECT VideoId, Score FROM VideoTrending WHERE (Score, VideoId) < (?, ?)
+                                       ORDER BY Score DESC, VideoId DESC LIMIT ?''', (after[0], after[1], limit + 1)).fetchall()
+        rows, next_cursor = page(rows, limit, lambda row: [row[1], row[0]])
+        return {'videos': Database.get_videos_by_ids([row[0] for row in rows]), 'next': next_cursor}
+
+    @staticmethod
+    def get_view_stats(Subject: str, Key: str | int, Hours: int = 48, Days: int = 30) -> dict:
+        # Views of a video or a channel from the rollups only: the last Hours hours and the last Days days (UTC)
+        hourly, daily, column = VIEW_ROLLUPS[Subject]
+        hour = int(time.time() // HOUR)
+        day = hour // 24
+        with Database.connection() as conn:
+            hours = dict(conn.execute(f'SELECT Hour, Views FROM {hourly} WHERE {column} = ? AND Hour > ?', (Key, hour - Hours)).fetchall())
+            days = dict(conn.execute(f'SELECT Day, Views FROM {daily} WHERE {column} = ? AND Day > ?', (Key, day - Days)).fetchall())
+        return {'Hourly': view_series(hours, hour, Hours, HOUR, 'Hour', '%Y-%m-%dT%H:00:00Z'),
+                'Daily': view_series(days, day, Days, DAY, 'Day', '%Y-%m-%d'),
+                'PeriodViews': sum(days.values())}
+
+    @staticmethod
+    def get_channel_stats(Login: str, Hours: int = 48, Days: int = 30, Top: int = 10) -> dict:
+        stats = Database.get_view_stats('channel', Login, Hours, Days)
+        with Database.connection() as conn:
+            top = conn.execute('''SELECT d.VideoId, SUM(d.Views) AS Views FROM Videos v JOIN VideoViewsDaily d ON d.VideoId = v.id
+                                  WHERE v.OwnerId = ? AND d.Day > ? GROUP BY d.VideoId ORDER BY Views DESC, d.VideoId DESC LIMIT ?''',
+                               (Login, int(time.time() // DAY) - Days, Top)).fetchall()
+        views = dict(top)
+        stats['TopVideos'] = [{**video, 'PeriodViews': views[video['id']]} for video in Database.get_videos_by_ids(list(views))]
+        return stats
+
+    @staticmethod
+    def invalidate_comment(CommentId: int) -> None:
+        with Database.connection() as conn:
+            row = conn.execute('SELECT VideoId FROM Comments WHERE id = ?', (CommentId,)).fetchone()
+        if row:
+            Database.cache.invalidate('comments', *comment_cache_keys(row[0]))
 
     @staticmethod
     def comment_video(UserId: str, Text: str, VideoId: int):
-        with sqlite3.connect('database.db') as conn:
+        with Database.connection() as conn:
             conn.execute('INSERT INTO Comments (CommentatorId, Text, VideoId, DateTime) VALUES (?, ?, ?, ?)', (UserId, Text, VideoId, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        Database.cache.invalidate('comments', *comment_cache_keys(VideoId))
 
     @staticmethod
-    def get_all_comments(VideoId: int):
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('''
-                SELECT
-                    CommentatorId,
-                    VideoId,
-                    Text,
-                    DateTime
-                FROM Comments 
-                Where VideoId = ?  
-            ''', (VideoId,))
-            rows = cursor.fetchall()
-            comments = []
-            for row in rows:
-                comment = {
-                    'Commentator': Database.get_user_data(row[0]),
-                    'Video': row[1],
-                    'Text': row[2],
-                    'DateTime': row[3]
-                }
-                comments.append(comment)
-            return comments
+    def load_comments_page(VideoId: int, sort: str, after: list | None, limit: int) -> list[tuple]:
+        # Both orders walk an index on (VideoId, key, id), so every page costs the same whatever its depth
+        column = COMMENT_ORDERS[sort]
+        with Database.connection() as conn:
+            if after is None:
+                return conn.execute(f'''SELECT id, CommentatorId, Text, DateTime, Likes, Dislikes FROM Comments
+                                        WHERE VideoId = ? ORDER BY {column} DESC, id DESC LIMIT ?''', (VideoId, limit + 1)).fetchall()
+            return conn.execute(f'''SELECT id, CommentatorId, Text, DateTime, Likes, Dislikes FROM Comments
+                                    WHERE VideoId = ? AND ({column}, id) < (?, ?) ORDER BY {column} DESC, id DESC LIMIT ?''',
+                                (VideoId, after[0], after[1], limit + 1)).fetchall()
+
+    @staticmethod
+    def get_comments_page(VideoId: int, sort: str = 'new', cursor: str | None = None, limit: int = 20) -> dict:
+        if sort not in COMMENT_ORDERS:
+            raise InvalidCursor(sort)
+        VideoId = int(VideoId)
+        limit = min(limit, COMMENTS_PAGE_MAX)
+        after = decode_cursor(cursor, 2)
+        if after is None:
+            # First pages are what /video/<id> embeds: cached at the largest page size and sliced
+            key = f'{VideoId}:{sort}'
+            rows = Database.cache.get_many('comments', [key], lambda keys: {key: Database.load_comments_page(VideoId, sort, None, COMMENTS_PAGE_MAX)})[key]
+            rows = rows[:limit + 1]
+        else:
+            rows = Database.load_comments_page(VideoId, sort, after, limit)
+        sort_index = 3 if sort == 'new' else 4
+        rows, next_cursor = page(rows, limit, lambda row: [row[sort_index], row[0]])
+        commentators = Database.get_users_data([row[1] for row in rows])
+        comments = []
+        for row in rows:
+            comment = {
+                'id': row[0],
+                'Commentator': commentators.get(row[1]),
+                'Video': VideoId,
+                'Text': row[2],
+                'DateTime': row[3],
+                'Likes': row[4],
+                'Dislikes': row[5]
+            }
+            comments.append(comment)
+        return {'comments': comments, 'next': next_cursor}
+
     @staticmethod
     def delete_video(UserId: str, VideoId: int) -> dict:
-        with sqlite3.connect('database.db') as conn:
-            conn.execute('DELETE FROM Videos WHERE OwnerId = ? AND id = ?', (UserId, VideoId,))
-        return {'success': True}
+        with Database.connection() as conn:
+            cursor = conn.execute('DELETE FROM Videos WHERE OwnerId = ? AND id = ?', (UserId, VideoId,))
+        if cursor.rowcount:
+            Database.video_names.remove(int(VideoId))
+            Database.cache.notify('video-names', int(VideoId))
+            Database.cache.invalidate('video', int(VideoId))
+            Database.cache.invalidate('comments', *comment_cache_keys(VideoId))
+            Database.cache.invalidate('user', UserId)
+        return {'success': bool(cursor.rowcount)}
     @staticmethod
     def update_profile(Login: str, NewDescription: str, NewName: str) -> None:
-        with sqlite3.connect('database.db') as conn:
-            conn.execute("UPDATE Users SET Description = ?, Name = ? where Login = ? ", (NewDescription, NewName, Login))
+        with Database.connection() as conn:
+            cursor = conn.execute("UPDATE Users SET Description = ?, Name = ? where Login = ? ", (NewDescription, NewName, Login))
+        if cursor.rowcount:
+            Database.channel_names.add(Login, NewName)
+            Database.cache.notify('channel-names', Login)
+            Database.cache.invalidate('user', Login)
+
+    @staticmethod
+    def add_video(Name: str, Path: str, Description: str, OwnerLogin: str, Tags: list) -> int:
+        with Database.connection() as conn:
+            cursor = conn.execute('INSERT INTO Videos (Name, Path, ImagePath, Description, OwnerId, DateTime) VALUES (?, ?, ?, ?, ?, ?)', (Name, Path+'.mp4',Path+'.png', Description, OwnerLogin, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            Database.set_video_tags(conn, cursor.lastrowid, Tags)
+        Database.video_names.add(cursor.lastrowid, Name)
+        Database.cache.notify('video-names', cursor.lastrowid)
+        # The owner's version also covers the list of their videos on the profile page
+        Database.cache.invalidate('user', OwnerLogin)
+        return cursor.lastrowid
 
     @staticmethod
-    def add_video(Name: str, Path: str, Description: str, OwnerLogin: str, Tags: list) -> None:
-        with sqlite3.connect('database.db') as conn:
-            conn.execute('INSERT INTO Videos (Name, Path, ImagePath, Description, OwnerId, DateTime, TagsJSON) VALUES (?, ?, ?, ?, ?, ?, ?)', (Name, Path+'.mp4',Path+'.png', Description, OwnerLogin, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), json.dumps(Tags.split(',')) if Tags else None))
+    def set_video_tags(conn: sqlite3.Connection, VideoId: int, Tags: list | str | None) -> None:
+        # Tags are stored trimmed and lower-cased, in the given order; the VideoTags triggers update VideosSearch
+        if isinstance(Tags, str):
+            Tags = Tags.split(',')
+        tags = json.dumps([str(tag) for tag in Tags or []])
+        conn.execute('DELETE FROM VideoTags WHERE VideoId = ?', (VideoId,))
+        conn.execute(f"INSERT OR IGNORE INTO Tags (Name) SELECT {TAG_VALUE} FROM json_each(?) tag WHERE {TAG_VALUE} != ''", (tags,))
+        conn.execute(f'''INSERT OR IGNORE INTO VideoTags (TagId, VideoId, Position)
+                         SELECT t.id, ?, tag.key FROM json_each(?) tag JOIN Tags t ON t.Name = {TAG_VALUE}''', (VideoId, tags))
+
+    @staticmethod
+    def load_users(UserIds: list[str]) -> dict[str, dict]:
+        with Database.connection() as conn:
+            cursor = conn.execute('SELECT Login, Name, Description, PfpPath FROM Users WHERE Login IN (SELECT value FROM json_each(?))', (json.dumps(UserIds),))
+            return {row[0]: {'Login':row[0], 'Name':row[1], 'Description':row[2], 'PfpPath':row[3]} for row in cursor.fetchall()}
+
+    @staticmethod
+    def get_users_data(UserIds: list[str]) -> dict[str, dict]:
+        logins = [login for login in dict.fromkeys(UserIds) if login is not None]
+        if not logins:
+            return {}
+        return {login: dict(user) for login, user in Database.cache.get_many('user', logins, Database.load_users).items()}
 
     @staticmethod
     def get_user_data(UserId: str):
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT Login, Name, Description, PfpPath FROM Users WHERE Login = ?', (UserId,))
-            row = cursor.fetchone()
-            if row:
-                return {'Login':row[0], 'Name':row[1], 'Description':row[2], 'PfpPath':row[3]}
-            return None
+        return Database.get_users_data([UserId]).get(UserId)
 
     @staticmethod
-    def login_user(Login: str, Password: str):
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT Login FROM Users WHERE Login = ? and Password = ?', (Login, Password))
-            row = cursor.fetchone()
-            if row:
-                return row[0]
+    def get_password_hash(Login: str) -> str | None:
+        with Database.connection() as conn:
+            row = conn.execute('SELECT Password FROM Users WHERE Login = ?', (Login,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def set_password_hash(Login: str, Hash: str, Previous: str) -> bool:
+        # Only replaces the value that was verified, so a concurrent password change is not overwritten
+        with Database.connection() as conn:
+            return bool(conn.execute('UPDATE Users SET Password = ? WHERE Login = ? AND Password = ?', (Hash, Login, Previous)).rowcount)
+
+    @staticmethod
+    def load_sessions(Ids: list[str]) -> dict[str, tuple[dict, float]]:
+        with Database.connection() as conn:
+            rows = conn.execute('SELECT Id, Data, Expires FROM Sessions WHERE Id IN (SELECT value FROM json_each(?))', (json.dumps(Ids),)).fetchall()
+        return {row[0]: (json.loads(row[1]), row[2]) for row in rows}
+
+    @staticmethod
+    def get_session(Id: str) -> tuple[dict, float] | None:
+        session = Database.cache.get_many('session', [Id], Database.load_sessions).get(Id)
+        if session is None or session[1] <= time.time():
             return None
+        return session
 
     @staticmethod
-    def redact_video(VideoId: int, Name: str, Path: str, Description: str, Tags: list, OwnerLogin: str) -> None:
-        with sqlite3.connect('database.db') as conn:
-            conn.execute('UPDATE Videos SET Name = ?, Description = ?, TagsJSON = ? WHERE VideoId = ? and OwnerId = ?', (Name, Path+'.mp4', Description, json.dumps(Tags).replace("\\", '') if type(Tags) == list else Tags.replace('\\', ''), VideoId, OwnerLogin))
-        return True
+    def save_session(Id: str, Data: dict, Expires: float) -> None:
+        with Database.connection() as conn:
+            conn.execute('''INSERT INTO Sessions (Id, Data, Expires) VALUES (?, ?, ?)
+                            ON CONFLICT (Id) DO UPDATE SET Data = excluded.Data, Expires = excluded.Expires''', (Id, json.dumps(Data), Expires))
+        Database.cache.invalidate('session', Id)
+
+    @staticmethod
+    def delete_session(Id: str) -> None:
+        with Database.connection() as conn:
+            conn.execute('DELETE FROM Sessions WHERE Id = ?', (Id,))
+        Database.cache.invalidate('session', Id)
+
+    @staticmethod
+    def compact_sessions(batch: int = 1000) -> int:
+        # Expired sessions are already ignored on read; this only reclaims their rows, a batch per transaction
+        deleted = 0
+        while True:
+            with Database.connection() as conn:
+                count = conn.execute('DELETE FROM Sessions WHERE Id IN (SELECT Id FROM Sessions WHERE Expires <= ? LIMIT ?)',
+                                     (time.time(), batch)).rowcount
+            deleted += count
+            if count < batch:
+                return deleted
+
+    @staticmethod
+    def hash_plain_passwords(Hasher, batch: int = 100) -> int:
+        # Rows from before password hashing; run offline, each hash takes as long as a login
+        from passwords import parse
+        hashed, after = 0, ''
+        while True:
+            with Database.connection() as conn:
+                rows = conn.execute('SELECT Login, Password FROM Users WHERE Login > ? ORDER BY Login LIMIT ?', (after, batch)).fetchall()
+            if not rows:
+                return hashed
+            after = rows[-1][0]
+            for Login, Password in rows:
+                if parse(Password) is None:
+                    hashed += Database.set_password_hash(Login, Hasher.hash_sync(Password), Password)
+
+    @staticmethod
+    def redact_video(VideoId: int, Name: str, Description: str, Tags: list | str | None, OwnerLogin: str) -> bool:
+        with Database.connection() as conn:
+            cursor = conn.execute('UPDATE Videos SET Name = ?, Description = ? WHERE id = ? and OwnerId = ?', (Name, Description, VideoId, OwnerLogin))
+            if cursor.rowcount:
+                Database.set_video_tags(conn, VideoId, Tags)
+        if cursor.rowcount:
+            Database.video_names.add(int(VideoId), Name)
+            Database.cache.notify('video-names', int(VideoId))
+            Database.cache.invalidate('video', int(VideoId))
+            Database.cache.invalidate('user', OwnerLogin)
+        return bool(cursor.rowcount)
     
     @staticmethod
     def reg_user(Login: str, Password: str, Nickname: str) -> None:
-        with sqlite3.connect('database.db') as conn:
+        with Database.connection() as conn:
             conn.execute('INSERT INTO Users (Login, Password, Name, PfpPath) VALUES (?, ?, ?, ?)', (Login, Password, Nickname, Login+'.png'))
+        Database.channel_names.add(Login, Nickname)
+        Database.cache.notify('channel-names', Login)
 
     @staticmethod
     def get_video_comments(videoid: int):
-        with sqlite3.connect('database.db') as conn:
+        with Database.connection() as conn:
             cursor = conn.execute('SELECT * FROM Comments WHERE VideoId = ?', (videoid,))
             rows = cursor.fetchall()
             if rows:
@@ -262,62 +632,72 @@ class Database:
             return None
     
     @staticmethod
-    def search_in_database_slow(text:str, distance: int = 20) -> list:
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT Name, Path, ImagePath, Description, OwnerId, DateTime, id, TagsJSON FROM Videos')
-            rows = cursor.fetchall()
-            videos = []
-            for row in rows:
-                video = {
-                    'Name': row[0],
-                    'Path': row[1],
-                    'ImagePath': row[2],
-                    'Description': row[3],
-                    'Owner': Database.get_user_data(row[4]),
-                    'DateTime': row[5],
-                    'id': row[6]
-                }
-                videos.append(video)
-            cursor = conn.execute('SELECT Login, Name, Description, PfpPath FROM Users')
-            rows = cursor.fetchall()
-            channels = []
-            for row in rows:
-                channel = {
-                    'Name': row[1],
-                    'Login': row[0],
-                    'Description': row[2],
-                    'PfpPath': row[3]
-                }
-                channels.append(channel)
-            filtered_videos = [video for video in videos if Levenshtein.distance(video['Name'], text) < distance or text in video['Description']]
-            filtered_channels = [channel for channel in channels if Levenshtein.distance(channel['Name'], text) < distance or text in channel['Description']]
-            filtered_videos.sort(key=lambda video: Levenshtein.distance(video['Name'], text))
-            filtered_channels.sort(key=lambda channel: Levenshtein.distance(channel['Name'], text))
-            outputvideos = []
-            for i in filtered_videos:
-                outputvideos.append(Database.get_video_by_id(i['id']))
-            return {'videos': outputvideos, 'channels': filtered_channels}
+    def search_in_database(text: str, limit: int = 20, cursor: str | None = None, fuzzy: bool = True) -> dict:
+        # The cursor holds the last (score, rowid) of each list, None once a list is exhausted.
+        # Relevance order still makes FTS score every match, but a page no longer re-reads the ones before it.
+        query = fts_query(text)
+        if not query:
+            return {'videos': [], 'channels': [], 'next': None}
+        after = decode_cursor(cursor, 2)
+        # Picks up names changed by other processes before the fuzzy indexes are used
+        Database.cache.sync()
+        with Database.connection() as conn:
+            video_rows = Database.search_page(conn, 'VideosSearch', 'rowid', VIDEO_SEARCH_RANK, query, after[0] if after else [], limit)
+            user_rows = Database.search_page(conn, 'UsersSearch', 'Login', USER_SEARCH_RANK, query, after[1] if after else [], limit)
+        video_rows, video_next = page(video_rows, limit, lambda row: [row[1], row[2]])
+        user_rows, user_next = page(user_rows, limit, lambda row: [row[1], row[2]])
+        video_ids = [row[0] for row in video_rows]
+        logins = [row[0] for row in user_rows]
+        next_cursor = None
+        if video_next or user_next:
+            next_cursor = encode_cursor([decode_cursor(video_next), decode_cursor(user_next)])
+        if fuzzy and after is None:
+            # Typo tolerance: top up the first page with names close to the query by edit distance
+            if len(video_ids) < limit:
+                video_ids += [key for key, _ in Database.video_names.search(text, limit) if key not in video_ids][:limit - len(video_ids)]
+            if len(logins) < limit:
+                logins += [key for key, _ in Database.channel_names.search(text, limit) if key not in logins][:limit - len(logins)]
+        videos = Database.get_videos_by_ids(video_ids)
+        users = Database.get_users_data(logins)
+        channels = []
+        for login in logins:
+            user = users.get(login)
+            if user:
+                channels.append({
+                    'Name': user['Name'],
+                    'Login': user['Login'],
+                    'Description': user['Description'],
+                    'PfpPath': user['PfpPath']
+                })
+        return {'videos': videos, 'channels': channels, 'next': next_cursor}
+
+    @staticmethod
+    def search_page(conn: sqlite3.Connection, table: str, column: str, rank: str, query: str, after: list | None, limit: int) -> list[tuple]:
+        # after is [] for the first page and None when the previous page was the last one
+        if after is None:
+            return []
+        if not after:
+            return conn.execute(f'''SELECT {column}, {rank} AS score, rowid FROM {table} WHERE {table} MATCH ?
+                                    ORDER BY score, rowid LIMIT ?''', (query, limit + 1)).fetchall()
+        return conn.execute(f'''SELECT {column}, {rank} AS score, rowid FROM {table} WHERE {table} MATCH ? AND ({rank}, rowid) > (?, ?)
+                                ORDER BY score, rowid LIMIT ?''', (query, after[0], after[1], limit + 1)).fetchall()
     
     @staticmethod
-    def search_in_database_fast(text:str) -> list:
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.execute('SELECT Name, Path, ImagePath, Description, OwnerId, DateTime, id, TagsJSON FROM Videos WHERE Name LIKE ?', (f'%{text}%',))
-            rows = cursor.fetchall()
-            videos = []
-            for row in rows:
-                video = {
-                    'Name': row[0],
-                    'Path': row[1],
-                    'ImagePath': row[2],
-                    'Description': row[3],
-                    'Owner': Database.get_user_data(row[4]),
-                    'DateTime': row[5],
-                    'id': row[6],
-                    'Tags': json.loads(row[7]) if row[7] else []
-                }
-                videos.append(video)
-            cursor = conn.execute('SELECT Login, Name, Description, PfpPath, TagsJSON FROM Users WHERE Name LIKE ?', (f'%{text}%',))
-            rows = cursor.fetchall()
+    def search_in_database_fast(text:str, limit: int = 20, cursor: str | None = None) -> list:
+        # Substring match, newest videos first; the cursor is the last video id and channel login
+        after = decode_cursor(cursor, 2) or [None, None]
+        with Database.connection() as conn:
+            if after[0] is None:
+                rows = conn.execute('SELECT id FROM Videos WHERE Name LIKE ? ORDER BY id DESC LIMIT ?', (f'%{text}%', limit + 1)).fetchall()
+            else:
+                rows = conn.execute('SELECT id FROM Videos WHERE Name LIKE ? AND id < ? ORDER BY id DESC LIMIT ?', (f'%{text}%', after[0], limit + 1)).fetchall()
+            rows, video_next = page(rows, limit, lambda row: row[0])
+            videos = Database.get_videos_by_ids([row[0] for row in rows])
+            if after[1] is None:
+                cursor = conn.execute('SELECT Login, Name, Description, PfpPath FROM Users WHERE Name LIKE ? ORDER BY Login LIMIT ?', (f'%{text}%', limit + 1))
+            else:
+                cursor = conn.execute('SELECT Login, Name, Description, PfpPath FROM Users WHERE Name LIKE ? AND Login > ? ORDER BY Login LIMIT ?', (f'%{text}%', after[1], limit + 1))
+            rows, channel_next = page(cursor.fetchall(), limit, lambda row: row[0])
             channels = []
             for row in rows:
                 channels.append({
@@ -326,13 +706,239 @@ class Database:
                     'Description': row[2],
                     'PfpPath': row[3]
                 })
-            output = {'videos':videos, 'channels':channels}
+            next_cursor = None
+            if video_next or channel_next:
+                next_cursor = encode_cursor([decode_cursor(video_next), decode_cursor(channel_next)])
+            output = {'videos':videos, 'channels':channels, 'next': next_cursor}
             return output
-    
-    
+
     @staticmethod
-    def start_db() -> None:
-        with sqlite3.connect('database.db') as conn:
+    def add_job(Kind: str, Payload: dict) -> int:
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with Database.connection() as conn:
+            cursor = conn.execute("INSERT INTO Jobs (Kind, Payload, Status, Attempts, CreatedAt, UpdatedAt) VALUES (?, ?, 'queued', 0, ?, ?)", (Kind, json.dumps(Payload), now, now))
+            return cursor.lastrowid
+
+    @staticmethod
+    def get_job(JobId: int) -> dict | None:
+        with Database.connection() as conn:
+            row = conn.execute('''SELECT id, Kind, Status, Result, Error, Attempts, CreatedAt, UpdatedAt, json_extract(Payload, '$.owner_id')
+                                  FROM Jobs WHERE id = ?''', (JobId,)).fetchone()
+            if row:
+                return {'id': row[0], 'Kind': row[1], 'Status': row[2], 'Result': json.loads(row[3]) if row[3] else None,
+                        'Error': row[4], 'Attempts': row[5], 'CreatedAt': row[6], 'UpdatedAt': row[7], 'OwnerId': row[8]}
+            return None
+
+    @staticmethod
+    def claim_job(Worker: str, LeaseSeconds: float) -> dict | None:
+        # A single UPDATE ... RETURNING, so two workers can never claim the same job
+        with Database.connection() as conn:
+            row = conn.execute('''UPDATE Jobs SET Status = 'running', Worker = ?, LeaseUntil = ?, Attempts = Attempts + 1, UpdatedAt = ?
+                                  WHERE id = (SELECT id FROM Jobs WHERE Status = 'queued' ORDER BY id LIMIT 1)
+                                  RETURNING id, Kind, Payload, Attempts''',
+                               (Worker, time.time() + LeaseSeconds, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))).fetchone()
+            if row:
+                return {'id': row[0], 'Kind': row[1], 'Payload': json.loads(row[2]), 'Attempts': row[3]}
+            return None
+
+    @staticmethod
+    def extend_job_leases(JobIds: list[int], LeaseSeconds: float) -> None:
+        with Database.connection() as conn:
+            conn.execute("UPDATE Jobs SET LeaseUntil = ? WHERE Status = 'running' AND id IN (SELECT value FROM json_each(?))", (time.time() + LeaseSeconds, json.dumps(JobIds)))
+
+    @staticmethod
+    def finish_job(JobId: int, Status: str, Result: dict | None = None, Error: str | None = None) -> None:
+        with Database.connection() as conn:
+            conn.execute('UPDATE Jobs SET Status = ?, Result = ?, Error = ?, LeaseUntil = NULL, UpdatedAt = ? WHERE id = ?',
+                         (Status, json.dumps(Result) if Result is not None else None, Error, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), JobId))
+
+    @staticmethod
+    def requeue_job(JobId: int) -> None:
+        # Back to the queue without counting the attempt, for failures that were not the job's fault
+        with Database.connection() as conn:
+            conn.execute('''UPDATE Jobs SET Status = 'queued', Attempts = MAX(Attempts - 1, 0), Worker = NULL, LeaseUntil = NULL, UpdatedAt = ?
+                            WHERE id = ?''', (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), JobId))
+
+    @staticmethod
+    def requeue_expired_jobs(MaxAttempts: int) -> int:
+        # Jobs whose worker died (restart, crash) stop renewing their lease and are picked up again
+        with Database.connection() as conn:
+            cursor = conn.execute('''UPDATE Jobs SET Status = CASE WHEN Attempts >= ? THEN 'failed' ELSE 'queued' END,
+                                         Error = 'lease expired', Worker = NULL, LeaseUntil = NULL
+                                     WHERE Status = 'running' AND LeaseUntil < ?''', (MaxAttempts, time.time()))
+            return cursor.rowcount
+
+    @staticmethod
+    def add_upload(UploadId: str, OwnerLogin: str, Name: str, Description: str, Tags: str, Size: int) -> None:
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with Database.connection() as conn:
+            conn.execute("INSERT INTO Uploads (id, OwnerId, Name, Description, Tags, Size, Received, Status, CreatedAt, UpdatedAt) VALUES (?, ?, ?, ?, ?, ?, 0, 'open', ?, ?)",
+                         (UploadId, OwnerLogin, Name, Description, Tags, Size, now, now))
+
+    @staticmethod
+    def get_upload(UploadId: str) -> dict | None:
+        with Database.connection() as conn:
+            row = conn.execute('SELECT id, OwnerId, Name, Description, Tags, Size, Received, Status FROM Uploads WHERE id = ?', (UploadId,)).fetchone()
+            if row:
+                return {'UploadId': row[0], 'OwnerId': row[1], 'Name': row[2], 'Description': row[3], 'Tags': row[4],
+                        'Size': row[5], 'Received': row[6], 'Status': row[7]}
+            return None
+
+    @staticmethod
+    def advance_upload(UploadId: str, Offset: int, Received: int) -> bool:
+        # Only moves forward from the offset the chunk was written at, so a concurrent duplicate chunk loses
+        with Database.connection() as conn:
+            cursor = conn.execute("UPDATE Uploads SET Received = ?, UpdatedAt = ? WHERE id = ? AND Received = ? AND Status = 'open'",
+                                  (Received, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), UploadId, Offset))
+            return cursor.rowcount == 1
+
+    @staticmethod
+    def complete_upload(UploadId: str) -> bool:
+        with Database.connection() as conn:
+            cursor = conn.execute("UPDATE Uploads SET Status = 'done', UpdatedAt = ? WHERE id = ? AND Status = 'open' AND Received = Size",
+                                  (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), UploadId))
+            return cursor.rowcount == 1
+
+    @staticmethod
+    def reopen_upload(UploadId: str, Received: int) -> None:
+        # Undoes complete_upload when publishing the finished upload failed
+        with Database.connection() as conn:
+            conn.execute("UPDATE Uploads SET Status = 'open', Received = ?, UpdatedAt = ? WHERE id = ? AND Status = 'done'",
+                         (Received, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), UploadId))
+
+    @staticmethod
+    def expire_uploads(MaxAge: float) -> list[str]:
+        # Deletes open uploads without a chunk for MaxAge seconds and returns their ids, each to exactly one caller
+        cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=MaxAge)).strftime('%Y-%m-%d %H:%M:%S')
+        with Database.connection() as conn:
+            return [row[0] for row in conn.execute("DELETE FROM Uploads WHERE Status = 'open' AND UpdatedAt < ? RETURNING id", (cutoff,))]
+
+    @staticmethod
+    def share_cache(PollInterval: float = 0.25) -> None:
+        # For several server processes: invalidations go through the CacheInvalidations table
+        Database.cache.share(InvalidationLog(Database.connection, PollInterval))
+
+    @staticmethod
+    def build_fuzzy_index() -> None:
+        Database.video_names.clear()
+        Database.channel_names.clear()
+        with Database.connection() as conn:
+            for row in conn.execute('SELECT id, Name FROM Videos'):
+                Database.video_names.add(row[0], row[1])
+            for row in conn.execute('SELECT Login, Name FROM Users'):
+                Database.channel_names.add(row[0], row[1])
+
+    @staticmethod
+    def refresh_video_names(VideoIds: list[int]) -> None:
+        # Applies name changes made by other server processes to this process's fuzzy index
+        with Database.connection() as conn:
+            names = dict(conn.execute('SELECT id, Name FROM Videos WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(VideoIds),)).fetchall())
+        for VideoId in VideoIds:
+            if VideoId in names:
+                Database.video_names.add(VideoId, names[VideoId])
+            else:
+                Database.video_names.remove(VideoId)
+
+    @staticmethod
+    def refresh_channel_names(Logins: list[str]) -> None:
+        with Database.connection() as conn:
+            names = dict(conn.execute('SELECT Login, Name FROM Users WHERE Login IN (SELECT value FROM json_each(?))', (json.dumps(Logins),)).fetchall())
+        for Login in Logins:
+            if Login in names:
+                Database.channel_names.add(Login, names[Login])
+            else:
+                Database.channel_names.remove(Login)
+
+    @staticmethod
+    def set_video_metadata(VideoId: int, Metadata: dict) -> None:
+        with Database.connection() as conn:
+            conn.execute('UPDATE Videos SET Duration = ?, Width = ?, Height = ?, VideoCodec = ?, AudioCodec = ?, Bitrate = ? WHERE id = ?',
+                         (Metadata.get('Duration'), Metadata.get('Width'), Metadata.get('Height'), Metadata.get('VideoCodec'),
+                          Metadata.get('AudioCodec'), Metadata.get('Bitrate'), VideoId))
+        Database.cache.invalidate('video', int(VideoId))
+
+    @staticmethod
+    def touch_video(VideoId: int) -> None:
+        # For changes outside the database (e.g. HLS renditions appearing) that show up in the video's data
+        Database.cache.invalidate('video', int(VideoId))
+
+    @staticmethod
+    def get_cache_versions(Keys: list[tuple[str, object]]) -> tuple:
+        return Database.cache.versions(Keys)
+
+    @staticmethod
+    def get_videos_without_metadata() -> list[tuple[int, str]]:
+        with Database.connection() as conn:
+            return conn.execute('SELECT id, Path FROM Videos WHERE Duration IS NULL').fetchall()
+
+    @staticmethod
+    def reconcile_counters(batch_size: int = 10000) -> None:
+        # Recomputes the denormalized counters from VideoWatches/VideoReactions, one id range per transaction
+        for first, last in id_ranges(Database.connection, 'Videos', batch_size):
+            with Database.connection() as conn:
+                conn.execute('''UPDATE Videos SET
+                                    ViewCount = (SELECT COUNT() FROM VideoWatches WHERE VideoId = Videos.id),
+                                    Likes = (SELECT COUNT() FROM VideoReactions WHERE VideoId = Videos.id AND IsLike = 1),
+                                    Dislikes = (SELECT COUNT() FROM VideoReactions WHERE VideoId = Videos.id AND IsLike = 0)
+                                WHERE id >= ? AND id < ?''', (first, last))
+        for first, last in id_ranges(Database.connection, 'Comments', batch_size):
+            with Database.connection() as conn:
+                conn.execute('''UPDATE Comments SET
+                                    Likes = (SELECT COUNT() FROM CommentReactions WHERE CommentId = Comments.id AND IsLike = 1),
+                                    Dislikes = (SELECT COUNT() FROM CommentReactions WHERE CommentId = Comments.id AND IsLike = 0)
+                                WHERE id >= ? AND id < ?''', (first, last))
+
+    @staticmethod
+    def move_video_tags(batch_size: int = 10000) -> None:
+        # Moves the legacy TagsJSON column into Tags/VideoTags, one id range per transaction. A range is cleared
+        # from TagsJSON in the same transaction, so running this again only touches videos not moved yet.
+        for first, last in id_ranges(Database.connection, 'Videos', batch_size):
+            with Database.connection() as conn:
+                conn.execute('''DELETE FROM VideoTags WHERE VideoId IN
+                                (SELECT id FROM Videos WHERE id >= ? AND id < ? AND TagsJSON IS NOT NULL)''', (first, last))
+                conn.execute(f"""INSERT OR IGNORE INTO Tags (Name) SELECT {TAG_VALUE} FROM Videos v, {TAG_SOURCE.format(row='v')}
+                                 WHERE v.id >= ? AND v.id < ? AND {TAG_VALUE} != ''""", (first, last))
+                conn.execute(f'''INSERT OR IGNORE INTO VideoTags (TagId, VideoId, Position)
+                                 SELECT t.id, v.id, tag.key FROM Videos v, {TAG_SOURCE.format(row='v')}
+                                 JOIN Tags t ON t.Name = {TAG_VALUE} WHERE v.id >= ? AND v.id < ?''', (first, last))
+                conn.execute('UPDATE Videos SET TagsJSON = NULL WHERE id >= ? AND id < ? AND TagsJSON IS NOT NULL', (first, last))
+
+    @staticmethod
+    def rebuild_tag_affinity(batch_size: int = 1000) -> None:
+        # Recomputes affinity from watches and reactions, one range of users per transaction
+        for first, last in id_ranges(Database.connection, 'Users', batch_size, 'rowid'):
+            with Database.connection() as conn:
+                conn.execute('DELETE FROM UserTagAffinity WHERE UserId IN (SELECT Login FROM Users WHERE rowid >= ? AND rowid < ?)', (first, last))
+                conn.execute(f'''INSERT INTO UserTagAffinity (UserId, TagId, Weight)
+                                SELECT UserId, TagId, SUM(Weight) FROM (
+                                    SELECT w.WatcherId AS UserId, vt.TagId AS TagId, {WATCH_AFFINITY} AS Weight
+                                    FROM Users u JOIN VideoWatches w ON w.WatcherId = u.Login JOIN VideoTags vt ON vt.VideoId = w.VideoId
+                                    WHERE u.rowid >= ? AND u.rowid < ?
+                                    UNION ALL
+                                    SELECT r.ReactorId, vt.TagId, CASE WHEN r.IsLike = 1 THEN {LIKE_AFFINITY} ELSE {DISLIKE_AFFINITY} END
+                                    FROM Users u JOIN VideoReactions r ON r.ReactorId = u.Login JOIN VideoTags vt ON vt.VideoId = r.VideoId
+                                    WHERE u.rowid >= ? AND u.rowid < ?
+                                ) GROUP BY UserId, TagId''', (first, last, first, last))
+
+    @staticmethod
+    def rebuild_search_index(batch_size: int = 10000) -> None:
+        for first, last in id_ranges(Database.connection, 'Videos', batch_size):
+            with Database.connection() as conn:
+                conn.execute('DELETE FROM VideosSearch WHERE rowid >= ? AND rowid < ?', (first, last))
+                conn.execute(f'''INSERT INTO VideosSearch (rowid, Name, Description, Tags)
+                                 SELECT id, Name, Description, {VIDEO_TAG_NAMES.format(video='Videos.id')} FROM Videos
+                                 WHERE id >= ? AND id < ?''', (first, last))
+        for first, last in id_ranges(Database.connection, 'Users', batch_size, 'rowid'):
+            with Database.connection() as conn:
+                conn.execute('DELETE FROM UsersSearch WHERE rowid >= ? AND rowid < ?', (first, last))
+                conn.execute('''INSERT INTO UsersSearch (rowid, Login, Name, Description)
+                                SELECT rowid, Login, Name, Description FROM Users WHERE rowid >= ? AND rowid < ?''', (first, last))
+
+    @staticmethod
+    def migrate_base_schema() -> None:
+        # Schema as it stood before versioning; every statement is conditional, so databases created by
+        # any earlier start_db are brought to the same state
+        with Database.connection() as conn:
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS Users (
                     Login TEXT NOT NULL PRIMARY KEY,
@@ -394,4 +1000,379 @@ class Database:
                     FOREIGN KEY (ReactorId) REFERENCES Users (Login)
                 )
                 ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS Jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Kind TEXT NOT NULL,
+                    Payload TEXT NOT NULL,
+                    Status TEXT NOT NULL,
+                    Result TEXT,
+                    Error TEXT,
+                    Attempts INTEGER NOT NULL DEFAULT 0,
+                    Worker TEXT,
+                    LeaseUntil REAL,
+                    CreatedAt DATETIME NOT NULL,
+                    UpdatedAt DATETIME NOT NULL
+                )
+                ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS JobsStatus ON Jobs (Status, id)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS CacheInvalidations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Namespace TEXT NOT NULL,
+                    Keys TEXT NOT NULL
+                )
+                ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS Uploads (
+                    id TEXT NOT NULL PRIMARY KEY,
+                    OwnerId TEXT NOT NULL,
+                    Name TEXT NOT NULL,
+                    Description TEXT,
+                    Tags TEXT,
+                    Size INTEGER NOT NULL,
+                    Received INTEGER NOT NULL DEFAULT 0,
+                    Status TEXT NOT NULL,
+                    CreatedAt DATETIME NOT NULL,
+                    UpdatedAt DATETIME NOT NULL,
+                    FOREIGN KEY (OwnerId) REFERENCES Users (Login)
+                )
+                ''')
+            video_columns = [row[1] for row in conn.execute('PRAGMA table_info(Videos)')]
+            counters_missing = 'ViewCount' not in video_columns
+            if counters_missing:
+                conn.execute('ALTER TABLE Videos ADD COLUMN ViewCount INTEGER NOT NULL DEFAULT 0')
+                conn.execute('ALTER TABLE Videos ADD COLUMN Likes INTEGER NOT NULL DEFAULT 0')
+                conn.execute('ALTER TABLE Videos ADD COLUMN Dislikes INTEGER NOT NULL DEFAULT 0')
+            comment_columns = [row[1] for row in conn.execute('PRAGMA table_info(Comments)')]
+            if 'Likes' not in comment_columns:
+                counters_missing = True
+                conn.execute('ALTER TABLE Comments ADD COLUMN Likes INTEGER NOT NULL DEFAULT 0')
+                conn.execute('ALTER TABLE Comments ADD COLUMN Dislikes INTEGER NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS CommentsVideoDate ON Comments (VideoId, DateTime, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS CommentsVideoLikes ON Comments (VideoId, Likes, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideosOwnerDate ON Videos (OwnerId, DateTime, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS CommentReactionsCommentId ON CommentReactions (CommentId)')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS CommentReactionsCountInsert AFTER INSERT ON CommentReactions BEGIN
+                    UPDATE Comments SET Likes = Likes + (new.IsLike = 1), Dislikes = Dislikes + (new.IsLike = 0) WHERE id = new.CommentId;
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS CommentReactionsCountDelete AFTER DELETE ON CommentReactions BEGIN
+                    UPDATE Comments SET Likes = Likes - (old.IsLike = 1), Dislikes = Dislikes - (old.IsLike = 0) WHERE id = old.CommentId;
+                END
+                ''')
+            if 'Duration' not in video_columns:
+                conn.execute('ALTER TABLE Videos ADD COLUMN Duration REAL')
+                conn.execute('ALTER TABLE Videos ADD COLUMN Width INTEGER')
+                conn.execute('ALTER TABLE Videos ADD COLUMN Height INTEGER')
+                conn.execute('ALTER TABLE Videos ADD COLUMN VideoCodec TEXT')
+                conn.execute('ALTER TABLE Videos ADD COLUMN AudioCodec TEXT')
+                conn.execute('ALTER TABLE Videos ADD COLUMN Bitrate INTEGER')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS Tags (
+                    id INTEGER PRIMARY KEY,
+                    Name TEXT NOT NULL UNIQUE
+                )
+                ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS VideoTags (
+                    TagId INTEGER NOT NULL,
+                    VideoId INTEGER NOT NULL,
+                    PRIMARY KEY (TagId, VideoId),
+                    FOREIGN KEY (TagId) REFERENCES Tags (id),
+                    FOREIGN KEY (VideoId) REFERENCES Videos (id)
+                ) WITHOUT ROWID
+                ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS UserTagAffinity (
+                    UserId TEXT NOT NULL,
+                    TagId INTEGER NOT NULL,
+                    Weight REAL NOT NULL,
+                    PRIMARY KEY (UserId, TagId),
+                    FOREIGN KEY (UserId) REFERENCES Users (Login),
+                    FOREIGN KEY (TagId) REFERENCES Tags (id)
+                ) WITHOUT ROWID
+                ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideoTagsVideoId ON VideoTags (VideoId, TagId)')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideoWatchesWatcherId ON VideoWatches (WatcherId, VideoId)')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideosViewCount ON Videos (ViewCount)')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS VideoTagsInsert AFTER INSERT ON Videos BEGIN
+                    INSERT OR IGNORE INTO Tags (Name) SELECT {TAG_VALUE} FROM {TAG_SOURCE.format(row='new')} WHERE {TAG_VALUE} != '';
+                    INSERT OR IGNORE INTO VideoTags (TagId, VideoId) SELECT t.id, new.id FROM {TAG_SOURCE.format(row='new')} JOIN Tags t ON t.Name = {TAG_VALUE};
+                END
+                ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS VideoTagsUpdate AFTER UPDATE OF TagsJSON ON Videos BEGIN
+                    DELETE FROM VideoTags WHERE VideoId = old.id;
+                    INSERT OR IGNORE INTO Tags (Name) SELECT {TAG_VALUE} FROM {TAG_SOURCE.format(row='new')} WHERE {TAG_VALUE} != '';
+                    INSERT OR IGNORE INTO VideoTags (TagId, VideoId) SELECT t.id, new.id FROM {TAG_SOURCE.format(row='new')} JOIN Tags t ON t.Name = {TAG_VALUE};
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideoTagsDelete AFTER DELETE ON Videos BEGIN
+                    DELETE FROM VideoTags WHERE VideoId = old.id;
+                END
+                ''')
+            # Affinity moves with every watch and reaction, so recommendations never have to scan a user's history
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS UserTagAffinityWatch AFTER INSERT ON VideoWatches WHEN new.WatcherId IS NOT NULL BEGIN
+                    INSERT INTO UserTagAffinity (UserId, TagId, Weight) SELECT new.WatcherId, TagId, {WATCH_AFFINITY} FROM VideoTags WHERE VideoId = new.VideoId
+                    ON CONFLICT (UserId, TagId) DO UPDATE SET Weight = Weight + excluded.Weight;
+                END
+                ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS UserTagAffinityReact AFTER INSERT ON VideoReactions BEGIN
+                    INSERT INTO UserTagAffinity (UserId, TagId, Weight)
+                    SELECT new.ReactorId, TagId, CASE WHEN new.IsLike = 1 THEN {LIKE_AFFINITY} ELSE {DISLIKE_AFFINITY} END FROM VideoTags WHERE VideoId = new.VideoId
+                    ON CONFLICT (UserId, TagId) DO UPDATE SET Weight = Weight + excluded.Weight;
+                END
+                ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS UserTagAffinityUnreact AFTER DELETE ON VideoReactions BEGIN
+                    UPDATE UserTagAffinity SET Weight = Weight - CASE WHEN old.IsLike = 1 THEN {LIKE_AFFINITY} ELSE {DISLIKE_AFFINITY} END
+                    WHERE UserId = old.ReactorId AND TagId IN (SELECT TagId FROM VideoTags WHERE VideoId = old.VideoId);
+                END
+                ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideoWatchesVideoId ON VideoWatches (VideoId)')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideoReactionsVideoId ON VideoReactions (VideoId)')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideoWatchesCountInsert AFTER INSERT ON VideoWatches BEGIN
+                    UPDATE Videos SET ViewCount = ViewCount + 1 WHERE id = new.VideoId;
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideoWatchesCountDelete AFTER DELETE ON VideoWatches BEGIN
+                    UPDATE Videos SET ViewCount = ViewCount - 1 WHERE id = old.VideoId;
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideoReactionsCountInsert AFTER INSERT ON VideoReactions BEGIN
+                    UPDATE Videos SET Likes = Likes + (new.IsLike = 1), Dislikes = Dislikes + (new.IsLike = 0) WHERE id = new.VideoId;
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideoReactionsCountDelete AFTER DELETE ON VideoReactions BEGIN
+                    UPDATE Videos SET Likes = Likes - (old.IsLike = 1), Dislikes = Dislikes - (old.IsLike = 0) WHERE id = old.VideoId;
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideoReactionsCountUpdate AFTER UPDATE OF VideoId, IsLike ON VideoReactions BEGIN
+                    UPDATE Videos SET Likes = Likes - (old.IsLike = 1), Dislikes = Dislikes - (old.IsLike = 0) WHERE id = old.VideoId;
+                    UPDATE Videos SET Likes = Likes + (new.IsLike = 1), Dislikes = Dislikes + (new.IsLike = 0) WHERE id = new.VideoId;
+                END
+                ''')
+        if counters_missing:
+            Database.reconcile_counters()
+
+    @staticmethod
+    def migrate_reaction_constraints() -> None:
+        # One reaction per user per video/comment. The newest duplicate is kept; the delete triggers
+        # take the others out of the counters and the tag affinity.
+        with Database.connection() as conn:
+            conn.execute('DELETE FROM VideoReactions WHERE id NOT IN (SELECT MAX(id) FROM VideoReactions GROUP BY VideoId, ReactorId)')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS VideoReactionsUnique ON VideoReactions (VideoId, ReactorId)')
+            conn.execute('DROP INDEX IF EXISTS VideoReactionsVideoId')
+            conn.execute('DELETE FROM CommentReactions WHERE id NOT IN (SELECT MAX(id) FROM CommentReactions GROUP BY CommentId, ReactorId)')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS CommentReactionsUnique ON CommentReactions (CommentId, ReactorId)')
+            conn.execute('DROP INDEX IF EXISTS CommentReactionsCommentId')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideoReactionsReactorId ON VideoReactions (ReactorId, VideoId)')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideosPath ON Videos (Path)')
+            # A changed reaction is now an UPDATE of IsLike rather than a second row
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS CommentReactionsCountUpdate AFTER UPDATE OF IsLike ON CommentReactions BEGIN
+                    UPDATE Comments SET Likes = Likes - (old.IsLike = 1) + (new.IsLike = 1), Dislikes = Dislikes - (old.IsLike = 0) + (new.IsLike = 0)
+                    WHERE id = new.CommentId;
+                END
+                ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS UserTagAffinityReactUpdate AFTER UPDATE OF IsLike ON VideoReactions BEGIN
+                    UPDATE UserTagAffinity SET Weight = Weight
+                        - CASE WHEN old.IsLike = 1 THEN {LIKE_AFFINITY} ELSE {DISLIKE_AFFINITY} END
+                        + CASE WHEN new.IsLike = 1 THEN {LIKE_AFFINITY} ELSE {DISLIKE_AFFINITY} END
+                    WHERE UserId = new.ReactorId AND TagId IN (SELECT TagId FROM VideoTags WHERE VideoId = new.VideoId);
+                END
+                ''')
+
+    @staticmethod
+    def migrate_video_tags() -> None:
+        # VideoTags becomes the only copy of a video's tags, and the search index is created over them: VideosSearch
+        # is a regular FTS table the triggers keep in sync. Databases from before versioning still have the
+        # external-content VideosSearch over TagsJSON, which is dropped first.
+        with Database.connection() as conn:
+            if 'Position' not in [row[1] for row in conn.execute('PRAGMA table_info(VideoTags)')]:
+                conn.execute('ALTER TABLE VideoTags ADD COLUMN Position INTEGER NOT NULL DEFAULT 0')
+            conn.execute('DROP TRIGGER IF EXISTS VideoTagsInsert')
+            conn.execute('DROP TRIGGER IF EXISTS VideoTagsUpdate')
+            conn.execute('DROP INDEX IF EXISTS VideoTagsVideoId')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideoTagsVideoPosition ON VideoTags (VideoId, Position, TagId)')
+            for trigger in ('VideosSearchInsert', 'VideosSearchUpdate', 'VideosSearchDelete'):
+                conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            conn.execute('DROP TABLE IF EXISTS VideosSearch')
+            conn.execute('''
+                CREATE VIRTUAL TABLE VideosSearch USING fts5(
+                    Name, Description, Tags,
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )
+                ''')
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS UsersSearch USING fts5(
+                    Login UNINDEXED, Name, Description,
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideosSearchInsert AFTER INSERT ON Videos BEGIN
+                    INSERT INTO VideosSearch (rowid, Name, Description, Tags) VALUES (new.id, new.Name, new.Description, '');
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideosSearchUpdate AFTER UPDATE OF Name, Description ON Videos BEGIN
+                    UPDATE VideosSearch SET Name = new.Name, Description = new.Description WHERE rowid = new.id;
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideosSearchDelete AFTER DELETE ON Videos BEGIN
+                    DELETE FROM VideosSearch WHERE rowid = old.id;
+                END
+                ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS VideoTagsSearchInsert AFTER INSERT ON VideoTags BEGIN
+                    UPDATE VideosSearch SET Tags = {VIDEO_TAG_NAMES.format(video='new.VideoId')} WHERE rowid = new.VideoId;
+                END
+                ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS VideoTagsSearchDelete AFTER DELETE ON VideoTags BEGIN
+                    UPDATE VideosSearch SET Tags = {VIDEO_TAG_NAMES.format(video='old.VideoId')} WHERE rowid = old.VideoId;
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS UsersSearchInsert AFTER INSERT ON Users BEGIN
+                    INSERT INTO UsersSearch (rowid, Login, Name, Description) VALUES (new.rowid, new.Login, new.Name, new.Description);
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS UsersSearchDelete AFTER DELETE ON Users BEGIN
+                    DELETE FROM UsersSearch WHERE rowid = old.rowid;
+                END
+                ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS UsersSearchUpdate AFTER UPDATE OF Name, Description ON Users BEGIN
+                    UPDATE UsersSearch SET Name = new.Name, Description = new.Description WHERE rowid = old.rowid;
+                END
+                ''')
+        Database.move_video_tags()
+        Database.rebuild_search_index()
+        Database.rebuild_tag_affinity()
+
+    @staticmethod
+    def migrate_sessions() -> None:
+        with Database.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS Sessions (
+                    Id TEXT PRIMARY KEY,
+                    Data TEXT NOT NULL,
+                    Expires REAL NOT NULL
+                ) WITHOUT ROWID
+                ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS SessionsExpires ON Sessions (Expires)')
+
+    @staticmethod
+    def migrate_watch_rollups() -> None:
+        # Watches get a timestamp (rows from before this have none and stay out of the rollups) and are folded
+        # into per-video and per-channel hourly/daily view counts; RollupState holds the last folded watch id
+        # and the time of the last trending refresh
+        with Database.connection() as conn:
+            if 'WatchedAt' not in [row[1] for row in conn.execute('PRAGMA table_info(VideoWatches)')]:
+                conn.execute('ALTER TABLE VideoWatches ADD COLUMN WatchedAt REAL')
+            for hourly, daily, column in VIEW_ROLLUPS.values():
+                kind = 'INTEGER' if column == 'VideoId' else 'TEXT'
+                conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {hourly} (
+                        {column} {kind} NOT NULL,
+                        Hour INTEGER NOT NULL,
+                        Views INTEGER NOT NULL,
+                        PRIMARY KEY ({column}, Hour)
+                    ) WITHOUT ROWID
+                    ''')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS {hourly}Hour ON {hourly} (Hour)')
+                conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {daily} (
+                        {column} {kind} NOT NULL,
+                        Day INTEGER NOT NULL,
+                        Views INTEGER NOT NULL,
+                        PRIMARY KEY ({column}, Day)
+                    ) WITHOUT ROWID
+                    ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS VideoTrending (
+                    VideoId INTEGER PRIMARY KEY,
+                    Score REAL NOT NULL
+                )
+                ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS VideoTrendingScore ON VideoTrending (Score, VideoId)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS RollupState (
+                    Name TEXT PRIMARY KEY,
+                    Position REAL NOT NULL,
+                    Previous REAL NOT NULL DEFAULT 0
+                )
+                ''')
+            conn.execute("INSERT OR IGNORE INTO RollupState (Name, Position) VALUES ('watches', (SELECT COALESCE(MAX(id), 0) FROM VideoWatches)), ('trending', 0)")
+            # A deleted video leaves trending and its own rollups; the channel keeps the views it had
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS VideoRollupsDelete AFTER DELETE ON Videos BEGIN
+                    DELETE FROM VideoViewsHourly WHERE VideoId = old.id;
+                    DELETE FROM VideoViewsDaily WHERE VideoId = old.id;
+                    DELETE FROM VideoTrending WHERE VideoId = old.id;
+                END
+                ''')
+
+    @staticmethod
+    def start_db() -> None:
+        run_migrations(Database.connection, MIGRATIONS)
+
+# Append only: a released migration is never edited, schema changes go into a new version
+MIGRATIONS = [
+    (1, 'base schema', Database.migrate_base_schema),
+    (2, 'reaction constraints and lookup indexes', Database.migrate_reaction_constraints),
+    (3, 'relational video tags and search index', Database.migrate_video_tags),
+    (4, 'sessions', Database.migrate_sessions),
+    (5, 'watch rollups', Database.migrate_watch_rollups),
+]
 Database.start_db()
+Database.cache.listen('video-names', Database.refresh_video_names)
+Database.cache.listen('channel-names', Database.refresh_channel_names)
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['reconcile-counters']:
+        Database.reconcile_counters()
+    elif sys.argv[1:] == ['rebuild-recommendations']:
+        Database.rebuild_tag_affinity()
+    elif sys.argv[1:] == ['rebuild-search']:
+        Database.rebuild_search_index()
+    elif sys.argv[1:] == ['compact-sessions']:
+        print(Database.compact_sessions(), 'expired sessions removed')
+    elif sys.argv[1:] == ['rollup-watches']:
+        # Folds every pending watch into the rollups and recomputes trending, e.g. after a bulk import
+        while Database.rollup_watches() == ROLLUP_BATCH:
+            pass
+        Database.refresh_trending()
+    elif sys.argv[1:2] == ['expire-uploads']:
+        # python database.py expire-uploads [max age in hours, default 24]
+        from uploads import upload_part_path, remove_files
+        expired = Database.expire_uploads(float(sys.argv[2] if len(sys.argv) > 2 else 24) * 3600)
+        remove_files(*map(upload_part_path, expired))
+        print(len(expired), 'abandoned uploads removed')
+    elif sys.argv[1:] == ['hash-passwords']:
+        from passwords import PasswordHasher
+        print(Database.hash_plain_passwords(PasswordHasher()), 'passwords hashed')
+    elif sys.argv[1:] == ['probe-videos']:
+        # Queues faststart + metadata probing for videos uploaded before it ran on ingest
+        for VideoId, Path in Database.get_videos_without_metadata():
+            Database.add_job('probe_mp4', {'video_id': VideoId, 'video': Path})
+    else:
+        print('usage: python database.py reconcile-counters | rebuild-recommendations | rebuild-search | compact-sessions | rollup-watches | expire-uploads [hours] | hash-passwords | probe-videos')
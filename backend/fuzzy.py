@@ -0,0 +1,121 @@
+import threading
+from array import array
+import numpy as np
+import Levenshtein
+
+
+def normalize(text: str) -> str:
+    return ' '.join((text or '').lower().split())
+
+
+def trigrams(text: str) -> set[str]:
+    # Words are padded separately, so the trigrams of any single word are a subset of the name's trigrams
+    grams = set()
+    for word in text.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class FuzzyIndex:
+    # Trigram inverted index over short names (video titles, channel names).
+    # A string within edit distance d of the query keeps all but at most 3*d of the query's trigrams,
+    # so candidates only need to be collected from the 3*d+1 rarest query trigrams and then verified
+    # with Levenshtein on that small set instead of on every name.
+    def __init__(self, max_candidates: int = 128, max_postings_scanned: int = 20000):
+        self.max_candidates = max_candidates
+        self.max_postings_scanned = max_postings_scanned
+        self._keys = []
+        self._names = []
+        self._slots = {}
+        self._postings = {}
+        self._removed = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, key) -> bool:
+        return key in self._slots
+
+    def add(self, key, name: str) -> None:
+        name = normalize(name)
+        with self._lock:
+            if key in self._slots:
+                self._remove(key)
+            slot = len(self._keys)
+            self._keys.append(key)
+            self._names.append(name)
+            self._slots[key] = slot
+            for gram in trigrams(name):
+                posting = self._postings.get(gram)
+                if posting is None:
+                    posting = self._postings[gram] = array('I')
+                posting.append(slot)
+
+    def remove(self, key) -> None:
+        with self._lock:
+            if key in self._slots:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys, self._names, self._slots, self._postings, self._removed = [], [], {}, {}, 0
+
+    def _remove(self, key) -> None:
+        # Slots are only tombstoned here; their postings are dropped by _compact once most slots are dead,
+        # which renames through add() reach as well as removals
+        slot = self._slots.pop(key)
+        self._keys[slot] = None
+        self._names[slot] = None
+        self._removed += 1
+        if self._removed > 1024 and self._removed * 2 > len(self._keys):
+            self._compact()
+
+    def _compact(self) -> None:
+        items = [(key, name) for key, name in zip(self._keys, self._names) if key is not None]
+        self._keys, self._names, self._slots, self._postings, self._removed = [], [], {}, {}, 0
+        for slot, (key, name) in enumerate(items):
+            self._keys.append(key)
+            self._names.append(name)
+            self._slots[key] = slot
+            for gram in trigrams(name):
+                self._postings.setdefault(gram, array('I')).append(slot)
+
+    def _candidates(self, query: str, max_distance: int) -> list[int]:
+        postings = sorted((self._postings[gram] for gram in trigrams(query) if gram in self._postings), key=len)
+        selected = []
+        scanned = 0
+        for posting in postings[:3 * max_distance + 1]:
+            if selected and scanned + len(posting) > self.max_postings_scanned:
+                break
+            selected.append(np.frombuffer(posting, dtype=np.uint32))
+            scanned += len(posting)
+        if not selected:
+            return []
+        slots, hits = np.unique(np.concatenate(selected), return_counts=True)
+        del selected
+        if len(slots) > self.max_candidates:
+            best = np.argpartition(-hits, self.max_candidates)[:self.max_candidates]
+            slots = slots[best[np.argsort(-hits[best], kind='stable')]]
+        return slots.tolist()
+
+    def search(self, text: str, limit: int = 10, max_distance: int = 2) -> list[tuple[object, int]]:
+        query = normalize(text)
+        if not query:
+            return []
+        single_word = ' ' not in query
+        results = []
+        with self._lock:
+            for slot in self._candidates(query, max_distance):
+                name = self._names[slot]
+                if name is None:
+                    continue
+                distance = Levenshtein.distance(query, name, score_cutoff=max_distance)
+                if single_word and distance > 0:
+                    for word in name.split():
+                        distance = min(distance, Levenshtein.distance(query, word, score_cutoff=max_distance))
+                if distance <= max_distance:
+                    results.append((distance, len(name), slot))
+            results.sort()
+            return [(self._keys[slot], distance) for distance, _, slot in results[:limit]]
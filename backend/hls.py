@@ -0,0 +1,162 @@
+import os
+import re
+import time
+import shutil
+import subprocess
+
+HLS_DIR = 'hls'
+SEGMENT_SECONDS = 4
+# (short side, video bitrate, audio bitrate), largest first
+RENDITIONS = [
+    (1080, 5000, 128),
+    (720, 2800, 128),
+    (480, 1400, 96),
+    (360, 800, 96),
+    (240, 400, 64),
+]
+# Link speed the reported startup time is estimated for: master + media playlist + first segment
+STARTUP_LINK_BPS = 3_000_000
+
+PLAYLIST_CACHE = 'public, max-age=60'
+SEGMENT_CACHE = 'public, max-age=31536000, immutable'
+MEDIA_TYPES = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+
+_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+_FILE = re.compile(r'^(?:index\.m3u8|seg_\d{5}\.ts)$')
+_RENDITION = re.compile(r'^\d+p$')
+
+
+def ffmpeg_binary() -> str:
+    binary = os.environ.get('FFMPEG') or shutil.which('ffmpeg')
+    if not binary:
+        raise ValueError('ffmpeg not found, set FFMPEG or install it')
+    return binary
+
+
+def ffmpeg_available() -> bool:
+    binary = os.environ.get('FFMPEG') or shutil.which('ffmpeg')
+    return bool(binary) and os.access(binary, os.X_OK)
+
+
+def hls_dir(video_path: str) -> str:
+    return os.path.join(HLS_DIR, os.path.splitext(os.path.basename(video_path))[0])
+
+
+def hls_file(name: str, rendition: str | None = None, filename: str = 'master.m3u8') -> str | None:
+    # Maps URL parts to a file below HLS_DIR, rejecting anything that is not a name the packager writes
+    if not _NAME.match(name):
+        return None
+    if rendition is None:
+        return os.path.join(HLS_DIR, name, 'master.m3u8') if filename == 'master.m3u8' else None
+    if not _RENDITION.match(rendition) or not _FILE.match(filename):
+        return None
+    return os.path.join(HLS_DIR, name, rendition, filename)
+
+
+def master_url(video_path: str) -> str | None:
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    if os.path.exists(os.path.join(HLS_DIR, name, 'master.m3u8')):
+        return f'/hls/{name}/master.m3u8'
+    return None
+
+
+def ladder(width: int, height: int) -> list[tuple]:
+    # Never upscale: keep the renditions that fit the source, or the smallest one for tiny sources
+    short = min(width, height)
+    renditions = [rendition for rendition in RENDITIONS if rendition[0] <= short]
+    return renditions or RENDITIONS[-1:]
+
+
+def scaled_size(width: int, height: int, short: int) -> tuple[int, int]:
+    # Same rounding as ffmpeg's scale filter with -2 (nearest even number)
+    if width >= height:
+        return round(short * width / height / 2) * 2, short
+    return short, round(short * height / width / 2) * 2
+
+
+def read_playlist(path: str) -> list[tuple[str, float]]:
+    segments, duration = [], None
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration = float(line[8:].split(',')[0])
+            elif line and not line.startswith('#') and duration is not None:
+                segments.append((line, duration))
+                duration = None
+    return segments
+
+
+def encode_rendition(source: str, target: str, width: int, height: int, rendition: tuple) -> dict:
+    short, video_kbps, audio_kbps = rendition
+    os.makedirs(target)
+    scale = f'scale=-2:{short}' if width >= height else f'scale={short}:-2'
+    started = time.perf_counter()
+    try:
+        subprocess.run([
+            ffmpeg_binary(), '-nostdin', '-y', '-v', 'error', '-i', source,
+            '-map', '0:v:0', '-map', '0:a:0?', '-vf', scale,
+            '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main', '-pix_fmt', 'yuv420p',
+            '-b:v', f'{video_kbps}k', '-maxrate', f'{video_kbps * 3 // 2}k', '-bufsize', f'{video_kbps * 2}k',
+            # Keyframes on segment boundaries so every rendition switches at the same points
+            '-force_key_frames', f'expr:gte(t,n_forced*{SEGMENT_SECONDS})', '-sc_threshold', '0',
+            '-c:a', 'aac', '-b:a', f'{audio_kbps}k', '-ac', '2',
+            '-f', 'hls', '-hls_time', str(SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(target, 'seg_%05d.ts'), os.path.join(target, 'index.m3u8'),
+        ], check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        # Re-running ffmpeg on the same input fails the same way, so this is not worth retrying
+        raise ValueError(e.stderr.decode('utf-8', 'replace').strip()[-500:]) from None
+    encoded = time.perf_counter() - started
+
+    playlist = os.path.join(target, 'index.m3u8')
+    segments = [(os.path.getsize(os.path.join(target, name)), duration) for name, duration in read_playlist(playlist)]
+    size = sum(segment_size for segment_size, _ in segments)
+    duration = sum(segment_duration for _, segment_duration in segments) or 1
+    out_width, out_height = scaled_size(width, height, short)
+    startup_bytes = os.path.getsize(playlist) + (segments[0][0] if segments else 0)
+    return {
+        'Name': f'{short}p',
+        'Width': out_width,
+        'Height': out_height,
+        'Bandwidth': int(max((segment_size * 8 / max(segment_duration, 0.001) for segment_size, segment_duration in segments), default=0)),
+        'AverageBandwidth': int(size * 8 / duration),
+        'Size': size,
+        'Segments': len(segments),
+        'EncodeSeconds': round(encoded, 3),
+        'StartupBytes': startup_bytes,
+    }
+
+
+def write_master(path: str, renditions: list[dict]) -> None:
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for rendition in renditions:
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={rendition['Bandwidth']},"
+                     f"AVERAGE-BANDWIDTH={rendition['AverageBandwidth']},"
+                     f"RESOLUTION={rendition['Width']}x{rendition['Height']}")
+        lines.append(f"{rendition['Name']}/index.m3u8")
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def package_hls(video_path: str, width: int, height: int) -> dict:
+    # Everything is written to a temporary directory that replaces the published one in a single rename,
+    # so players never see a master playlist pointing at renditions that are still being encoded
+    target = hls_dir(video_path)
+    building = target + '.building'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    try:
+        renditions = [encode_rendition(video_path, os.path.join(building, f'{rendition[0]}p'), width, height, rendition)
+                      for rendition in ladder(width, height)]
+        write_master(os.path.join(building, 'master.m3u8'), renditions)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(building, target)
+    except Exception:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    master_size = os.path.getsize(os.path.join(target, 'master.m3u8'))
+    for rendition in renditions:
+        rendition['StartupBytes'] += master_size
+        rendition['StartupSeconds'] = round(rendition['StartupBytes'] * 8 / STARTUP_LINK_BPS, 3)
+    return {'Source': os.path.getsize(video_path), 'Renditions': renditions}
@@ -0,0 +1,169 @@
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+from streaming import file_validators
+
+# Image blobs (thumbnails, avatars) are small and requested on every listing, so the hot ones are kept
+# in memory together with their validators. A blob is re-checked with stat() at most every `revalidate`
+# seconds, which picks up changes made by other workers; overwrites in this process call invalidate().
+# Every image also gets a content digest: /image/<name>?v=<digest> never changes, so it can be cached forever.
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, no-cache'
+# File name fields of API data and the URL field added next to each
+URL_FIELDS = {'ImagePath': 'ImageUrl', 'PfpPath': 'PfpUrl'}
+HASH_CHUNK = 1024 * 1024
+
+
+class ImageEntry:
+    __slots__ = ('name', 'body', 'stat', 'size', 'mtime_ns', 'mtime', 'digest', 'etag', 'last_modified', 'checked')
+
+    def __init__(self, name: str, stat, digest: str, body: bytes | None):
+        self.name = name
+        self.stat = stat
+        self.body = body
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.mtime = stat.st_mtime
+        self.digest = digest
+        self.etag = f'"{digest}"'
+        self.last_modified = file_validators(stat)[1]
+        self.checked = time.monotonic()
+
+
+class ImageCache:
+    # LRU over the blobs of one storage bucket, bounded by the total size of the bodies it holds;
+    # blobs above max_file_bytes keep only their validators and are streamed from the store
+    def __init__(self, store, bucket: str, max_bytes: int = 64 * 1024 * 1024, max_file_bytes: int = 1024 * 1024, revalidate: float = 2.0):
+        self.store = store
+        self.bucket = bucket
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.revalidate = revalidate
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, name: str) -> ImageEntry | None:
+        # Only entries checked within the revalidate interval; older ones go through load()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or time.monotonic() - entry.checked > self.revalidate:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(name)
+            self.stats['hits'] += 1
+            return entry
+
+    def _store(self, entry: ImageEntry) -> None:
+        with self._lock:
+            old = self._entries.pop(entry.name, None)
+            if old is not None and old.body is not None:
+                self.bytes -= len(old.body)
+            self._entries[entry.name] = entry
+            if entry.body is not None:
+                self.bytes += len(entry.body)
+            while self.bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                if evicted.body is not None:
+                    self.bytes -= len(evicted.body)
+                self.stats['evictions'] += 1
+
+    def load(self, name: str) -> ImageEntry | None:
+        # Blocking: stat, and read and hash the blob when it is new or has changed
+        try:
+            stat = self.store.stat(self.bucket, name)
+        except OSError:
+            self.invalidate(name)
+            return None
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is not None and (entry.mtime_ns, entry.size) == (stat.st_mtime_ns, stat.st_size):
+            entry.checked = time.monotonic()
+            return entry
+        try:
+            with self.store.open_range(self.bucket, name) as file:
+                if stat.st_size <= self.max_file_bytes:
+                    body = file.read()
+                    digest = hashlib.blake2b(body, digest_size=8).hexdigest()
+                else:
+                    body = None
+                    hasher = hashlib.blake2b(digest_size=8)
+                    while chunk := file.read(HASH_CHUNK):
+                        hasher.update(chunk)
+                    digest = hasher.hexdigest()
+        except OSError:
+            return None
+        entry = ImageEntry(name, stat, digest, body)
+        self._store(entry)
+        return entry
+
+    async def get(self, name: str) -> ImageEntry | None:
+        entry = self._lookup(name)
+        if entry is None:
+            entry = await asyncio.get_running_loop().run_in_executor(None, self.load, name)
+        return entry
+
+    async def get_many(self, names: list[str]) -> dict[str, ImageEntry]:
+        found, missing = {}, []
+        for name in dict.fromkeys(names):
+            entry = self._lookup(name)
+            if entry is None:
+                missing.append(name)
+            else:
+                found[name] = entry
+        if missing:
+            loaded = await asyncio.get_running_loop().run_in_executor(None, lambda: [self.load(name) for name in missing])
+            found.update((name, entry) for name, entry in zip(missing, loaded) if entry is not None)
+        return found
+
+    def invalidate(self, *names: str) -> None:
+        with self._lock:
+            for name in names:
+                entry = self._entries.pop(name, None)
+                if entry is not None:
+                    self.stats['invalidations'] += 1
+                    if entry.body is not None:
+                        self.bytes -= len(entry.body)
+
+    async def with_urls(self, value):
+        # Copy of API data with a content-hashed URL next to every image file name (cached data is never modified)
+        return _add_urls(value, await self.get_many(_image_names(value, [])))
+
+    def snapshot(self) -> dict:
+        return {**self.stats, 'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+
+def image_url(filename: str, entry: ImageEntry | None) -> str:
+    url = '/image/' + quote(filename)
+    return f'{url}?v={entry.digest}' if entry is not None else url
+
+
+def _image_names(value, names: list) -> list:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in URL_FIELDS and isinstance(item, str):
+                names.append(item)
+            else:
+                _image_names(item, names)
+    elif isinstance(value, list):
+        for item in value:
+            _image_names(item, names)
+    return names
+
+
+def _add_urls(value, entries: dict[str, ImageEntry]):
+    # entries by file name
+    if isinstance(value, dict):
+        result = {key: _add_urls(item, entries) for key, item in value.items()}
+        for key, field in URL_FIELDS.items():
+            if isinstance(value.get(key), str):
+                result[field] = image_url(value[key], entries.get(value[key]))
+        return result
+    if isinstance(value, list):
+        return [_add_urls(item, entries) for item in value]
+    return value
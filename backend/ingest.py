@@ -0,0 +1,108 @@
+import time
+import asyncio
+import sqlite3
+from collections import OrderedDict
+from database import Database
+
+
+class ViewIngestor:
+    # Buffers view events in memory and writes them with one executemany per batch.
+    # record() never blocks a handler: when the queue is full the event is dropped and counted,
+    # which is the backpressure signal exposed in stats.
+    def __init__(self, max_queue: int = 10000, batch_size: int = 500, flush_interval: float = 1.0,
+                 dedup_window: float = 30 * 60, max_sessions: int = 100000):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dedup_window = dedup_window
+        self.max_sessions = max_sessions
+        self.stats = {'accepted': 0, 'deduplicated': 0, 'dropped': 0, 'flushed': 0, 'failed': 0, 'batches': 0}
+        self._queue = None
+        self._task = None
+        # (session, video) -> last time seen, least recently seen first
+        self._recent = OrderedDict()
+
+    def record(self, session_key, UserId: str | None, VideoId: int) -> bool:
+        if self._queue is None:
+            Database.add_video_watch(UserId, VideoId)
+            return True
+        now = time.monotonic()
+        watched_at = time.time()
+        key = (session_key, VideoId)
+        if session_key is not None:
+            seen = self._recent.get(key)
+            if seen is not None and now - seen < self.dedup_window:
+                self.stats['deduplicated'] += 1
+                return False
+        try:
+            # Stamped here: a batch may be written up to flush_interval later
+            self._queue.put_nowait((UserId, VideoId, watched_at))
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+            return False
+        self.stats['accepted'] += 1
+        if session_key is not None:
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            self._forget_before(now - self.dedup_window)
+        return True
+
+    def _forget_before(self, moment: float) -> None:
+        # Expired entries are at the front; past max_sessions the least recently seen go first
+        while self._recent and (len(self._recent) > self.max_sessions or next(iter(self._recent.values())) < moment):
+            self._recent.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, 'queued': self._queue.qsize() if self._queue else 0}
+
+    async def _flush(self, batch: list[tuple]) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, Database.add_video_watches, batch)
+        except sqlite3.Error:
+            self.stats['failed'] += len(batch)
+            return
+        self.stats['flushed'] += len(batch)
+        self.stats['batches'] += 1
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        running = True
+        while running:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # The None sentinel lets the writer finish its current batch; anything queued behind it is flushed here
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        batch = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                batch.append(item)
+        for first in range(0, len(batch), self.batch_size):
+            await self._flush(batch[first:first + self.batch_size])
+        self._task = None
+        self._queue = None
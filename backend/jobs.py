@@ -0,0 +1,252 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+import tempfile
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import cv2
+from mp4 import MP4Error, faststart, probe_mp4
+from hls import package_hls
+from storage import IMAGES, VIDEOS, LocalStorage, create_storage
+from thumbnails import pick_frame, save_frame, make_thumbnails, variant_paths
+
+# Job handlers run in worker processes: they only touch blobs and files and return a JSON-serializable result,
+# all bookkeeping in SQLite is done by JobQueue in the server process. Payloads name blobs; a handler works
+# on local copies from storage.fetch_to_local() and puts what it produced back into the store.
+
+logger = logging.getLogger(__name__)
+# Replaced in every worker process by use_storage(), the pool's initializer
+storage = LocalStorage()
+
+
+def use_storage(backend: str, options: dict) -> None:
+    global storage
+    storage = create_storage(backend, **options)
+
+
+def probe_video(video_path: str) -> dict:
+    vidcap = cv2.VideoCapture(video_path)
+    try:
+        if not vidcap.isOpened():
+            raise ValueError(f'cannot open {video_path}')
+        frames = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = vidcap.get(cv2.CAP_PROP_FPS)
+        return {
+            'Frames': frames,
+            'Fps': round(fps, 3),
+            'Width': int(vidcap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'Height': int(vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'Duration': round(frames / fps, 3) if fps else None,
+        }
+    finally:
+        vidcap.release()
+
+
+def extract_thumbnail(video_path: str, image_path: str) -> bool:
+    frame = pick_frame(video_path)
+    if frame is None:
+        return False
+    save_frame(frame, image_path)
+    return True
+
+
+def prepare_mp4(video_path: str) -> dict | None:
+    # Files that are not MP4 (or are damaged) are still served as uploaded, just without metadata
+    try:
+        moved = faststart(video_path)
+        metadata = probe_mp4(video_path)
+    except MP4Error:
+        return None
+    metadata['MovedMoov'] = moved
+    return metadata
+
+
+def publish_thumbnails(image: str) -> dict:
+    with storage.fetch_to_local(IMAGES, image) as image_path, tempfile.TemporaryDirectory() as scratch:
+        sizes = make_thumbnails(image_path, scratch)
+        for name in variant_paths(image):
+            storage.put_file(IMAGES, name, os.path.join(scratch, name))
+    return sizes
+
+
+def process_upload(payload: dict) -> dict:
+    # faststart runs first so the thumbnail and HLS steps read the final file
+    with storage.fetch_to_local(VIDEOS, payload['video']) as video_path, tempfile.TemporaryDirectory() as scratch:
+        metadata = prepare_mp4(video_path)
+        result = probe_video(video_path)
+        result['Metadata'] = metadata
+        if payload.get('make_thumbnail'):
+            image_path = os.path.join(scratch, payload['image'])
+            result['Thumbnail'] = extract_thumbnail(video_path, image_path)
+            if result['Thumbnail']:
+                storage.put_file(IMAGES, payload['image'], image_path)
+        if metadata and metadata['MovedMoov']:
+            storage.put_file(VIDEOS, payload['video'], video_path)
+    if storage.exists(IMAGES, payload['image']):
+        result['Thumbnails'] = publish_thumbnails(payload['image'])
+    return result
+
+
+def package_video(payload: dict) -> dict:
+    # The renditions are written below HLS_DIR on this host, not into the store
+    with storage.fetch_to_local(VIDEOS, payload['video']) as video_path:
+        probe = probe_video(video_path)
+        return package_hls(video_path, probe['Width'], probe['Height'])
+
+
+def probe_upload(payload: dict) -> dict:
+    with storage.fetch_to_local(VIDEOS, payload['video']) as video_path:
+        metadata = prepare_mp4(video_path)
+        if metadata and metadata['MovedMoov']:
+            storage.put_file(VIDEOS, payload['video'], video_path)
+    return {'Metadata': metadata}
+
+
+def regenerate_thumbnails(payload: dict) -> dict:
+    return {'Thumbnails': publish_thumbnails(payload['image'])}
+
+
+HANDLERS = {
+    'process_upload': process_upload,
+    'make_thumbnails': regenerate_thumbnails,
+    'package_hls': package_video,
+    'probe_mp4': probe_upload,
+}
+
+
+def run_job(kind: str, payload: dict) -> dict:
+    return HANDLERS[kind](payload)
+
+
+class JobQueue:
+    # Persistent job queue: jobs live in the Jobs table, are claimed atomically and executed on a process pool.
+    # Running jobs hold a lease that is renewed while they run; a lease that expires (the worker was
+    # restarted or crashed) puts the job back in the queue, up to max_attempts.
+    def __init__(self, db, workers: int = 2, poll_interval: float = 1.0, lease: float = 60.0, max_attempts: int = 3,
+                 storage: tuple[str, dict] = ('local', {})):
+        self.db = db
+        # (backend, options) the worker processes open the blob store with
+        self.storage = storage
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self._executor = None
+        self._task = None
+        self._wakeup = None
+        self._running = {}
+        self._callbacks = {}
+        # on_finish(kind, status, seconds) after every attempt; status is 'done', 'queued' (will retry) or 'failed'
+        self.on_finish = None
+
+    def on_done(self, kind: str, callback) -> None:
+        # callback(payload, result) is awaited in the server process before the job is marked done
+        self._callbacks[kind] = callback
+
+    async def enqueue(self, kind: str, payload: dict) -> int:
+        job_id = await self.db.add_job(kind, payload)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=use_storage, initargs=self.storage)
+
+    async def _execute(self, job: dict) -> None:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        executor = self._executor
+        try:
+            try:
+                result = await loop.run_in_executor(executor, run_job, job['Kind'], job['Payload'])
+            except BrokenProcessPool:
+                # A worker process died (crash, OOM killer) and took the pool with it: every job that was running
+                # on it goes back to the queue without losing an attempt, and the first one replaces the pool
+                if self._executor is executor:
+                    logger.error('job worker process died, restarting the pool')
+                    self._executor = self._new_executor()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                self._finished(job['Kind'], 'queued', started)
+                await self.db.requeue_job(job['id'])
+            except Exception as e:
+                error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+                status = 'queued' if job['Attempts'] < self.max_attempts and not isinstance(e, (KeyError, ValueError)) else 'failed'
+                self._finished(job['Kind'], status, started)
+                await self.db.finish_job(job['id'], status, Error=error)
+            else:
+                callback = self._callbacks.get(job['Kind'])
+                try:
+                    if callback is not None:
+                        await callback(job['Payload'], result)
+                except Exception as e:
+                    # The files are done, only storing the outcome failed: re-running the job would redo all of it
+                    logger.exception('on_done callback of job %s (%s) failed', job['id'], job['Kind'])
+                    self._finished(job['Kind'], 'failed', started)
+                    await self.db.finish_job(job['id'], 'failed', Result=result,
+                                             Error='on_done: ' + ''.join(traceback.format_exception_only(type(e), e)).strip())
+                else:
+                    self._finished(job['Kind'], 'done', started)
+                    await self.db.finish_job(job['id'], 'done', Result=result)
+        except Exception:
+            # Recording the outcome failed; the job keeps its lease and is requeued once it expires
+            logger.exception('could not record the outcome of job %s (%s)', job['id'], job['Kind'])
+        finally:
+            self._running.pop(job['id'], None)
+            self._wakeup.set()
+
+    def _finished(self, kind: str, status: str, started: float) -> None:
+        if self.on_finish is not None:
+            self.on_finish(kind, status, time.perf_counter() - started)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        renew_at = 0
+        backoff = self.poll_interval
+        while True:
+            self._wakeup.clear()
+            try:
+                if loop.time() >= renew_at:
+                    await self.db.requeue_expired_jobs(self.max_attempts)
+                    if self._running:
+                        await self.db.extend_job_leases(list(self._running), self.lease)
+                    renew_at = loop.time() + self.lease / 3
+                while len(self._running) < self.workers:
+                    job = await self.db.claim_job(self.name, self.lease)
+                    if job is None:
+                        break
+                    self._running[job['id']] = asyncio.create_task(self._execute(job))
+            except Exception:
+                # Usually a busy or timed out database: wait longer after each failure in a row, then carry on
+                logger.exception('job queue poll failed, retrying in %.1fs', backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.lease / 3)
+                continue
+            backoff = self.poll_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self, workers: int | None = None) -> None:
+        if workers is not None:
+            self.workers = workers
+        self._executor = self._new_executor()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Jobs still running are abandoned with their lease; they are requeued once it expires
+        if self._task is None:
+            return
+        for task in [self._task, *self._running.values()]:
+            task.cancel()
+        await asyncio.gather(self._task, *self._running.values(), return_exceptions=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._task = None
+        self._running = {}
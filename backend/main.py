@@ -1,68 +1,357 @@
-from PIL import Image
 from sanic import Sanic, response
 from sanic.request import Request
+from sanic.log import logger
 from sanic_session import Session
+from sessions import DatabaseSessionStore, MemorySessionStore, SessionInterface
+from passwords import PasswordHasher
 import string
-import cv2
+import mimetypes
 import os
 import random
+import time
+import asyncio
+import secrets
+import hashlib
+from contextlib import asynccontextmanager
+from functools import partial
 from sanic_cors import CORS
 from database import *
+from streaming import is_not_modified, send_blob_ranges, send_file_ranges, send_ranges
+from ingest import ViewIngestor
+from asyncdb import AsyncDatabase, DatabaseTimeout
+from jobs import JobQueue
+from rollups import WatchRollups
+from hls import MEDIA_TYPES, PLAYLIST_CACHE, SEGMENT_CACHE, ffmpeg_available, hls_file, master_url
+from thumbnails import SIZES, CONTENT_TYPES, variant_path, variant_paths, remove_variants
+from images import IMMUTABLE, REVALIDATE, ImageCache
+from storage import IMAGES, VIDEOS, create_storage
+from pagination import InvalidCursor, clamp_limit
+from uploads import UPLOADS_DIR, MultipartError, MultipartStreamParser, multipart_boundary, upload_part_path, remove_files
+from responses import compress_response, dumps, etag_matches, version_etag
+from metrics import COUNT_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE, LoopLagMonitor, Registry, RequestStats, SamplingProfiler, current_request
 
 
-app = Sanic("VideoHosting")
+def timed_dumps(*args, **kwargs):
+    # JSON encoding happens on the event loop, so its cost is tracked per request
+    started = time.perf_counter()
+    try:
+        return dumps(*args, **kwargs)
+    finally:
+        stats = current_request.get()
+        if stats is not None:
+            stats.json_seconds += time.perf_counter() - started
+
+app = Sanic("VideoHosting", dumps=timed_dumps)
 app.static("/static", "./static")
 
-Session(app)
+# Video and image blobs; STORAGE_BACKEND picks the store and the other STORAGE_* settings are its options
+storage_backend = app.config.get('STORAGE_BACKEND', 'local')
+storage_options = {key[8:].lower(): value for key, value in app.config.items() if key.startswith('STORAGE_') and key != 'STORAGE_BACKEND'}
+storage = create_storage(storage_backend, **storage_options)
+
 CORS(app)
 
+view_ingestor = ViewIngestor()
+db = AsyncDatabase()
+job_queue = JobQueue(db, storage=(storage_backend, storage_options))
+rollups = WatchRollups(db)
+sessions = SessionInterface(DatabaseSessionStore(db))
+Session(app, interface=sessions)
+passwords = PasswordHasher()
+
+registry = Registry()
+http_requests = registry.counter('http_requests_total', 'Requests by route, method and status', ('route', 'method', 'status'))
+http_latency = registry.histogram('http_request_duration_seconds', 'Time until the response is sent (until the first byte for streamed files)', ('route', 'method'))
+request_db_calls = registry.histogram('http_request_db_calls', 'Database calls made by one request', ('route',), COUNT_BUCKETS)
+request_db_seconds = registry.histogram('http_request_db_seconds', 'Time one request spent in database calls', ('route',))
+request_json_seconds = registry.histogram('http_request_json_seconds', 'Time one request spent encoding JSON', ('route',))
+db_call_seconds = registry.histogram('db_call_duration_seconds', 'Database method latency, including the wait for a worker thread', ('method',))
+db_call_errors = registry.counter('db_call_errors_total', 'Database calls that raised, including timeouts', ('method',))
+compression_bytes = registry.counter('http_compressed_bytes_total', 'Bodies of compressed responses before (in) and after (out) compression',
+                                     ('encoding', 'stage'))
+media_bytes = registry.counter('media_bytes_sent_total', 'File bytes written to clients by the streaming routes', ('kind',))
+job_seconds = registry.histogram('job_duration_seconds', 'Background job run time by outcome', ('kind', 'status'),
+                                 (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+loop_lag = LoopLagMonitor(registry.histogram('event_loop_lag_seconds', 'How late the event loop woke up a 0.5 s timer'),
+                          registry.gauge('event_loop_lag_last_seconds', 'Latest event loop lag measurement'))
+profiler = SamplingProfiler()
+images = ImageCache(storage, IMAGES)
+
+def record_db_call(name: str, seconds: float, failed: bool):
+    db_call_seconds.observe(seconds, method=name)
+    if failed:
+        db_call_errors.inc(method=name)
+    stats = current_request.get()
+    if stats is not None:
+        stats.db_calls += 1
+        stats.db_seconds += seconds
+
+db.on_call = record_db_call
+job_queue.on_finish = lambda kind, status, seconds: job_seconds.observe(seconds, kind=kind, status=status)
+
+async def store_video_metadata(payload, result):
+    if result.get('Metadata'):
+        await db.set_video_metadata(payload['video_id'], result['Metadata'])
+
+job_queue.on_done('process_upload', store_video_metadata)
+job_queue.on_done('probe_mp4', store_video_metadata)
+job_queue.on_done('package_hls', lambda payload, result: db.touch_video(payload['video_id']))
+
+# Pages built from cached data carry a strong ETag computed from the versions of that data. Counters that
+# change without an invalidation (views, recommendations, HLS progress) are covered by rotating
+# the tag every ETAG_WINDOW seconds, the same staleness the cache itself allows.
+PAGE_CACHE = 'private, no-cache'
+compression = {'enabled': True, 'min_size': 1024, 'gzip_level': 6, 'brotli_quality': 5}
+# HLS packaging needs the ffmpeg binary; without it uploads are served as MP4 only
+hls = {'enabled': True}
+
+@app.before_server_start
+async def configure_cache(app):
+    Database.cache.enabled = bool(int(app.config.get('CACHE_ENABLED', 1)))
+    if int(app.config.get('CACHE_SHARED', 0)):
+        Database.share_cache(float(app.config.get('CACHE_POLL_INTERVAL', 0.25)))
+
+@app.before_server_start
+async def configure_compression(app):
+    compression.update(enabled=bool(int(app.config.get('COMPRESS_ENABLED', 1))),
+                       min_size=int(app.config.get('COMPRESS_MIN_SIZE', 1024)),
+                       gzip_level=int(app.config.get('COMPRESS_GZIP_LEVEL', 6)),
+                       brotli_quality=int(app.config.get('COMPRESS_BROTLI_QUALITY', 5)))
+
+@app.before_server_start
+async def configure_hls(app):
+    hls['enabled'] = bool(int(app.config.get('HLS_ENABLED', 1)))
+    if hls['enabled'] and not ffmpeg_available():
+        logger.warning('ffmpeg not found (install it or set FFMPEG), HLS packaging is disabled')
+        hls['enabled'] = False
+
+async def enqueue_hls(video_id: int, video: str, owner: str) -> int | None:
+    if not hls['enabled']:
+        return None
+    return await job_queue.enqueue('package_hls', {'video_id': video_id, 'video': video, 'owner_id': owner})
+
+@app.before_server_start
+async def configure_images(app):
+    images.max_bytes = int(float(app.config.get('IMAGE_CACHE_MB', 64)) * 1024 * 1024)
+    images.max_file_bytes = int(float(app.config.get('IMAGE_CACHE_FILE_KB', 1024)) * 1024)
+    images.revalidate = float(app.config.get('IMAGE_REVALIDATE', 2))
+
+@app.before_server_start
+async def configure_auth(app):
+    if app.config.get('SESSION_BACKEND', 'sqlite') == 'memory':
+        sessions.store = MemorySessionStore()
+    sessions.expiry = int(app.config.get('SESSION_EXPIRY', 30 * 24 * 3600))
+    passwords.configure(app.config.get('PASSWORD_KDF', 'scrypt'), int(app.config.get('PASSWORD_SCRYPT_N', 2 ** 14)),
+                        int(app.config.get('PASSWORD_SCRYPT_R', 8)), int(app.config.get('PASSWORD_SCRYPT_P', 1)),
+                        int(app.config.get('PASSWORD_PBKDF2_ITERATIONS', 600000)))
+    passwords.start(int(app.config.get('PASSWORD_WORKERS', 2)))
+
+@app.after_server_start
+async def start_session_compaction(app):
+    sessions.start_compaction(float(app.config.get('SESSION_COMPACT_INTERVAL', 600)))
+
+@app.before_server_stop
+async def stop_session_compaction(app):
+    await sessions.stop_compaction()
+
+@app.after_server_stop
+async def stop_password_hasher(app):
+    passwords.shutdown()
+
+@app.before_server_start
+async def load_search_index(app):
+    Database.build_fuzzy_index()
+
+@app.before_server_start
+async def create_upload_dir(app):
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    storage.create_buckets(VIDEOS, IMAGES)
+
+@app.after_server_start
+async def start_upload_expiry(app):
+    app.ctx.upload_expiry = asyncio.create_task(expire_uploads(float(app.config.get('UPLOAD_SWEEP_INTERVAL', 3600)),
+                                                               float(app.config.get('UPLOAD_EXPIRY', 24 * 3600))))
+
+@app.before_server_stop
+async def stop_upload_expiry(app):
+    app.ctx.upload_expiry.cancel()
+    await asyncio.gather(app.ctx.upload_expiry, return_exceptions=True)
+
+@app.before_server_start
+async def start_db_executor(app):
+    db.start(int(app.config.get('DB_WORKERS', 8)), float(app.config.get('DB_TIMEOUT', 10)))
+
+@app.after_server_start
+async def start_monitoring(app):
+    loop_lag.start()
+    if int(app.config.get('PROFILER_ENABLED', 0)):
+        profiler.interval = float(app.config.get('PROFILER_INTERVAL_MS', 5)) / 1000
+        profiler.start(float(app.config.get('PROFILER_THRESHOLD_MS', 500)) / 1000)
+
+@app.before_server_stop
+async def stop_monitoring(app):
+    await loop_lag.stop()
+    profiler.stop()
+
+@app.on_request
+async def start_request_metrics(request):
+    request.ctx.started = time.monotonic()
+    request.ctx.stats = RequestStats()
+    current_request.set(request.ctx.stats)
+
+@app.on_response
+async def record_request_metrics(request, response):
+    started = getattr(request.ctx, 'started', None)
+    if started is None:
+        return
+    finished = time.monotonic()
+    route = request.uri_template or 'unmatched'
+    stats = request.ctx.stats
+    http_requests.inc(route=route, method=request.method, status=response.status)
+    http_latency.observe(finished - started, route=route, method=request.method)
+    request_db_calls.observe(stats.db_calls, route=route)
+    request_db_seconds.observe(stats.db_seconds, route=route)
+    request_json_seconds.observe(stats.json_seconds, route=route)
+    response.headers['Server-Timing'] = (f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.db_calls} calls", '
+                                         f'json;dur={stats.json_seconds * 1000:.1f}, total;dur={(finished - started) * 1000:.1f}')
+    profiler.record(f'{request.method} {route}', started, finished)
+
+@app.on_response
+async def compress_body(request, response):
+    if not compression['enabled']:
+        return
+    size = len(response.body or b'')
+    encoding = compress_response(request, response, compression['min_size'], compression['gzip_level'], compression['brotli_quality'])
+    if encoding:
+        compression_bytes.inc(size, encoding=encoding, stage='in')
+        compression_bytes.inc(len(response.body), encoding=encoding, stage='out')
+
+@app.after_server_start
+async def start_job_queue(app):
+    await job_queue.start(int(app.config.get('JOB_WORKERS', 2)))
+
+@app.before_server_stop
+async def stop_job_queue(app):
+    await job_queue.stop()
+
+@app.after_server_stop
+async def stop_db_executor(app):
+    db.shutdown()
+
+@app.exception(InvalidCursor)
+async def invalid_cursor(request, exception):
+    return response.json({'message': 'Некорректный курсор'}, status=400)
+
+@app.exception(DatabaseTimeout)
+async def database_timeout(request, exception):
+    return response.json({'message': 'Сервер перегружен, попробуйте позже'}, status=503)
+
+@app.after_server_start
+async def start_view_ingestor(app):
+    await view_ingestor.start()
+
+@app.before_server_stop
+async def stop_view_ingestor(app):
+    await view_ingestor.stop()
+
+@app.after_server_start
+async def start_rollups(app):
+    rollups.interval = float(app.config.get('ROLLUP_INTERVAL', 60))
+    rollups.batch_size = int(app.config.get('ROLLUP_BATCH', ROLLUP_BATCH))
+    rollups.trending_hours = int(app.config.get('TRENDING_HOURS', 48))
+    rollups.half_life = float(app.config.get('TRENDING_HALF_LIFE', 12))
+    rollups.start()
+
+@app.before_server_stop
+async def stop_rollups(app):
+    await rollups.stop()
+
+def record_view(request, VideoId: int):
+    session = request.ctx.session
+    view_ingestor.record(getattr(session, 'sid', None) or request.remote_addr or request.ip, session.get('Auth'), VideoId)
+
+async def page_etag(request, *keys) -> str:
+    # keys: (namespace, key) pairs of the cached data the page is built from; the page also depends on who asks
+    window = int(time.time() // float(app.config.get('ETAG_WINDOW', 30)))
+    versions = await db.get_cache_versions(list(keys))
+    return version_etag(request.path, request.query_string, request.ctx.session.get('Auth'), window, *versions)
+
+def not_modified(etag: str):
+    return response.empty(status=304, headers={'ETag': etag, 'Cache-Control': PAGE_CACHE})
+
+def reaction_target(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+async def toggle_reaction(request, target: str, key: str, not_found: str):
+    user = request.ctx.session.get('Auth')
+    if not user:
+        return response.json({'message': 'Вы не авторизованы'}, status=400)
+    target_id = reaction_target(request.json.get(key))
+    result = await db.toggle_reaction(target, user, target_id, request.json.get('IsLike')) if target_id is not None else None
+    if result is None:
+        return response.json({'message': not_found}, status=404)
+    return response.json({'message': 'Реакция сохранена' if result['IsLike'] is not None else 'Реакция удалена', **result})
+
 @app.post('/react/video')
 async def react_on_video(request):
+    return await toggle_reaction(request, 'video', 'VideoId', 'Видео не найдено')
+
+@app.post('/reactions')
+async def my_reactions(request):
+    # Current user's reactions for every video and comment on a page, in one call
     user = request.ctx.session.get('Auth')
+    video_ids = [reaction_target(i) for i in request.json.get('Videos') or []]
+    comment_ids = [reaction_target(i) for i in request.json.get('Comments') or []]
+    if None in video_ids or None in comment_ids or len(video_ids) + len(comment_ids) > REACTIONS_BULK_MAX:
+        return response.json({'message': 'Некорректный запрос'}, status=400)
     if not user:
-        return response.json({'message': 'Вы не авторизованы'}, status=400)
-    if Database.is_video_reacted(user,request.json.get('VideoId')):
-        Database.unreact_video(user,request.json.get('VideoId'))
-        return response.json({'message': 'Реакция удалена'})
-    else:
-        Database.react_video(user,request.json.get('VideoId'), request.json.get('IsLike'))
-        return response.json({'message': 'Реакция сохранена'})
+        return response.json({'Videos': {}, 'Comments': {}})
+    return response.json(await db.get_user_reactions(user, video_ids, comment_ids))
 
 @app.post('/search')
 async def search(request):
     text = request.json.get('text')
-    distance = request.json.get('distance')
     onlyname = request.json.get('onlyname')
-    data = Database.search_in_database_slow(text, int(distance) if distance else 20)
+    limit = clamp_limit(request.json.get('limit'), 20, 100)
+    data = await db.search_in_database(text, limit, request.json.get('cursor'), request.json.get('fuzzy', True))
     if onlyname:
         return response.json([video['Name'] for video in data['videos']] + [channel['Name'] for channel in data['channels']])
-    else:
-        return response.json(Database.search_in_database_slow(text, int(distance) if distance else 20))
+    return response.json(await images.with_urls(data))
     
 @app.post('/comment/video')
 async def comment_video(request):
-    Database.comment_video(request.ctx.session.get('Auth'), request.json.get('Text'), request.json.get('VideoId'))
+    await db.comment_video(request.ctx.session.get('Auth'), request.json.get('Text'), request.json.get('VideoId'))
     return response.json({'message': 'Реакция сохранена'})
 
 @app.post('/react/comment')
 async def reactComment(request):
-    comment_id = request.json.get('CommentId')
-    isLike = request.json.get('IsLike')
-    Database.react_comment(request.ctx.session.get('Auth'), comment_id, isLike)
+    return await toggle_reaction(request, 'comment', 'CommentId', 'Комментарий не найден')
 
 @app.get('/video/<video_id:int>')
 async def video(request, video_id:int):
-    Data = Database.get_video_by_id(video_id)
-    if os.path.exists('video/'+Data['Path']):
+    etag = await page_etag(request, ('video', video_id), ('comments', f'{video_id}:new'), ('user', None))
+    if etag_matches(request, etag):
+        record_view(request, video_id)
+        return not_modified(etag)
+    Data = await db.get_video_by_id(video_id)
+    if Data and storage.exists(VIDEOS, Data['Path']):
         for i in Data['Reactions']:
             if Data['Reactions'][i] is None:
                 Data['Reactions'][i] = 0
-        Database.add_video_watch(request.ctx.session.get('Auth'),Data['id'])
+        record_view(request, Data['id'])
+        Data['Hls'] = master_url(Data['Path'])
         
-        Data['recommended_videos'] = Database.get_reccomended_videos_by_user_id(request.ctx.session.get('Auth'), 5)
-        Data['comments'] = Database.get_all_comments(Data['id'])
+        Data['recommended_videos'] = await db.get_reccomended_videos_by_user_id(request.ctx.session.get('Auth'), 5)
+        comments = await db.get_comments_page(Data['id'])
+        Data['comments'] = comments['comments']
+        Data['comments_next'] = comments['next']
+        if request.ctx.session.get('Auth'):
+            Data['my_reactions'] = await db.get_user_reactions(request.ctx.session.get('Auth'), [Data['id']], [comment['id'] for comment in comments['comments']])
         
-        return response.json(Data)
+        return response.json(await images.with_urls(Data), headers={'ETag': etag, 'Cache-Control': PAGE_CACHE})
     return response.json({'message': 'Видео не найдено'})
 
 @app.post('/delete_video')
@@ -70,13 +359,13 @@ async def delete_video(request):
     user = request.ctx.session.get('Auth')
     if not user:
         return response.json({'message': 'Вы не авторизованы'}, status=400)
-    video = Database.get_video_by_id(request.json.get('VideoId'))
+    video = await db.get_video_by_id(request.json.get('VideoId'))
     if not video:
         return response.json({'message': 'Видео не найдено'}, status=400)
-    if video['OwnerId'] != user:
+    if (video['Owner'] or {}).get('Login') != user:
         return response.json({'message': 'Вы не можете удалить это видео'}, status=400)
     
-    Database.delete_video(request.json.get('VideoId'))
+    await db.delete_video(user, video['id'])
     return response.json({'message': 'Видео удалено'}, status=200)
 
 @app.post('/newprofileinfo')
@@ -85,150 +374,461 @@ async def update_description(request):
     newname = request.form.get('newname')
     if not newname:
         return response.json({'message': 'Новое имя не может быть пустым'}, status=400)
-    newpfp = request.file.get('newpfp')
+    newpfp = request.files.get('newpfp')
     if newpfp:
-        newpfp.save('Images/'+request.ctx.session.get('Auth')+'.png')
-    Database.update_profile(request.ctx.session.get('Auth'), newdes, newname)
+        name = request.ctx.session.get('Auth') + '.png'
+        storage.write(IMAGES, name, newpfp.body)
+        images.invalidate(name)
+    await db.update_profile(request.ctx.session.get('Auth'), newdes, newname)
     return response.json({'message': 'Профиль изменен'}, status=200)
 
 @app.get('/get_recommended_videos')
 async def get_recommended_videos(request):
     user = request.ctx.session.get('Auth')
     count = request.args.get('count')
-    if user:
-        return response.json(Database.get_reccomended_videos_by_user_id(user, int(count) if count else 5))
-    return response.json([Database.get_random_video() for i in range(int(count) if count else 5)])
+    return response.json(await images.with_urls(await db.get_reccomended_videos_by_user_id(user, max(1, min(int(count) if count else 5, 100)))))
+
+@app.get('/trending')
+async def trending(request):
+    page = await db.get_trending_page(request.args.get('cursor'), clamp_limit(request.args.get('limit'), 24, 100))
+    return response.json(await images.with_urls(page))
 
 @app.route('/servevideo/<filename:str>')
 async def serve_video(request, filename:str):
-    video_data = Database.get_video_by_path(filename)
-    video_path = 'video/' + video_data['Path']
-    
+    video_data = await db.get_video_by_path(filename)
+    if not video_data:
+        return response.json({'message': 'Видео не найдено'}, status=404)
+    if not request.headers.get('Range'):
+        record_view(request, video_data['id'])
     try:
-        with open(video_path, 'rb') as video_file:
-            video_data = video_file.read()
-    except:
-        return response.json({'message': 'Видео не найдено'}, status=404)
-    
-    headers = {'Accept-Ranges': 'bytes'}
-    content_range = request.headers.get('Range')
+        return await send_blob_ranges(request, storage, VIDEOS, video_data['Path'], on_send=partial(media_bytes.inc, kind='video'))
+    except OSError:
+        return response.json({'message': 'Видео не найдено'}, status=404)
 
-    if content_range:
-        start, end = content_range.replace('bytes=', '').split('-')
-        start = int(start)
-        end = int(end) if end else len(video_data) - 1
+@app.get('/stats/views')
+async def view_stats(request):
+    return response.json({**view_ingestor.snapshot(), 'rollups': rollups.snapshot()})
 
-        content_length = end - start + 1
-        headers['Content-Range'] = f'bytes {start}-{end}/{len(video_data)}'
-        
-        video_chunk = video_data[start:end+1]
-        return response.raw(video_chunk, headers=headers, status=206)
-    Database.add_video_watch(request.ctx.session.get('Auth'),Database.get_video_by_path(filename)['id'])
-    return await response.file_stream(video_path, headers=headers)
+@app.get('/stats/cache')
+async def cache_stats(request):
+    return response.json({**Database.cache.snapshot(), 'images': images.snapshot()})
+
+@app.get('/metrics')
+async def metrics(request):
+    return response.text(registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+def profiler_allowed(request) -> bool:
+    # The profiler endpoints only exist when a PROFILER_TOKEN is configured
+    token = app.config.get('PROFILER_TOKEN')
+    return bool(token) and secrets.compare_digest(request.headers.get('X-Profiler-Token', ''), str(token))
+
+@app.get('/debug/profile')
+async def profile_dump(request):
+    # Folded stacks of slow requests, ready for flamegraph.pl or speedscope
+    if not profiler_allowed(request):
+        return response.json({'message': 'Не найдено'}, status=404)
+    return response.text(profiler.dump())
+
+@app.post('/debug/profile')
+async def profile_control(request):
+    if not profiler_allowed(request):
+        return response.json({'message': 'Не найдено'}, status=404)
+    body = request.json or {}
+    if body.get('clear'):
+        profiler.clear()
+    if body.get('enabled') is True:
+        profiler.start(float(body['threshold_ms']) / 1000 if body.get('threshold_ms') is not None else None)
+    elif body.get('enabled') is False:
+        profiler.stop()
+    return response.json({'enabled': profiler.enabled, 'threshold_ms': profiler.threshold * 1000, 'requests': profiler.requests})
+
+@app.route('/hls/<name:str>/master.m3u8')
+async def serve_hls_master(request, name: str):
+    return await serve_hls_file(request, hls_file(name), PLAYLIST_CACHE)
+
+@app.route('/hls/<name:str>/<rendition:str>/<filename:str>')
+async def serve_hls_media(request, name: str, rendition: str, filename: str):
+    # Media playlists may be rewritten by a re-run of the job, segments are never served with other content
+    path = hls_file(name, rendition, filename)
+    return await serve_hls_file(request, path, PLAYLIST_CACHE if filename.endswith('.m3u8') else SEGMENT_CACHE)
+
+async def serve_hls_file(request, path, cache_control: str):
+    if path is None:
+        return response.json({'message': 'Файл не найден'}, status=404)
+    try:
+        return await send_file_ranges(request, path, {'Cache-Control': cache_control}, MEDIA_TYPES[os.path.splitext(path)[1]],
+                                      on_send=partial(media_bytes.inc, kind='hls'))
+    except OSError:
+        return response.json({'message': 'Файл не найден'}, status=404)
 
 @app.route('/image/<filename:str>')
 async def serve_image(request, filename):
-    return await response.file('Images/'+filename)
+    size = request.args.get('size')
+    if size and size not in SIZES:
+        return response.json({'message': 'Неизвестный размер изображения'}, status=400)
+    original = await images.get(filename)
+    entry, content_type = original, mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if size:
+        fmt = 'webp' if 'image/webp' in request.headers.get('accept', '') else 'jpg'
+        variant = await images.get(variant_path(filename, size, fmt))
+        # Until the thumbnail job has run (or for profile pictures) the original is served instead
+        if variant is not None:
+            entry, content_type = variant, CONTENT_TYPES[fmt]
+    if entry is None:
+        return response.json({'message': 'Файл не найден'}, status=404)
+    # ?v= names one version of the original: only the final bytes for that version may be cached for good
+    final = original is not None and request.args.get('v') == original.digest and (not size or entry is not original)
+    headers = {'ETag': entry.etag, 'Last-Modified': entry.last_modified, 'Cache-Control': IMMUTABLE if final else REVALIDATE}
+    if size:
+        headers['Vary'] = 'Accept'
+    if request.headers.get('If-None-Match') is not None:
+        not_modified = etag_matches(request, entry.etag)
+    else:
+        not_modified = is_not_modified(request, entry.etag, entry.mtime)
+    if not_modified:
+        return response.empty(status=304, headers=headers)
+    if entry.body is not None:
+        return response.raw(entry.body, content_type=content_type, headers=headers)
+    return await send_ranges(request, entry.stat, partial(storage.open_range, IMAGES, entry.name), headers, content_type, etag=entry.etag)
 
 @app.post('/login')
 async def login(request):
     username = request.form.get('username')
     password = request.form.get('password')
-    logged_in = Database.login_user(username, password)
+    stored = await db.get_password_hash(username) if username and password else None
+    logged_in = bool(password) and await passwords.verify(password, stored)
     if logged_in:
-        request.ctx.session['Auth'] = logged_in
+        if passwords.needs_rehash(stored):
+            await db.set_password_hash(username, await passwords.hash(password), stored)
+        sessions.regenerate(request)
+        request.ctx.session['Auth'] = username
         return response.json({'message': 'Вы вошли в аккаунт'}, status=200)
     else:
         return response.json({'message': 'Неверное имя пользователя или пароль'}, status=400)
 
 @app.route('/profile/<profilename:str>')
 async def account_info(request: Request, profilename:str):
-    account_data = Database.get_user_data(profilename)
+    etag = await page_etag(request, ('user', profilename))
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    account_data = await db.get_user_data(profilename)
     if not account_data:
         return response.json({'message': 'Пользователь не найден'}, status=404)
-    account_data['UserVideos'] = Database.get_all_videos_by_owner_id(profilename)
+    videos = await db.get_videos_by_owner_page(profilename)
+    account_data['UserVideos'] = videos['videos']
+    account_data['UserVideosNext'] = videos['next']
     account_data['ItIsMyAccount'] = profilename == request.ctx.session.get('Auth')
-    return response.json(account_data, status=200)
+    return response.json(await images.with_urls(account_data), status=200, headers={'ETag': etag, 'Cache-Control': PAGE_CACHE})
+
+@app.get('/profile/<profilename:str>/videos')
+async def account_videos(request, profilename: str):
+    page = await db.get_videos_by_owner_page(profilename, request.args.get('cursor'), clamp_limit(request.args.get('limit'), 24, 100))
+    return response.json(await images.with_urls(page))
+
+def stats_range(request) -> tuple[int, int]:
+    # Hours and days of the view series; hourly buckets only go back HOURLY_RETENTION hours
+    return clamp_limit(request.args.get('hours'), 48, HOURLY_RETENTION), clamp_limit(request.args.get('days'), 30, 365)
+
+@app.get('/profile/<profilename:str>/stats')
+async def account_stats(request, profilename: str):
+    if not await db.get_user_data(profilename):
+        return response.json({'message': 'Пользователь не найден'}, status=404)
+    hours, days = stats_range(request)
+    return response.json(await images.with_urls(await db.get_channel_stats(profilename, hours, days)))
+
+@app.get('/video/<video_id:int>/comments')
+async def video_comments(request, video_id: int):
+    sort = request.args.get('sort', 'new')
+    if sort not in COMMENT_ORDERS:
+        return response.json({'message': 'Неизвестная сортировка'}, status=400)
+    etag = await page_etag(request, ('comments', f'{video_id}:{sort}'), ('user', None))
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    page = await db.get_comments_page(video_id, sort, request.args.get('cursor'), clamp_limit(request.args.get('limit'), 20, COMMENTS_PAGE_MAX))
+    return response.json(await images.with_urls(page), headers={'ETag': etag, 'Cache-Control': PAGE_CACHE})
+
+@app.get('/video/<video_id:int>/stats')
+async def video_stats(request, video_id: int):
+    if not await db.get_video_by_id(video_id):
+        return response.json({'message': 'Видео не найдено'}, status=404)
+    hours, days = stats_range(request)
+    return response.json(await db.get_view_stats('video', video_id, hours, days))
 
 @app.post('/redact_video_image')
 async def redact_video_image(request):
     user = request.ctx.session.get('Auth')
     if not user:
         return response.json({'message': 'Вы не авторизованы'}, status=401)
-    video = Database.get_video_by_id(request.form.get('VideoId'))
+    video = await db.get_video_by_id(int(request.form.get('VideoId') or 0))
     if not video:
         return response.json({'message': 'Видео не найдено'}, status=404)
-    if video['OwnerId'] != user:
+    if (video['Owner'] or {}).get('Login') != user:
         return response.json({'message': 'Вы не можете редактировать это видео'}, status=403)
-    request.file.get('image').save('Images/'+video['ImagePath'])
-    return response.json({'message': 'ok'}, status=200)
+    image = request.files.get('image')
+    if not image:
+        return response.json({'message': 'Изображение не было прикреплено'}, status=400)
+    storage.write(IMAGES, video['ImagePath'], image.body)
+    # Old variants would show the previous image until the job replaces them
+    remove_variants(storage, IMAGES, video['ImagePath'])
+    images.invalidate(video['ImagePath'], *variant_paths(video['ImagePath']))
+    # The page embeds the image's content-hashed URL
+    await db.touch_video(video['id'])
+    job_id = await job_queue.enqueue('make_thumbnails', {'image': video['ImagePath'], 'owner_id': user})
+    return response.json({'message': 'ok', 'JobId': job_id}, status=200)
 
 @app.post('/redact_video')
 async def redact_video(request):
     user = request.ctx.session.get('Auth')
     if not user:
         return response.json({'message': 'Вы не авторизованы'}, status=401)
-    return response.json({'status': Database.redact_video(request.json.get('Name'), request.json.get('Description'), request.json.get('Tags'), user)}, status=200)
+    return response.json({'status': await db.redact_video(request.json.get('VideoId'), request.json.get('Name'), request.json.get('Description'), request.json.get('Tags'), user)}, status=200)
 
-@app.post('/videoupload')
+def random_file_name() -> str:
+    return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
+
+@app.post('/videoupload', stream=True)
 async def upload_video(request):
     if not request.ctx.session.get('Auth'):
         return response.json({'message': 'Вы не авторизованы'}, status=401)
-    
-    uploaded_videofile = request.files.get('video')
-    uploaded_videoimage = request.files.get('image')
-    uploaded_videoname = request.form.get('name')
-    uploaded_videodesc = request.form.get('desc')
-    tags = str(request.form.get('tags'))
-    
+    boundary = multipart_boundary(request.headers.get('content-type'))
+    if not boundary:
+        return response.json({'message': 'Ожидается multipart/form-data'}, status=400)
+    request.stream.request_max_size = int(app.config.get('VIDEO_MAX_SIZE', 10 * 1024 ** 3))
+
+    random_name_video = random_file_name()
+    # File parts are staged next to the chunked uploads and moved into storage once the request is valid
+    video_part = os.path.join(UPLOADS_DIR, random_name_video + '.mp4.part')
+    image_part = os.path.join(UPLOADS_DIR, random_name_video + '.png.part')
+    targets = {'video': video_part, 'image': image_part}
+
+    def open_file(field, filename):
+        if field not in targets:
+            return None
+        return open(targets[field], 'wb')
+
+    # The body is parsed as it arrives, file parts go straight to disk instead of being buffered in memory
+    loop = asyncio.get_running_loop()
+    parser = MultipartStreamParser(boundary, open_file)
+    try:
+        while (body := await request.stream.read()) is not None:
+            await loop.run_in_executor(None, parser.feed, body)
+        parser.finish()
+    except MultipartError as e:
+        parser.close()
+        remove_files(video_part, image_part)
+        return response.json({'message': 'Некорректный запрос', 'exception': str(e)}, status=400)
+    except BaseException:
+        # Too large, client gone, disk full, cancelled: the staged parts are never used
+        parser.close()
+        remove_files(video_part, image_part)
+        raise
+
+    uploaded_videofile = parser.files.get('video', {}).get('size')
+    uploaded_videoimage = parser.files.get('image', {}).get('size')
+    uploaded_videoname = parser.fields.get('name')
+    uploaded_videodesc = parser.fields.get('desc')
+    tags = str(parser.fields.get('tags'))
+
     if not uploaded_videofile:
+        remove_files(video_part, image_part)
         return response.json({'message': 'Видеофайла не было прикреплено'}, status=400)
     if not uploaded_videoname:
+        remove_files(video_part, image_part)
         return response.json({'message': 'Имя видео не может быть пустым'}, status=400)
-    random_name_video = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
-    
-    video_file_path = os.path.join('video/', random_name_video + ".mp4")
-    
-    with open(video_file_path, 'wb') as file:
-        file.write(uploaded_videofile.body)
 
     if not uploaded_videoimage:
-        vidcap = cv2.VideoCapture(os.path.join('video/', random_name_video + ".mp4"))
-        totalFrames = vidcap.get(cv2.CAP_PROP_FRAME_COUNT)
-        randomFrameNumber=random.randint(0, totalFrames)
-        vidcap.set(cv2.CAP_PROP_POS_FRAMES,randomFrameNumber)
-        success, image = vidcap.read()
-        if success:
-            cv2.imwrite(os.path.join('Images/', random_name_video + ".png"), image)
+        remove_files(image_part)
+    try:
+        video_id, job_id, hls_job_id = await publish_video(request.ctx.session.get('Auth'), uploaded_videoname, uploaded_videodesc, tags,
+                                                           random_name_video, video_part, image_part if uploaded_videoimage else None)
+    except BaseException:
+        remove_files(video_part, image_part)
+        raise
+    return response.json({'message': 'Видеофайл успешно загружен', 'VideoId': video_id, 'JobId': job_id, 'HlsJobId': hls_job_id}, status=200)
 
-    else:
-        image_file_path = os.path.join('Images/', random_name_video + ".png")
-        with open(image_file_path, 'wb') as file:
-            file.write(uploaded_videoimage.body)
+async def publish_video(owner: str, name: str, desc: str, tags: str, random_name_video: str, video_part: str, image_part: str | None):
+    # The row goes in before the files are moved into storage, so a failed insert leaves nothing behind;
+    # if a move or an enqueue fails afterwards, the stored files and the row are removed again
+    video_id = await db.add_video(name, random_name_video, desc, owner, tags)
+    try:
+        storage.put_file(VIDEOS, random_name_video + '.mp4', video_part)
+        if image_part:
+            storage.put_file(IMAGES, random_name_video + '.png', image_part)
+        job_id = await job_queue.enqueue('process_upload', {'video_id': video_id, 'video': random_name_video + '.mp4', 'image': random_name_video + '.png',
+                                                            'make_thumbnail': not image_part, 'owner_id': owner})
+        hls_job_id = await enqueue_hls(video_id, random_name_video + '.mp4', owner)
+    except BaseException:
+        storage.delete(VIDEOS, random_name_video + '.mp4')
+        storage.delete(IMAGES, random_name_video + '.png')
+        await db.delete_video(owner, video_id)
+        raise
+    return video_id, job_id, hls_job_id
 
-    Database.add_video(uploaded_videoname, random_name_video, uploaded_videodesc, request.ctx.session.get('Auth'), tags)
-    
-    return response.json({'message': 'Видеофайл успешно загружен'}, status=200)
+# Upload id -> [lock, requests holding or waiting for it]; the entry goes away with the last of them
+upload_locks = {}
+
+@asynccontextmanager
+async def upload_lock(upload_id: str):
+    entry = upload_locks.setdefault(upload_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del upload_locks[upload_id]
+
+async def expire_uploads(interval: float, max_age: float):
+    # Resumable uploads untouched for max_age seconds are dropped together with their .part file
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            expired = await db.expire_uploads(max_age)
+        except Exception:
+            # Busy database: retried on the next round
+            continue
+        remove_files(*map(upload_part_path, expired))
+
+def write_chunk(path: str, offset: int, data: bytes) -> None:
+    with open(path, 'r+b') as file:
+        file.seek(offset)
+        file.write(data)
+
+def truncate_file(path: str, size: int) -> None:
+    with open(path, 'r+b') as file:
+        file.truncate(size)
+
+async def get_own_upload(request, upload_id: str):
+    upload = await db.get_upload(upload_id)
+    if not upload or upload['OwnerId'] != request.ctx.session.get('Auth'):
+        return None
+    return upload
+
+@app.post('/upload/init')
+async def upload_init(request):
+    user = request.ctx.session.get('Auth')
+    if not user:
+        return response.json({'message': 'Вы не авторизованы'}, status=401)
+    name = request.json.get('name')
+    size = request.json.get('size')
+    if not name:
+        return response.json({'message': 'Имя видео не может быть пустым'}, status=400)
+    if not isinstance(size, int) or not 0 < size <= int(app.config.get('VIDEO_MAX_SIZE', 10 * 1024 ** 3)):
+        return response.json({'message': 'Некорректный размер файла'}, status=400)
+    upload_id = secrets.token_hex(16)
+    open(upload_part_path(upload_id), 'wb').close()
+    await db.add_upload(upload_id, user, name, request.json.get('desc'), str(request.json.get('tags')), size)
+    return response.json({'UploadId': upload_id, 'ChunkSize': int(app.config.get('UPLOAD_CHUNK_SIZE', 8 * 1024 ** 2)), 'Received': 0}, status=200)
+
+@app.get('/upload/<upload_id:str>')
+async def upload_status(request, upload_id: str):
+    upload = await get_own_upload(request, upload_id)
+    if not upload:
+        return response.json({'message': 'Загрузка не найдена'}, status=404)
+    return response.json({'UploadId': upload_id, 'Size': upload['Size'], 'Received': upload['Received'], 'Status': upload['Status']})
+
+@app.put('/upload/<upload_id:str>', stream=True)
+async def upload_chunk(request, upload_id: str):
+    upload = await get_own_upload(request, upload_id)
+    if not upload:
+        return response.json({'message': 'Загрузка не найдена'}, status=404)
+    checksum = (request.headers.get('X-Chunk-SHA256') or '').lower()
+    if not checksum:
+        return response.json({'message': 'Не указана контрольная сумма'}, status=400)
+    try:
+        offset = int(request.args.get('offset'))
+    except (TypeError, ValueError):
+        return response.json({'message': 'Не указано смещение'}, status=400)
+    # A chunk is never larger than UPLOAD_CHUNK_SIZE, which bounds both memory and what a retry has to resend
+    request.stream.request_max_size = int(app.config.get('UPLOAD_CHUNK_SIZE', 8 * 1024 ** 2))
+
+    async with upload_lock(upload_id):
+        # Expired or finalized while this request waited for the lock
+        upload = await db.get_upload(upload_id)
+        if not upload:
+            return response.json({'message': 'Загрузка не найдена'}, status=404)
+        if upload['Status'] != 'open' or offset != upload['Received']:
+            return response.json({'message': 'Неверное смещение', 'Received': upload['Received']}, status=409)
+        loop = asyncio.get_running_loop()
+        path = upload_part_path(upload_id)
+        digest = hashlib.sha256()
+        position = offset
+        while (body := await request.stream.read()) is not None:
+            if position + len(body) > upload['Size']:
+                await loop.run_in_executor(None, truncate_file, path, offset)
+                return response.json({'message': 'Размер превышает заявленный', 'Received': offset}, status=400)
+            digest.update(body)
+            await loop.run_in_executor(None, write_chunk, path, position, body)
+            position += len(body)
+        if digest.hexdigest() != checksum:
+            await loop.run_in_executor(None, truncate_file, path, offset)
+            return response.json({'message': 'Контрольная сумма не совпадает', 'Received': offset}, status=400)
+        if not await db.advance_upload(upload_id, offset, position):
+            return response.json({'message': 'Неверное смещение', 'Received': offset}, status=409)
+    return response.json({'UploadId': upload_id, 'Size': upload['Size'], 'Received': position}, status=200)
+
+@app.post('/upload/<upload_id:str>/finalize')
+async def upload_finalize(request, upload_id: str):
+    upload = await get_own_upload(request, upload_id)
+    if not upload:
+        return response.json({'message': 'Загрузка не найдена'}, status=404)
+    if upload['Received'] != upload['Size'] or not await db.complete_upload(upload_id):
+        return response.json({'message': 'Загрузка не завершена', 'Received': upload['Received']}, status=409)
+
+    part = upload_part_path(upload_id)
+    try:
+        video_id, job_id, hls_job_id = await publish_video(upload['OwnerId'], upload['Name'], upload['Description'], upload['Tags'],
+                                                           random_file_name(), part, None)
+    except BaseException:
+        # Reopened so the client can finalize again; if the part was already moved away it has to be resent
+        received = upload['Received'] if os.path.exists(part) else 0
+        if not received:
+            open(part, 'wb').close()
+        await db.reopen_upload(upload_id, received)
+        raise
+    return response.json({'message': 'Видеофайл успешно загружен', 'VideoId': video_id, 'JobId': job_id, 'HlsJobId': hls_job_id}, status=200)
+
+@app.get('/job/<job_id:int>')
+async def job_status(request, job_id: int):
+    # Only the user who started a job sees it; ids are sequential and results hold server paths and errors
+    user = request.ctx.session.get('Auth')
+    if not user:
+        return response.json({'message': 'Вы не авторизованы'}, status=401)
+    job = await db.get_job(job_id)
+    if not job or job.pop('OwnerId') != user:
+        return response.json({'message': 'Задача не найдена'}, status=404)
+    return response.json(job)
 
 @app.get('/whoami')
 async def whoami(request):
     user = request.ctx.session.get('Auth')
     if not user:
         return response.json({'message': 'Вы не авторизованы'}, status=401)
-    return response.json({'user': Database.get_user_data(user)})
+    return response.json({'user': await db.get_user_data(user)})
 
 @app.post('/register')
 async def register(request):
     try:
-        Database.reg_user(request.form.get('username'), request.form.get('password'), request.form.get('nickname'))
+        await db.reg_user(request.form.get('username'), await passwords.hash(request.form.get('password')), request.form.get('nickname'))
     except Exception as e:
         return response.json({'message': 'Пользователь с таким именем уже существует', 'exception': str(e)}, status=400)
-    original_image = Image.open('Images/no-photo.png')
-    copy_image = original_image.copy()
-    copy_image.save('Images/'+request.form.get('username')+'.png')
-    original_image.close()
-    copy_image.close()
+    storage.write(IMAGES, request.form.get('username') + '.png', storage.read(IMAGES, 'no-photo.png'))
     return response.json({'message': 'Аккаунт успешно создан'}, status=200)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description='VideoHosting server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=int(app.config.get('WORKERS', os.cpu_count() or 1)),
+                        help='server processes, all serving the same port (default: WORKERS or one per CPU)')
+    parser.add_argument('--dev', action='store_true', help='a single worker in debug mode')
+    args = parser.parse_args()
+    if args.dev:
+        app.run(host=args.host, port=args.port, debug=True)
+    else:
+        if args.workers > 1:
+            # Worker processes are started fresh and read their config from the environment
+            os.environ.setdefault('SANIC_CACHE_SHARED', '1')
+        app.run(host=args.host, port=args.port, workers=args.workers, access_log=False)
\ No newline at end of file
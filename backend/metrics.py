@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import contextvars
+from collections import Counter as Tally, deque
+
+# In-process metrics in the Prometheus text format. Each server process keeps its own registry,
+# so with several workers every process has to be scraped (or run with a single worker).
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f'{self.name}{_labels(self.label_names, key)} {_number(value)}' for key, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            items = sorted((key, [list(state[0]), state[1], state[2]]) for key, state in self._values.items())
+        bounds = [f'le="{_number(bound)}"' for bound in self.buckets] + ['le="+Inf"']
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket in zip(bounds, counts + [count - sum(counts)]):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, key, bound)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+class RequestStats:
+    # Time a request spent in work that is measured elsewhere (database calls, JSON encoding)
+    __slots__ = ('db_calls', 'db_seconds', 'json_seconds')
+
+    def __init__(self):
+        self.db_calls = 0
+        self.db_seconds = 0.0
+        self.json_seconds = 0.0
+
+
+# Set by the request middleware; tasks outside a request (ingestor, job queue) see None
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class LoopLagMonitor:
+    # Sleeps for interval and measures how late it wakes up: the time the event loop was blocked
+    def __init__(self, histogram: Histogram, gauge: Gauge, interval: float = 0.5):
+        self.histogram = histogram
+        self.gauge = gauge
+        self.interval = interval
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self.histogram.observe(lag)
+            self.gauge.set(lag)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class SamplingProfiler:
+    # Opt-in wall-clock profiler: a thread samples the Python stacks of every other thread into a short
+    # ring buffer, and the samples taken while a slow request was in flight are folded into
+    # "frame;frame;frame count" lines, the input format of flamegraph.pl and speedscope.
+    # Idle threads (executor workers waiting for work, the loop waiting in select) are skipped.
+    IDLE = {('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'), ('thread.py', '_worker')}
+
+    def __init__(self, interval: float = 0.005, window: float = 30.0, threshold: float = 0.5):
+        self.interval = interval
+        self.window = window
+        self.threshold = threshold
+        self.folded = Tally()
+        self.requests = 0
+        self._samples = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def _stack(self, frame) -> tuple:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            taken = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = self._stack(frame)
+                if stack and stack[-1][:2] not in self.IDLE:
+                    if ident not in names:
+                        names = {thread.ident: thread.name for thread in threading.enumerate()}
+                    taken.append((names.get(ident, str(ident)), stack))
+            with self._lock:
+                self._samples.append((now, taken))
+                while self._samples and self._samples[0][0] < now - self.window:
+                    self._samples.popleft()
+
+    def start(self, threshold: float | None = None) -> None:
+        if threshold is not None:
+            self.threshold = threshold
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            with self._lock:
+                self._samples.clear()
+
+    def record(self, label: str, started: float, finished: float) -> None:
+        # started/finished are time.monotonic() values of a request that took longer than threshold
+        if self._thread is None or finished - started < self.threshold:
+            return
+        with self._lock:
+            window = [taken for at, taken in self._samples if started <= at <= finished]
+            self.requests += 1
+            for taken in window:
+                for thread, stack in taken:
+                    frames = ';'.join(f'{name} ({filename}:{line})' for filename, name, line in stack)
+                    self.folded[f'{label};{thread};{frames}'] += 1
+
+    def dump(self) -> str:
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.folded.most_common())
+
+    def clear(self) -> None:
+        with self._lock:
+            self.folded.clear()
+            self.requests = 0
@@ -0,0 +1,50 @@
+import sys
+import time
+import sqlite3
+
+# Versioned schema migrations. PRAGMA user_version stores the last applied version; at startup every
+# newer migration runs in order and the version is bumped only after it has finished.
+# A migration is a callable that opens its own transactions, so a backfill can commit one id range
+# at a time instead of holding the write lock for the whole table. Migrations must be idempotent:
+# after a crash (or when two workers start together) a migration is simply run again.
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def id_ranges(connect, table: str, batch_size: int, column: str = 'id') -> list[tuple[int, int]]:
+    # [first, last) ranges covering every row of table, for backfills that commit once per range
+    with connect() as conn:
+        max_id = conn.execute(f'SELECT MAX({column}) FROM {table}').fetchone()[0] or 0
+    return [(first, first + batch_size) for first in range(0, max_id + 1, batch_size)]
+
+
+def log_stderr(message: str) -> None:
+    print(message, file=sys.stderr)
+
+
+def run_migrations(connect, migrations: list[tuple], log=log_stderr) -> int:
+    # migrations: (version, description, callable) with versions 1, 2, 3, ...; returns the final version
+    versions = [version for version, _, _ in migrations]
+    if versions != list(range(1, len(migrations) + 1)):
+        raise MigrationError(f'migration versions must be 1..{len(migrations)}, got {versions}')
+    with connect() as conn:
+        current = schema_version(conn)
+    if current > len(migrations):
+        raise MigrationError(f'database schema version {current} is newer than this code ({len(migrations)})')
+    for version, description, migrate in migrations[current:]:
+        with connect() as conn:
+            if schema_version(conn) >= version:
+                continue
+        started = time.perf_counter()
+        migrate()
+        with connect() as conn:
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+        log(f'migration {version} ({description}) applied in {time.perf_counter() - started:.2f}s')
+    with connect() as conn:
+        return schema_version(conn)
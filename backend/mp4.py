@@ -0,0 +1,203 @@
+import os
+import struct
+import shutil
+
+# Minimal ISO BMFF (MP4) box reader: enough to find moov/mdat, read track metadata and rewrite chunk offsets
+
+CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'udta', b'mvex', b'dinf'}
+COPY_CHUNK = 1024 * 1024
+
+
+class MP4Error(ValueError):
+    pass
+
+
+def iter_boxes(data, start: int = 0, end: int | None = None):
+    # Yields (type, offset, size, header_size) for the boxes in data[start:end]; data is bytes or a file
+    if end is None:
+        end = len(data)
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                raise MP4Error('truncated box header')
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise MP4Error(f'bad size for box {kind!r} at {offset}')
+        yield kind, offset, size, header
+        offset += size
+
+
+def top_level_boxes(path: str) -> list[tuple]:
+    # Only box headers are read, mdat payloads are skipped with seek
+    boxes = []
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        offset = 0
+        while offset + 8 <= file_size:
+            file.seek(offset)
+            head = file.read(16)
+            size, kind = struct.unpack('>I4s', head[:8])
+            header = 8
+            if size == 1:
+                size = struct.unpack('>Q', head[8:16])[0]
+                header = 16
+            elif size == 0:
+                size = file_size - offset
+            if size < header or offset + size > file_size:
+                raise MP4Error(f'bad size for box {kind!r} at {offset}')
+            boxes.append((kind, offset, size, header))
+            offset += size
+    if not boxes or boxes[0][0] != b'ftyp':
+        raise MP4Error('not an MP4 file')
+    return boxes
+
+
+def find_box(data: bytes, path: list[bytes], start: int = 0, end: int | None = None):
+    for kind, offset, size, header in iter_boxes(data, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return offset + header, offset + size
+            return find_box(data, path[1:], offset + header, offset + size)
+    return None
+
+
+def _duration(data: bytes, box) -> tuple[int, int]:
+    # mvhd and mdhd share the layout: version/flags, times, timescale, duration (32 or 64 bit by version)
+    start = box[0]
+    if data[start] == 1:
+        return struct.unpack('>IQ', data[start + 20:start + 32])
+    return struct.unpack('>II', data[start + 12:start + 20])
+
+
+def _sample_entry(data: bytes, stbl) -> tuple[str | None, tuple | None]:
+    stsd = find_box(data, [b'stsd'], *stbl)
+    if stsd is None:
+        return None, None
+    for kind, offset, size, header in iter_boxes(data, stsd[0] + 8, stsd[1]):
+        codec = kind.decode('latin-1')
+        entry = (offset + header, offset + size)
+        return codec, entry
+    return None, None
+
+
+def _video_codec(data: bytes, codec: str, entry) -> str:
+    # avc1/avc3: sample entry is 78 bytes before its child boxes, avcC carries profile/compat/level
+    if codec in ('avc1', 'avc3'):
+        avcc = find_box(data, [b'avcC'], entry[0] + 78, entry[1])
+        if avcc is not None:
+            return f'{codec}.{data[avcc[0] + 1]:02x}{data[avcc[0] + 2]:02x}{data[avcc[0] + 3]:02x}'
+    return codec
+
+
+def probe_mp4(path: str) -> dict:
+    boxes = top_level_boxes(path)
+    moov = next((box for box in boxes if box[0] == b'moov'), None)
+    if moov is None:
+        raise MP4Error('moov box not found')
+    with open(path, 'rb') as file:
+        file.seek(moov[1])
+        data = file.read(moov[2])
+    mvhd = find_box(data, [b'moov', b'mvhd'])
+    if mvhd is None:
+        raise MP4Error('mvhd box not found')
+    timescale, duration = _duration(data, mvhd)
+    result = {
+        'Duration': round(duration / timescale, 3) if timescale else None,
+        'Width': None,
+        'Height': None,
+        'VideoCodec': None,
+        'AudioCodec': None,
+        'Bitrate': None,
+        'FastStart': moov[1] < min((box[1] for box in boxes if box[0] == b'mdat'), default=moov[1] + 1),
+    }
+    moov_body = find_box(data, [b'moov'])
+    for kind, offset, size, header in iter_boxes(data, *moov_body):
+        if kind != b'trak':
+            continue
+        hdlr = find_box(data, [b'mdia', b'hdlr'], offset + header, offset + size)
+        stbl = find_box(data, [b'mdia', b'minf', b'stbl'], offset + header, offset + size)
+        if hdlr is None or stbl is None:
+            continue
+        handler = data[hdlr[0] + 8:hdlr[0] + 12]
+        codec, entry = _sample_entry(data, stbl)
+        if handler == b'vide' and result['VideoCodec'] is None:
+            result['VideoCodec'] = _video_codec(data, codec, entry) if codec else None
+            tkhd = find_box(data, [b'tkhd'], offset + header, offset + size)
+            if tkhd is not None:
+                # Presentation size is the last 8 bytes of tkhd, as 16.16 fixed point
+                width, height = struct.unpack('>II', data[tkhd[1] - 8:tkhd[1]])
+                result['Width'], result['Height'] = width >> 16, height >> 16
+        elif handler == b'soun' and result['AudioCodec'] is None:
+            result['AudioCodec'] = codec
+    if result['Duration']:
+        result['Bitrate'] = int(os.path.getsize(path) * 8 / result['Duration'])
+    return result
+
+
+def _shift_chunk_offsets(moov: bytearray, moved_from: int, shift: int) -> None:
+    # Chunks stored after the original moov position do not move; everything before it moves by shift
+    def walk(start: int, end: int) -> None:
+        for kind, offset, size, header in iter_boxes(moov, start, end):
+            body = offset + header
+            if kind in CONTAINERS:
+                walk(body, offset + size)
+            elif kind in (b'stco', b'co64'):
+                count = struct.unpack('>I', moov[body + 4:body + 8])[0]
+                fmt = '>I' if kind == b'stco' else '>Q'
+                step = struct.calcsize(fmt)
+                limit = 1 << (8 * step)
+                for position in range(body + 8, body + 8 + count * step, step):
+                    value = struct.unpack(fmt, moov[position:position + step])[0]
+                    if value < moved_from:
+                        value += shift
+                        if value >= limit:
+                            raise MP4Error('chunk offset overflows stco')
+                        moov[position:position + step] = struct.pack(fmt, value)
+    walk(0, len(moov))
+
+
+def faststart(path: str) -> bool:
+    # Moves moov in front of the first mdat so playback can start from the first response.
+    # The file is rewritten next to the original and renamed over it; returns False if nothing to do.
+    boxes = top_level_boxes(path)
+    moov = next((box for box in boxes if box[0] == b'moov'), None)
+    first_mdat = next((box for box in boxes if box[0] == b'mdat'), None)
+    if moov is None:
+        raise MP4Error('moov box not found')
+    if first_mdat is None or moov[1] < first_mdat[1]:
+        return False
+    with open(path, 'rb') as source:
+        source.seek(moov[1])
+        moov_data = bytearray(source.read(moov[2]))
+        _shift_chunk_offsets(moov_data, moov[1], moov[2])
+        target = path + '.faststart'
+        try:
+            with open(target, 'wb') as output:
+                for kind, offset, size, header in boxes:
+                    if offset == first_mdat[1]:
+                        output.write(moov_data)
+                    if kind == b'moov':
+                        continue
+                    source.seek(offset)
+                    remaining = size
+                    while remaining:
+                        chunk = source.read(min(COPY_CHUNK, remaining))
+                        if not chunk:
+                            raise MP4Error('unexpected end of file')
+                        output.write(chunk)
+                        remaining -= len(chunk)
+            shutil.copymode(path, target)
+            os.replace(target, path)
+        except BaseException:
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+            raise
+    return True
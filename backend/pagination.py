@@ -0,0 +1,40 @@
+import json
+import base64
+import binascii
+
+# Keyset pagination: a cursor is the sort key of the last row of the previous page, opaque to clients
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value, separators=(',', ':')).encode()).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor: str | None, length: int | None = None):
+    if not cursor:
+        return None
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise InvalidCursor(cursor) from None
+    if length is not None and (not isinstance(value, list) or len(value) != length):
+        raise InvalidCursor(cursor)
+    return value
+
+
+def page(rows: list, limit: int, key) -> tuple[list, str | None]:
+    # rows were fetched with LIMIT limit + 1, the extra row only tells whether there is a next page
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(key(rows[-1]))
+    return rows, None
+
+
+def clamp_limit(limit, default: int, maximum: int) -> int:
+    try:
+        return max(1, min(int(limit), maximum)) if limit not in (None, '') else default
+    except (TypeError, ValueError):
+        return default
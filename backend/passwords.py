@@ -0,0 +1,98 @@
+import hmac
+import base64
+import asyncio
+import hashlib
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+# Password hashes are stored as "<scheme>$<params>$<salt>$<hash>" with base64 salt and hash.
+# Rows written before hashing was introduced hold the plain password: it is still accepted once
+# and replaced by a hash on the next successful login (or by `python database.py hash-passwords`).
+# The KDFs release the GIL, so hashing on a small dedicated pool keeps a burst of logins away from
+# the event loop and from the database workers.
+
+SCHEMES = ('scrypt', 'pbkdf2_sha256')
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def derive(scheme: str, params: tuple[int, ...], password: str, salt: bytes) -> bytes:
+    if scheme == 'scrypt':
+        n, r, p = params
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p + 1024 * 1024, dklen=32)
+    if scheme == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, params[0], dklen=32)
+    raise ValueError(f'unknown password scheme {scheme!r}')
+
+
+def parse(stored: str) -> tuple[str, tuple[int, ...], bytes, bytes] | None:
+    # None for a legacy plain password
+    scheme, _, rest = stored.partition('$')
+    if scheme not in SCHEMES or rest.count('$') != 2:
+        return None
+    params, salt, digest = rest.split('$')
+    try:
+        return scheme, tuple(int(value) for value in params.split(',')), _unb64(salt), _unb64(digest)
+    except ValueError:
+        return None
+
+
+class PasswordHasher:
+    def __init__(self, scheme: str = 'scrypt', scrypt_n: int = 2 ** 14, scrypt_r: int = 8, scrypt_p: int = 1,
+                 pbkdf2_iterations: int = 600000, workers: int = 2):
+        self.configure(scheme, scrypt_n, scrypt_r, scrypt_p, pbkdf2_iterations)
+        self.workers = workers
+        self._executor = None
+        self._dummy = None
+
+    def configure(self, scheme: str, scrypt_n: int, scrypt_r: int, scrypt_p: int, pbkdf2_iterations: int) -> None:
+        if scheme not in SCHEMES:
+            raise ValueError(f'unknown password scheme {scheme!r}')
+        self.scheme = scheme
+        self.params = (scrypt_n, scrypt_r, scrypt_p) if scheme == 'scrypt' else (pbkdf2_iterations,)
+        self._dummy = None
+
+    def hash_sync(self, password: str) -> str:
+        salt = secrets.token_bytes(16)
+        digest = derive(self.scheme, self.params, password, salt)
+        return f"{self.scheme}${','.join(map(str, self.params))}${_b64(salt)}${_b64(digest)}"
+
+    def verify_sync(self, password: str, stored: str | None) -> bool:
+        if stored is None:
+            # Unknown login: spend the same time as for a real one so logins cannot be probed by timing
+            if self._dummy is None:
+                self._dummy = self.hash_sync(secrets.token_hex(16))
+            self.verify_sync(password, self._dummy)
+            return False
+        parsed = parse(stored)
+        if parsed is None:
+            return hmac.compare_digest(password.encode(), stored.encode())
+        scheme, params, salt, digest = parsed
+        return hmac.compare_digest(derive(scheme, params, password, salt), digest)
+
+    def needs_rehash(self, stored: str) -> bool:
+        parsed = parse(stored)
+        return parsed is None or parsed[:2] != (self.scheme, self.params)
+
+    def start(self, workers: int | None = None) -> None:
+        if workers is not None:
+            self.workers = workers
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='kdf')
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def hash(self, password: str) -> str:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.hash_sync, password)
+
+    async def verify(self, password: str, stored: str | None) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.verify_sync, password, stored)
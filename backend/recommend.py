@@ -0,0 +1,61 @@
+import numpy as np
+
+# Weights of the three signals; each signal is scaled to [0, 1] (tag affinity to [-1, 1]) before mixing
+TAG_WEIGHT = 0.6
+RECENCY_WEIGHT = 0.25
+POPULARITY_WEIGHT = 0.15
+RECENCY_HALF_LIFE_DAYS = 14.0
+# A little noise so repeated requests do not always return the same list
+JITTER = 0.02
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    # argpartition is O(n); only the k winners are sorted
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+def score_videos(videos: list[tuple], pairs: list[tuple], affinity: dict[int, float],
+                 now: np.datetime64 | None = None, rng: np.random.Generator | None = None) -> np.ndarray:
+    # videos: (id, DateTime, ViewCount, Likes, Dislikes); pairs: (VideoId, TagId) for tags in affinity
+    count = len(videos)
+    if count == 0:
+        return np.empty(0)
+    ids = np.fromiter((row[0] for row in videos), dtype=np.int64, count=count)
+    position = {int(video_id): i for i, video_id in enumerate(ids)}
+
+    tag_score = np.zeros(count)
+    if pairs and affinity:
+        weights = {tag: weight for tag, weight in affinity.items()}
+        rows = np.fromiter((position.get(video_id, -1) for video_id, _ in pairs), dtype=np.intp, count=len(pairs))
+        values = np.fromiter((weights.get(tag, 0.0) for _, tag in pairs), dtype=np.float64, count=len(pairs))
+        keep = rows >= 0
+        np.add.at(tag_score, rows[keep], values[keep])
+        scale = np.abs(tag_score).max()
+        if scale > 0:
+            tag_score /= scale
+
+    if now is None:
+        now = np.datetime64('now', 's')
+    dates = np.array([str(row[1]).replace(' ', 'T') for row in videos], dtype='datetime64[s]')
+    age_days = np.maximum((now - dates).astype(np.float64) / 86400, 0)
+    recency = 0.5 ** (age_days / RECENCY_HALF_LIFE_DAYS)
+
+    stats = np.array([row[2:5] for row in videos], dtype=np.float64).reshape(count, 3)
+    popularity = np.log1p(np.maximum(stats[:, 0] + 2 * stats[:, 1] - stats[:, 2], 0))
+    if popularity.max() > 0:
+        popularity /= popularity.max()
+
+    rng = rng or np.random.default_rng()
+    return TAG_WEIGHT * tag_score + RECENCY_WEIGHT * recency + POPULARITY_WEIGHT * popularity + JITTER * rng.random(count)
+
+
+def rank(videos: list[tuple], pairs: list[tuple], affinity: dict[int, float], seen: set[int], count: int) -> list[int]:
+    # Videos the user already watched (or owns) are never recommended
+    videos = [row for row in videos if row[0] not in seen]
+    scores = score_videos(videos, pairs, affinity)
+    return [videos[i][0] for i in top_k(scores, count)]
@@ -0,0 +1,109 @@
+import gzip
+import hashlib
+from sanic.request import Request
+from sanic.response import json_dumps
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# API response layer: JSON encoding, Accept-Encoding negotiation and version-based validators.
+# orjson and brotli are optional; without them responses use Sanic's encoder and gzip only.
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+COMPRESSIBLE = ('application/json', 'text/', 'application/javascript', 'application/vnd.apple.mpegurl', 'image/svg+xml')
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY) if orjson is not None else 0
+
+
+def dumps(value, **kwargs) -> str | bytes:
+    if orjson is not None and not kwargs:
+        try:
+            return orjson.dumps(value, option=ORJSON_OPTIONS)
+        except TypeError:
+            # Types orjson refuses (e.g. integers wider than 64 bits) go through the default encoder
+            pass
+    return json_dumps(value, **kwargs)
+
+
+def negotiate_encoding(accept_encoding: str | None, available: tuple = ENCODINGS) -> str | None:
+    # Highest q-value wins, ties go to the earlier (better compressing) entry of available
+    weights = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+    best, best_weight = None, 0.0
+    for encoding in available:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(body: bytes, encoding: str, gzip_level: int = 6, brotli_quality: int = 5) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, gzip_level, mtime=0)
+
+
+def add_vary(response, header: str) -> None:
+    vary = response.headers.get('Vary')
+    if not vary:
+        response.headers['Vary'] = header
+    elif header.lower() not in (value.strip().lower() for value in vary.split(',')):
+        response.headers['Vary'] = f'{vary}, {header}'
+
+
+def compress_response(request: Request, response, min_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5) -> str | None:
+    # Compresses a complete response body in place; streamed responses (files, HLS) have no body here
+    body = getattr(response, 'body', None)
+    if not body or len(body) < min_size or response.status in (204, 206, 304) or 'Content-Encoding' in response.headers:
+        return None
+    if not (response.content_type or '').startswith(COMPRESSIBLE):
+        return None
+    add_vary(response, 'Accept-Encoding')
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return None
+    response.body = compress(body, encoding, gzip_level, brotli_quality)
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    etag = response.headers.get('ETag')
+    if etag and etag.startswith('"'):
+        # A strong validator names exact bytes, so each encoding of the representation gets its own
+        response.headers['ETag'] = f'{etag[:-1]}-{encoding}"'
+    return encoding
+
+
+def version_etag(*parts) -> str:
+    # parts are the data versions a response was built from; equal versions give the same tag
+    return '"' + hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match uses the weak comparison; tags of the compressed variants match their source
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tag = etag.strip('"')
+    for candidate in header.split(','):
+        candidate = candidate.strip().removeprefix('W/').strip('"')
+        if candidate == '*' or candidate.partition('-')[0] == tag:
+            return True
+    return False
@@ -0,0 +1,57 @@
+import asyncio
+import sqlite3
+from asyncdb import DatabaseTimeout
+
+# Keeps the analytics rollups behind the watch log: every `interval` seconds the watches added since the
+# previous run are folded into the hourly/daily view tables batch by batch, then trending is recomputed
+# from the recent hourly buckets. Every server process runs one; the claims made in the database split
+# the work between them instead of repeating it.
+
+
+class WatchRollups:
+    def __init__(self, db, interval: float = 60.0, batch_size: int = 50000, max_batches: int = 20,
+                 trending_hours: int = 48, half_life: float = 12.0):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        # Bounds one run, so a large backlog is worked off over several intervals
+        self.max_batches = max_batches
+        self.trending_hours = trending_hours
+        self.half_life = half_life
+        self.stats = {'runs': 0, 'batches': 0, 'watches': 0, 'trending_refreshes': 0, 'failed': 0}
+        self._task = None
+
+    async def run_once(self) -> None:
+        for _ in range(self.max_batches):
+            covered = await self.db.rollup_watches(self.batch_size)
+            if covered:
+                self.stats['batches'] += 1
+                self.stats['watches'] += covered
+            if covered < self.batch_size:
+                break
+        # Half an interval, so the process that refreshes is whichever gets there first each round
+        if await self.db.refresh_trending(self.trending_hours, self.half_life, self.interval / 2):
+            self.stats['trending_refreshes'] += 1
+        self.stats['runs'] += 1
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except (sqlite3.Error, DatabaseTimeout):
+                # A busy database only delays the rollups; the next run picks up where this one stopped
+                self.stats['failed'] += 1
+            await asyncio.sleep(self.interval)
+
+    def snapshot(self) -> dict:
+        return dict(self.stats)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
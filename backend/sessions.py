@@ -0,0 +1,127 @@
+import re
+import time
+import uuid
+import asyncio
+from sanic_session.base import BaseSessionInterface, SessionDict, get_request_container
+
+# Session interface for sanic_session with a pluggable store. Unlike the stock interfaces it only
+# writes a session when it changed or when less than half of its lifetime is left, and never stores
+# empty (anonymous) sessions, so a request usually costs one cached read and no write.
+# Stores: DatabaseSessionStore (the Sessions table, shared by every worker process on the host)
+# and MemorySessionStore (one process only, for development).
+
+SESSION_ID = re.compile('[0-9a-f]{32}')
+
+
+class MemorySessionStore:
+    def __init__(self):
+        self._sessions = {}
+
+    async def get(self, sid: str) -> tuple[dict, float] | None:
+        session = self._sessions.get(sid)
+        return session if session is not None and session[1] > time.time() else None
+
+    async def set(self, sid: str, data: dict, expires: float) -> None:
+        self._sessions[sid] = (data, expires)
+
+    async def delete(self, sid: str) -> None:
+        self._sessions.pop(sid, None)
+
+    async def compact(self) -> int:
+        now = time.time()
+        expired = [sid for sid, (_, expires) in self._sessions.items() if expires <= now]
+        for sid in expired:
+            del self._sessions[sid]
+        return len(expired)
+
+
+class DatabaseSessionStore:
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, sid: str) -> tuple[dict, float] | None:
+        return await self.db.get_session(sid)
+
+    async def set(self, sid: str, data: dict, expires: float) -> None:
+        await self.db.save_session(sid, data, expires)
+
+    async def delete(self, sid: str) -> None:
+        await self.db.delete_session(sid)
+
+    async def compact(self) -> int:
+        return await self.db.compact_sessions()
+
+
+class SessionInterface(BaseSessionInterface):
+    def __init__(self, store, expiry: int = 2592000, cookie_name: str = 'session', domain: str = None, httponly: bool = True,
+                 sessioncookie: bool = False, samesite: str = None, session_name: str = 'session', secure: bool = False):
+        super().__init__(expiry=expiry, prefix='', cookie_name=cookie_name, domain=domain, httponly=httponly,
+                         sessioncookie=sessioncookie, samesite=samesite, session_name=session_name, secure=secure)
+        self.store = store
+        self._compaction = None
+
+    async def _get_value(self, prefix: str, sid: str):
+        return await self.store.get(sid)
+
+    async def _delete_key(self, key: str):
+        await self.store.delete(key)
+
+    async def _set_value(self, key: str, data):
+        await self.store.set(key, data, time.time() + self.expiry)
+
+    async def open(self, request) -> SessionDict:
+        sid = request.cookies.get(self.cookie_name)
+        # Malformed cookies never reach the store
+        stored = await self.store.get(sid) if sid and SESSION_ID.fullmatch(sid) else None
+        if stored is not None:
+            session = SessionDict(stored[0], sid=sid)
+            session.expires = stored[1]
+        else:
+            session = SessionDict(sid=uuid.uuid4().hex)
+            session.expires = None
+        session.replaced = None
+        get_request_container(request)[self.session_name] = session
+        return session
+
+    def regenerate(self, request) -> None:
+        # New id for the same data, e.g. on login, so an id known before authentication is worthless
+        session = get_request_container(request)[self.session_name]
+        if session.expires is not None:
+            session.replaced = session.sid
+        session.sid = uuid.uuid4().hex
+        session.expires = None
+
+    async def save(self, request, response) -> None:
+        session = get_request_container(request).get(self.session_name)
+        if session is None:
+            return
+        if session.replaced is not None:
+            await self.store.delete(session.replaced)
+        if not session:
+            if session.expires is not None:
+                await self.store.delete(session.sid)
+                self._delete_cookie(request, response)
+            return
+        now = time.time()
+        if session.modified or session.expires is None or session.expires - now < self.expiry / 2:
+            await self.store.set(session.sid, dict(session), now + self.expiry)
+            self._set_cookie_props(request, response)
+
+    async def _compact(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.store.compact()
+            except Exception:
+                # A busy or timed out compaction is simply retried on the next round
+                pass
+
+    def start_compaction(self, interval: float) -> None:
+        if self._compaction is None:
+            self._compaction = asyncio.create_task(self._compact(interval))
+
+    async def stop_compaction(self) -> None:
+        if self._compaction is not None:
+            self._compaction.cancel()
+            await asyncio.gather(self._compaction, return_exceptions=True)
+            self._compaction = None
@@ -0,0 +1,242 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, NamedTuple, Protocol
+from urllib.parse import quote
+
+# Blob storage for uploaded videos and images. Blobs are addressed by (bucket, name), never by path,
+# so a store only needs object operations: stat, ranged read, whole-object put, delete. That is the
+# S3 model. Steps that need a real file (ffmpeg, OpenCV, Pillow) ask for fetch_to_local(), which is
+# the file itself for LocalStorage and a temporary download for any other store.
+# LocalStorage keeps every bucket as a directory below root. With several worker processes (or
+# several hosts mounting the same directory) root is the shared location. ObjectDirStorage is a
+# stand-in for an S3-compatible service: objects are opaque files it alone knows how to find.
+
+VIDEOS = 'video'
+IMAGES = 'Images'
+COPY_CHUNK = 1024 * 1024
+
+
+class BlobNotFound(FileNotFoundError):
+    pass
+
+
+class BlobStat(NamedTuple):
+    # The fields of os.stat_result that the HTTP validators use, so either can be returned by stat()
+    st_size: int
+    st_mtime_ns: int
+
+    @property
+    def st_mtime(self) -> float:
+        return self.st_mtime_ns / 1e9
+
+
+class RangeReader:
+    # A file positioned at start that reads no further than end (inclusive), like the body of a ranged GET
+    def __init__(self, file: BinaryIO, start: int = 0, end: int | None = None):
+        file.seek(start)
+        self._file = file
+        self._left = None if end is None else max(end - start + 1, 0)
+
+    def read(self, size: int = -1) -> bytes:
+        if self._left is not None:
+            size = self._left if size < 0 else min(size, self._left)
+        data = self._file.read(size)
+        if self._left is not None:
+            self._left -= len(data)
+        return data
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def check_name(bucket: str, name: str) -> None:
+    # Names come from URLs and the database: anything that could leave the bucket is refused
+    if not name or name != os.path.basename(name) or name in ('.', '..'):
+        raise BlobNotFound(f'{bucket}/{name}')
+
+
+class BlobStore(Protocol):
+    # What a backend implements; read, write and exists come for free on top of it
+    def stat(self, bucket: str, name: str) -> BlobStat | os.stat_result:
+        ...
+
+    def open_range(self, bucket: str, name: str, start: int = 0, end: int | None = None) -> RangeReader:
+        # Bytes start..end inclusive, like an HTTP range; raises BlobNotFound
+        ...
+
+    def put_file(self, bucket: str, name: str, source: str) -> None:
+        # Moves a finished local file (an assembled upload, a rendered thumbnail) into the store;
+        # readers see either the previous blob or the whole new one
+        ...
+
+    def delete(self, bucket: str, name: str) -> None:
+        ...
+
+    def fetch_to_local(self, bucket: str, name: str):
+        # Context manager giving a local file with the blob's name, valid until it exits
+        ...
+
+    def create_buckets(self, *buckets: str) -> None:
+        ...
+
+    def exists(self, bucket: str, name: str) -> bool:
+        try:
+            self.stat(bucket, name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def read(self, bucket: str, name: str, start: int = 0, end: int | None = None) -> bytes:
+        with self.open_range(bucket, name, start, end) as body:
+            return body.read()
+
+    def write(self, bucket: str, name: str, data: bytes) -> None:
+        check_name(bucket, name)
+        with tempfile.NamedTemporaryFile(delete=False) as file:
+            file.write(data)
+        try:
+            self.put_file(bucket, name, file.name)
+        finally:
+            if os.path.exists(file.name):
+                os.remove(file.name)
+
+
+class LocalStorage(BlobStore):
+    def __init__(self, root: str = '.'):
+        self.root = root
+
+    def local_path(self, bucket: str, name: str) -> str:
+        # Only for this backend; everything else goes through the object operations
+        check_name(bucket, name)
+        return os.path.join(self.root, bucket, name)
+
+    def stat(self, bucket: str, name: str) -> os.stat_result:
+        path = self.local_path(bucket, name)
+        if not os.path.isfile(path):
+            raise BlobNotFound(f'{bucket}/{name}')
+        return os.stat(path)
+
+    def open_range(self, bucket: str, name: str, start: int = 0, end: int | None = None) -> RangeReader:
+        try:
+            return RangeReader(open(self.local_path(bucket, name), 'rb'), start, end)
+        except FileNotFoundError:
+            raise BlobNotFound(f'{bucket}/{name}') from None
+
+    def write(self, bucket: str, name: str, data: bytes) -> None:
+        # Written under a temporary name and renamed, so readers never see a half-written blob
+        path = self.local_path(bucket, name)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+
+    def put_file(self, bucket: str, name: str, source: str) -> None:
+        path = self.local_path(bucket, name)
+        if os.path.abspath(source) != os.path.abspath(path):
+            # A move across filesystems is a copy, which only becomes visible once complete
+            shutil.move(source, path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    def delete(self, bucket: str, name: str) -> None:
+        try:
+            os.remove(self.local_path(bucket, name))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def fetch_to_local(self, bucket: str, name: str):
+        # The blob already is a local file: changes made to it are changes to the blob
+        path = self.local_path(bucket, name)
+        if not os.path.isfile(path):
+            raise BlobNotFound(f'{bucket}/{name}')
+        yield path
+
+    def create_buckets(self, *buckets: str) -> None:
+        for bucket in buckets:
+            os.makedirs(os.path.join(self.root, bucket), exist_ok=True)
+
+
+class ObjectDirStorage(BlobStore):
+    # Local stand-in for an S3-compatible store, for running and testing everything against a backend
+    # without file paths: each object is one file in root named by a hash of its key, never exposed.
+    # Puts are atomic renames, so every worker process and host sharing root sees the same objects.
+    def __init__(self, root: str = 'objects'):
+        self.root = root
+
+    def _object(self, bucket: str, name: str) -> str:
+        check_name(bucket, name)
+        key = f'{quote(bucket, safe="")}/{quote(name, safe="")}'
+        return os.path.join(self.root, hashlib.sha256(key.encode()).hexdigest())
+
+    def stat(self, bucket: str, name: str) -> BlobStat:
+        try:
+            stat = os.stat(self._object(bucket, name))
+        except FileNotFoundError:
+            raise BlobNotFound(f'{bucket}/{name}') from None
+        return BlobStat(stat.st_size, stat.st_mtime_ns)
+
+    def open_range(self, bucket: str, name: str, start: int = 0, end: int | None = None) -> RangeReader:
+        try:
+            return RangeReader(open(self._object(bucket, name), 'rb'), start, end)
+        except FileNotFoundError:
+            raise BlobNotFound(f'{bucket}/{name}') from None
+
+    def put_file(self, bucket: str, name: str, source: str) -> None:
+        target = self._object(bucket, name)
+        staging = f'{target}.{os.getpid()}.tmp'
+        shutil.move(source, staging)
+        os.replace(staging, target)
+
+    def delete(self, bucket: str, name: str) -> None:
+        try:
+            os.remove(self._object(bucket, name))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def fetch_to_local(self, bucket: str, name: str):
+        # Downloaded into a temporary directory under the blob's own name, removed again on exit
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, name)
+            with self.open_range(bucket, name) as body, open(path, 'wb') as file:
+                shutil.copyfileobj(body, file, COPY_CHUNK)
+            yield path
+
+    def create_buckets(self, *buckets: str) -> None:
+        os.makedirs(self.root, exist_ok=True)
+
+
+BACKENDS = {
+    'local': LocalStorage,
+    'objects': ObjectDirStorage,
+}
+
+
+def create_storage(backend: str = 'local', **options) -> BlobStore:
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown storage backend {backend!r}, expected one of {", ".join(BACKENDS)}')
+    return BACKENDS[backend](**options)
+
+
+if __name__ == '__main__':
+    import sys
+    # python storage.py put <bucket> <file>...: copies local files (the stock Images, e.g. no-photo.png) into the
+    # store the server is configured with through SANIC_STORAGE_BACKEND and the other SANIC_STORAGE_* variables
+    if len(sys.argv) > 3 and sys.argv[1] == 'put':
+        options = {key[14:].lower(): value for key, value in os.environ.items() if key.startswith('SANIC_STORAGE_') and key != 'SANIC_STORAGE_BACKEND'}
+        store = create_storage(os.environ.get('SANIC_STORAGE_BACKEND', 'local'), **options)
+        store.create_buckets(sys.argv[2])
+        for path in sys.argv[3:]:
+            with open(path, 'rb') as file:
+                store.write(sys.argv[2], os.path.basename(path), file.read())
+        print(len(sys.argv) - 3, 'files stored')
+    else:
+        print('usage: python storage.py put <bucket> <file>...')
@@ -0,0 +1,183 @@
+import os
+import asyncio
+import secrets
+import mimetypes
+import email.utils
+from functools import partial
+from sanic import response
+from sanic.request import Request
+
+CHUNK_SIZE = 64 * 1024
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> list[tuple[int, int]] | None:
+    # None means the header is malformed or should be ignored and the whole file is sent
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, sep, end = part.partition('-')
+        start, end = start.strip(), end.strip()
+        if not sep or not (start or end):
+            return None
+        try:
+            if not start:
+                length = int(end)
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+            first = int(start)
+            last = int(end) if end else first
+        except ValueError:
+            return None
+        if first < 0 or last < first:
+            return None
+        if not end:
+            last = size - 1
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+    if not ranges:
+        raise RangeNotSatisfiable
+    ranges.sort()
+    merged = [ranges[0]]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def file_validators(stat: os.stat_result) -> tuple[str, str]:
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+    return etag, last_modified
+
+
+def _parse_http_date(value: str) -> float | None:
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since:
+        since = _parse_http_date(if_modified_since)
+        return since is not None and int(mtime) <= since
+    return False
+
+
+def if_range_matches(request: Request, etag: str, last_modified: str) -> bool:
+    value = request.headers.get('If-Range')
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('"'):
+        return value == etag
+    return value == last_modified
+
+
+def open_file_range(path: str, start: int, end: int):
+    file = open(path, 'rb')
+    file.seek(start)
+    return file
+
+
+async def _send_range(stream, open_range, start: int, end: int, chunk_size: int, on_send=None) -> None:
+    loop = asyncio.get_running_loop()
+    file = await loop.run_in_executor(None, open_range, start, end)
+    try:
+        offset = start
+        while offset <= end:
+            chunk = await loop.run_in_executor(None, file.read, min(chunk_size, end - offset + 1))
+            if not chunk:
+                break
+            await stream.send(chunk)
+            if on_send is not None:
+                on_send(len(chunk))
+            offset += len(chunk)
+    finally:
+        file.close()
+
+
+async def send_file_ranges(request: Request, path: str, headers: dict | None = None,
+                           content_type: str | None = None, chunk_size: int = CHUNK_SIZE, on_send=None):
+    # Raises OSError if the file cannot be read
+    stat = await asyncio.get_running_loop().run_in_executor(None, os.stat, path)
+    return await send_ranges(request, stat, partial(open_file_range, path), headers,
+                             content_type or mimetypes.guess_type(path)[0], chunk_size, on_send)
+
+
+async def send_blob_ranges(request: Request, store, bucket: str, name: str, headers: dict | None = None,
+                           content_type: str | None = None, chunk_size: int = CHUNK_SIZE, on_send=None):
+    # Same for a blob of a storage backend; raises BlobNotFound (an OSError) if there is none
+    stat = await asyncio.get_running_loop().run_in_executor(None, store.stat, bucket, name)
+    return await send_ranges(request, stat, partial(store.open_range, bucket, name), headers,
+                             content_type or mimetypes.guess_type(name)[0], chunk_size, on_send)
+
+
+async def send_ranges(request: Request, stat, open_range, headers: dict | None = None, content_type: str | None = None,
+                      chunk_size: int = CHUNK_SIZE, on_send=None, etag: str | None = None):
+    # stat has st_size, st_mtime and st_mtime_ns; open_range(start, end) returns a readable body positioned at
+    # start (it is called in a worker thread). Memory use is one chunk regardless of the size.
+    # on_send(bytes) is called after every chunk of data actually written to the client.
+    size = stat.st_size
+    file_etag, last_modified = file_validators(stat)
+    etag = etag or file_etag
+    content_type = content_type or 'application/octet-stream'
+    headers = {**(headers or {}), 'Accept-Ranges': 'bytes', 'ETag': etag, 'Last-Modified': last_modified}
+
+    if is_not_modified(request, etag, stat.st_mtime):
+        return response.empty(status=304, headers=headers)
+
+    ranges = None
+    range_header = request.headers.get('Range')
+    if range_header and if_range_matches(request, etag, last_modified):
+        try:
+            ranges = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            headers['Content-Range'] = f'bytes */{size}'
+            return response.empty(status=416, headers=headers)
+
+    if not ranges:
+        headers['Content-Length'] = str(size)
+        stream = await request.respond(status=200, headers=headers, content_type=content_type)
+        if size:
+            await _send_range(stream, open_range, 0, size - 1, chunk_size, on_send)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+        stream = await request.respond(status=206, headers=headers, content_type=content_type)
+        await _send_range(stream, open_range, start, end, chunk_size, on_send)
+    else:
+        boundary = secrets.token_hex(16)
+        parts = [((f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+                  f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode(), start, end)
+                 for start, end in ranges]
+        closing = f'\r\n--{boundary}--\r\n'.encode()
+        headers['Content-Length'] = str(sum(len(head) + end - start + 1 for head, start, end in parts) + len(closing))
+        stream = await request.respond(status=206, headers=headers,
+                                       content_type=f'multipart/byteranges; boundary={boundary}')
+        for head, start, end in parts:
+            await stream.send(head)
+            await _send_range(stream, open_range, start, end, chunk_size, on_send)
+        await stream.send(closing)
+    await stream.eof()
@@ -0,0 +1,88 @@
+import os
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+# Thumbnail variants are stored next to the original image, in the same bucket: <stem>.<size>.<format>
+SIZES = {
+    'hero': (1280, 720),
+    'card': (320, 180),
+    'tiny': (32, 18),
+}
+FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+CONTENT_TYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+
+SAMPLE_FRAMES = 8
+SAMPLE_WIDTH = 160
+MIN_BRIGHTNESS = 24
+MAX_BRIGHTNESS = 232
+MIN_CONTRAST = 12
+
+
+def variant_path(image_path: str, size: str, fmt: str) -> str:
+    return f'{os.path.splitext(image_path)[0]}.{size}.{fmt}'
+
+
+def variant_paths(image_path: str) -> list[str]:
+    return [variant_path(image_path, size, fmt) for size in SIZES for fmt in FORMATS]
+
+
+def remove_variants(store, bucket: str, image: str) -> None:
+    for name in variant_paths(image):
+        store.delete(bucket, name)
+
+
+def frame_scores(frames: np.ndarray) -> np.ndarray:
+    # frames: (n, h, w) grayscale. Sharpness is the variance of a 4-neighbour Laplacian; frames that are
+    # nearly black/white or flat (fades, title cards) are ranked below every usable frame.
+    frames = frames.astype(np.float32)
+    mean = frames.mean(axis=(1, 2))
+    contrast = frames.std(axis=(1, 2))
+    laplacian = (frames[:, :-2, 1:-1] + frames[:, 2:, 1:-1] + frames[:, 1:-1, :-2] + frames[:, 1:-1, 2:]
+                 - 4 * frames[:, 1:-1, 1:-1])
+    sharpness = laplacian.var(axis=(1, 2))
+    usable = (mean > MIN_BRIGHTNESS) & (mean < MAX_BRIGHTNESS) & (contrast > MIN_CONTRAST)
+    return np.where(usable, sharpness, sharpness - sharpness.max() - 1)
+
+
+def pick_frame(video_path: str, samples: int = SAMPLE_FRAMES) -> np.ndarray | None:
+    vidcap = cv2.VideoCapture(video_path)
+    try:
+        total = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # Skip the first and last 5%, where intros, fades and end cards usually are
+        positions = np.unique(np.linspace(total * 0.05, max(total * 0.95 - 1, 0), samples).astype(int))
+        frames, small = [], []
+        for position in positions:
+            vidcap.set(cv2.CAP_PROP_POS_FRAMES, int(position))
+            success, frame = vidcap.read()
+            if not success:
+                continue
+            height = max(1, frame.shape[0] * SAMPLE_WIDTH // frame.shape[1])
+            frames.append(frame)
+            small.append(cv2.cvtColor(cv2.resize(frame, (SAMPLE_WIDTH, height), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY))
+        if not frames:
+            return None
+        return frames[int(np.argmax(frame_scores(np.stack(small))))]
+    finally:
+        vidcap.release()
+
+
+def save_frame(frame: np.ndarray, image_path: str) -> None:
+    Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).save(image_path)
+
+
+def make_thumbnails(image_path: str, target_dir: str) -> dict:
+    # Variants are written to target_dir under the names variant_path() gives for the image's file name
+    with Image.open(image_path) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    sizes = {}
+    for size, box in SIZES.items():
+        resized = ImageOps.fit(image, box, Image.LANCZOS)
+        for fmt, options in FORMATS.items():
+            path = os.path.join(target_dir, variant_path(os.path.basename(image_path), size, fmt))
+            resized.save(path, **options)
+            sizes[f'{size}.{fmt}'] = os.path.getsize(path)
+    return sizes
@@ -0,0 +1,137 @@
+import os
+import re
+
+UPLOADS_DIR = 'uploads'
+MAX_FIELD_SIZE = 64 * 1024
+
+
+class MultipartError(Exception):
+    pass
+
+
+def multipart_boundary(content_type: str) -> bytes | None:
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not content_type or not content_type.lower().startswith('multipart/form-data') or not match:
+        return None
+    return match.group(1).encode()
+
+
+def _disposition(headers: bytes) -> tuple[str | None, str | None]:
+    for line in headers.decode('utf-8', 'replace').split('\r\n'):
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-disposition':
+            field = re.search(r'(?<![\w*])name="([^"]*)"', value)
+            filename = re.search(r'filename="([^"]*)"', value)
+            return field.group(1) if field else None, filename.group(1) if filename else None
+    return None, None
+
+
+class MultipartStreamParser:
+    # Incremental multipart/form-data parser: file parts are written to the files returned by open_file
+    # as the body arrives, plain fields are kept in memory up to MAX_FIELD_SIZE. Only a boundary-sized
+    # tail of the current chunk is ever buffered.
+    def __init__(self, boundary: bytes, open_file):
+        self.delimiter = b'\r\n--' + boundary
+        self.open_file = open_file
+        self.fields = {}
+        self.files = {}
+        self._buffer = bytearray(b'\r\n')
+        self._state = 'preamble'
+        self._field = None
+        self._sink = None
+        self._value = None
+
+    def feed(self, data: bytes) -> None:
+        self._buffer += data
+        while True:
+            if self._state == 'preamble':
+                index = self._buffer.find(self.delimiter)
+                if index < 0:
+                    del self._buffer[:max(0, len(self._buffer) - len(self.delimiter))]
+                    return
+                del self._buffer[:index + len(self.delimiter)]
+                self._state = 'delimiter'
+            elif self._state == 'delimiter':
+                if len(self._buffer) < 2:
+                    return
+                if self._buffer[:2] == b'--':
+                    self._state = 'done'
+                    self._buffer.clear()
+                    return
+                if self._buffer[:2] != b'\r\n':
+                    raise MultipartError('malformed boundary')
+                del self._buffer[:2]
+                self._state = 'headers'
+            elif self._state == 'headers':
+                index = self._buffer.find(b'\r\n\r\n')
+                if index < 0:
+                    if len(self._buffer) > MAX_FIELD_SIZE:
+                        raise MultipartError('part headers too large')
+                    return
+                self._start_part(bytes(self._buffer[:index]))
+                del self._buffer[:index + 4]
+                self._state = 'body'
+            elif self._state == 'body':
+                index = self._buffer.find(self.delimiter)
+                if index < 0:
+                    keep = len(self.delimiter) - 1
+                    if len(self._buffer) > keep:
+                        self._write(self._buffer[:len(self._buffer) - keep])
+                        del self._buffer[:len(self._buffer) - keep]
+                    return
+                self._write(self._buffer[:index])
+                del self._buffer[:index + len(self.delimiter)]
+                self._end_part()
+                self._state = 'delimiter'
+            else:
+                return
+
+    def finish(self) -> None:
+        if self._state != 'done':
+            self._end_part()
+            raise MultipartError('unexpected end of body')
+
+    def close(self) -> None:
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def _start_part(self, headers: bytes) -> None:
+        name, filename = _disposition(headers)
+        self._field = name
+        if filename is not None:
+            self._sink = self.open_file(name, filename)
+            if self._sink is not None:
+                self.files[name] = {'filename': filename, 'size': 0}
+        else:
+            self._value = bytearray()
+
+    def _write(self, data) -> None:
+        if not data:
+            return
+        if self._value is not None:
+            if len(self._value) + len(data) > MAX_FIELD_SIZE:
+                raise MultipartError(f'field {self._field} too large')
+            self._value += data
+        elif self._sink is not None:
+            self._sink.write(data)
+            self.files[self._field]['size'] += len(data)
+
+    def _end_part(self) -> None:
+        if self._value is not None and self._field is not None:
+            self.fields[self._field] = self._value.decode('utf-8', 'replace')
+        if self._sink is not None:
+            self._sink.close()
+        self._field = self._sink = self._value = None
+
+
+def upload_part_path(UploadId: str) -> str:
+    return os.path.join(UPLOADS_DIR, UploadId + '.part')
+
+
+def remove_files(*paths: str) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass